@@ -0,0 +1,397 @@
+#Script for online DDPG training with rollout actors decoupled from a single learner process
+import json
+import os
+import queue
+import time
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch import multiprocessing as mp
+from tensorboardX import SummaryWriter
+
+from control.nn_control import NNController
+from net.ddpg_net import DDPGActor, DDPGCritic
+from net.utils import ReplayBuffer, PrioritizedReplayBuffer, get_paths, transition
+from spawn import configure_simulation
+from runner_NN import parse_args as parse_runner_args, run_episode
+
+#Configs
+from config import GAMMA, SENSORS, NUMERIC_FEATURES, BATCH_SIZE, DATE_TIME, DEVICE
+
+from utils import arg_bool
+
+#Seconds processes get to finish after stop is set before they are terminated
+JOIN_TIMEOUT = 30
+
+
+class SharedWeights:
+    def __init__(self, net:torch.nn.Module, ctx=mp):
+        '''
+        Copy of the actor weights in shared CPU memory. Learner publishes new versions, actors pull them
+        between simulation steps without waiting for the learner.
+        :param net: torch.nn.Module, actor network defining the state_dict layout
+        :param ctx: multiprocessing context the processes are created with
+        '''
+        self.state = {key: value.detach().cpu().clone().share_memory_() for key, value in net.state_dict().items()}
+        self.version = ctx.Value('q', 0, lock=False)
+        self.lock = ctx.Lock()
+        self.local_version = 0
+        self.staleness = []
+
+    def publish(self, net:torch.nn.Module) -> int:
+        '''
+        :param net: torch.nn.Module, learner actor network
+        :return: int, published version
+        '''
+        with self.lock:
+            for key, value in net.state_dict().items():
+                self.state[key].copy_(value.detach())
+            self.version.value += 1
+            return self.version.value
+
+    def pull(self, net:torch.nn.Module) -> int:
+        '''
+        Loads published weights into net if they are newer than the ones it already has
+        :param net: torch.nn.Module, actor network of the rollout process
+        :return: int, staleness, number of versions the weights were behind the learner before the pull
+        '''
+        staleness = self.version.value - self.local_version
+        if staleness > 0:
+            with self.lock:
+                net.load_state_dict(self.state)
+                self.local_version = self.version.value
+        self.staleness.append(staleness)
+        return staleness
+
+    def stats(self) -> dict:
+        '''
+        :return: dict, mean and max staleness of the pulls since the last reset and local version
+        '''
+        staleness = np.array(self.staleness) if self.staleness else np.zeros(1)
+        return {'staleness_mean': float(staleness.mean()),
+                'staleness_max': int(staleness.max()),
+                'version': self.local_version}
+
+    def reset_stats(self) -> None:
+        self.staleness = []
+
+
+class ReplayQueue:
+    def __init__(self, transitions, features:list=NUMERIC_FEATURES, no_data_points:int=4, batch_size:int=BATCH_SIZE,
+                 stop=None):
+        '''
+        Actor side stand-in for the replay buffer, transitions are sent to the learner owning the ReplayBuffer.
+        It's always empty, so run_episode doesn't train in actor processes.
+        :param transitions: multiprocessing.Queue, read by the learner
+        :param features: list, numeric features
+        :param no_data_points: int, number of stacked frames
+        :param batch_size: int, kept for compatibility with ReplayBuffer
+        :param stop: multiprocessing.Event, set when the run ends, blocked sends give up
+        '''
+        self.transitions = transitions
+        self.features = features
+        self.no_data_points = no_data_points
+        self.batch_size = batch_size
+        self.stop = stop
+        self.sent = 0
+
+    def __len__(self):
+        return 0
+
+    def add_step(self, path:str, state:dict, action:dict, reward:float, done:float=0.) -> None:
+        '''
+        Sends online step of the agent to the learner, blocks if the learner is behind by the whole queue
+        until the learner catches up or the run is stopped
+        :return: None
+        '''
+        step = transition(path=path, state=state, action=action, reward=reward, done=done, features=self.features,
+                          no_data_points=self.no_data_points)
+        while True:
+            try:
+                self.transitions.put(step, timeout=1)
+                break
+            except queue.Full:
+                if self.stop is not None and self.stop.is_set():
+                    raise RuntimeError('Run stopped, learner no longer reads transitions')
+        self.sent += 1
+
+
+def build_controller(args, train:bool, device:str) -> NNController:
+    '''
+    :param args: argparse.args, config
+    :param train: bool, create target networks and optimizers
+    :param device: str, device of the networks
+    :return: NNController
+    '''
+    img_shape = [3, 60, 80 * args.no_data]
+    cuda = torch.device(device).type == 'cuda'
+    actor_net = DDPGActor(img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)],
+                          output_shape=[2], linear_hidden=args.linear, conv_filters=args.conv, cuda=cuda)
+    critic_net = DDPGCritic(actor_out_shape=[2, ], img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)],
+                            linear_hidden=args.linear, conv_filters=args.conv, cuda=cuda)
+    if args.actor_path:
+        actor_net.load_state_dict(torch.load(args.actor_path, map_location=device))
+    if args.critic_path:
+        critic_net.load_state_dict(torch.load(args.critic_path, map_location=device))
+    return NNController(actor_net=actor_net, critic_net=critic_net, no_data_points=args.no_data,
+                        features=NUMERIC_FEATURES, train=train, optimizer='adam', device=device,
+                        epsilon=args.epsilon, shared_encoder=args.shared_encoder, hard_sync_every=args.hard_sync_every)
+
+
+def learner(args, transitions, weights:SharedWeights, stats, stop) -> None:
+    '''
+    Owns the replay buffer and the optimizers. Ingests transitions sent by actors and trains as long as
+    the update-to-data ratio allows, newest actor weights are published every args.publish_every updates.
+    '''
+    controller = build_controller(args, train=True, device=args.device)
+    weights.publish(controller.actor_net)
+
+    buffer_params = {'capacity': args.capacity, 'features': NUMERIC_FEATURES, 'no_data_points': args.no_data,
+                     'batch_size': BATCH_SIZE}
+    buffer = PrioritizedReplayBuffer(**buffer_params) if args.prioritized else ReplayBuffer(**buffer_params)
+    if args.random_init:
+        for path in np.random.permutation(sorted(get_paths(sensors=SENSORS, tag='MPC').keys())):
+            buffer.add_episode(path=str(path))
+
+    updates = ingested = 0
+    report = {'updates': 0, 'ingested': 0, 'time': time.perf_counter(), 'actor_loss_v': 0., 'critic_loss_v': 0.}
+    while not stop.is_set():
+        #Everything actors sent so far goes to the buffer first, queue is bounded so they can't run away
+        for _ in range(args.queue_size):
+            try:
+                buffer.add(**transitions.get_nowait())
+                ingested += 1
+            except queue.Empty:
+                break
+
+        if len(buffer) <= args.min_size or (args.utd > 0 and updates >= args.utd * ingested):
+            time.sleep(0.005)
+        else:
+            batch = buffer.sample()
+            actor_loss_v, critic_loss_v, q_ref_v, td_errors = controller.train_on_batch(batch=batch, gamma=GAMMA)
+            if args.prioritized:
+                buffer.update_priorities(batch['idx'], td_errors.cpu().numpy())
+            updates += 1
+            report['actor_loss_v'] += actor_loss_v / buffer.batch_size
+            report['critic_loss_v'] += critic_loss_v / buffer.batch_size
+            if updates % args.publish_every == 0:
+                weights.publish(controller.actor_net)
+            if updates % args.save_every == 0:
+                save_models(controller, args.path)
+
+        elapsed = time.perf_counter() - report['time']
+        if elapsed > args.report_every:
+            new_updates = updates - report['updates']
+            stats.put({'process': 'learner',
+                       'updates_per_s': new_updates / elapsed,
+                       'transitions_per_s': (ingested - report['ingested']) / elapsed,
+                       'utd': new_updates / max(ingested - report['ingested'], 1),
+                       'buffer': len(buffer),
+                       'version': weights.version.value,
+                       'actor_loss_v': float(report['actor_loss_v']) / max(new_updates, 1),
+                       'critic_loss_v': float(report['critic_loss_v']) / max(new_updates, 1)})
+            report = {'updates': updates, 'ingested': ingested, 'time': time.perf_counter(),
+                      'actor_loss_v': 0., 'critic_loss_v': 0.}
+
+    save_models(controller, args.path)
+
+
+def actor(rank:int, args, transitions, weights:SharedWeights, stats, stop) -> None:
+    '''
+    Runs episodes on its own simulator with the newest published weights, steps are sent to the learner
+    '''
+    args.port = args.ports[rank % len(args.ports)]
+    client = configure_simulation(args)
+    controller = build_controller(args, train=False, device=args.actor_device)
+    controller.actor_net.eval()
+    weights.pull(controller.actor_net)
+    if args.cpu_inference:
+        controller.cpu_inference(threads=args.threads, quantize=args.quantize)
+    buffer = ReplayQueue(transitions, features=NUMERIC_FEATURES, no_data_points=args.no_data, stop=stop)
+
+    global_step = 0
+    for i in range(args.episodes):
+        if stop.is_set():
+            break
+        weights.reset_stats()
+        start, sent = time.perf_counter(), buffer.sent
+        try:
+            episode_info, _, status, save_paths, global_step, ep_length = run_episode(client=client,
+                                                                                      controller=controller,
+                                                                                      buffer=buffer,
+                                                                                      writer=None,
+                                                                                      global_step=global_step,
+                                                                                      args=args,
+                                                                                      weights=weights)
+        except Exception as e:
+            print(f'Actor {rank}: unsuccesfull episode {i}, {e}')
+            continue
+        elapsed = time.perf_counter() - start
+        stats.put({'process': f'actor_{rank}',
+                   'episode_q': episode_info['episode_q'],
+                   'episode_length': ep_length,
+                   'steps_per_s': (buffer.sent - sent) / elapsed,
+                   **episode_info['inference'],
+                   **weights.stats()})
+    stats.put({'process': f'actor_{rank}', 'finished': 1})
+    if stop.is_set():
+        #Transitions the learner won't read don't keep the process alive
+        transitions.cancel_join_thread()
+
+
+def save_models(controller:NNController, path:str) -> None:
+    torch.save(controller.actor_net.state_dict(), f=f'{path}/{controller.actor_net.__class__.__name__}.pt')
+    torch.save(controller.critic_net.state_dict(), f=f'{path}/{controller.critic_net.__class__.__name__}.pt')
+
+
+def main(args):
+    args.invert = arg_bool(args.invert)
+    args.random_init = arg_bool(args.random_init)
+    args.prioritized = arg_bool(args.prioritized)
+    args.shared_encoder = arg_bool(args.shared_encoder)
+    args.cpu_inference = arg_bool(args.cpu_inference)
+    args.quantize = arg_bool(args.quantize)
+    args.controller = 'NN'
+    args.ports = [int(port) for port in args.ports.split(',')]
+    args.path = f'../data/models/rl/{DATE_TIME}/actor_learner'
+    os.makedirs(args.path, exist_ok=True)
+    json.dump(vars(args), fp=open(f'{args.path}/args.json', 'w'), sort_keys=True, indent=4)
+    print(vars(args))
+
+    #CUDA can't be initialized in forked processes
+    ctx = mp.get_context('spawn')
+    transitions = ctx.Queue(maxsize=args.queue_size)
+    stats = ctx.Queue()
+    stop = ctx.Event()
+    weights = SharedWeights(build_controller(args, train=False, device='cpu').actor_net, ctx=ctx)
+
+    processes = [ctx.Process(target=learner, args=(args, transitions, weights, stats, stop), name='learner')]
+    processes += [ctx.Process(target=actor, args=(rank, args, transitions, weights, stats, stop), name=f'actor_{rank}')
+                  for rank in range(args.actors)]
+    for process in processes:
+        process.start()
+
+    writer = SummaryWriter(f'{args.path}/writer', max_queue=30, flush_secs=5)
+    steps = defaultdict(int)
+    finished = 0
+    try:
+        while finished < args.actors and processes[0].is_alive():
+            try:
+                info = stats.get(timeout=1)
+            except queue.Empty:
+                continue
+            process = info.pop('process')
+            if info.pop('finished', 0):
+                finished += 1
+                continue
+            for key, value in info.items():
+                writer.add_scalar(f'{process}/{key}', scalar_value=value, global_step=steps[process])
+            steps[process] += 1
+            print(f'{process}: ' + ', '.join(f'{key} {value:.3f}' for key, value in info.items()))
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(timeout=JOIN_TIMEOUT)
+            if process.is_alive():
+                print(f'{process.name} did not stop in {JOIN_TIMEOUT} s, terminating')
+                process.terminate()
+                process.join()
+        writer.close()
+
+
+def parse_args():
+    args = parse_runner_args()
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--actors',
+        default=2,
+        type=int,
+        dest='actors',
+        help='Number of rollout processes, each one needs own simulator')
+    argparser.add_argument(
+        '--ports',
+        default='2000',
+        type=str,
+        dest='ports',
+        help='Comma separated ports of simulators, actor i connects to port i modulo number of ports')
+    argparser.add_argument(
+        '--device',
+        default=str(DEVICE),
+        type=str,
+        dest='device',
+        help='Device of the learner')
+    argparser.add_argument(
+        '--actor_device',
+        default='cpu',
+        type=str,
+        dest='actor_device',
+        help='Device of the actors, use --cpu_inference for CPU-only rollout nodes')
+    argparser.add_argument(
+        '--actor_path',
+        default=None,
+        type=str,
+        dest='actor_path',
+        help='Initial weights of the actor network')
+    argparser.add_argument(
+        '--critic_path',
+        default=None,
+        type=str,
+        dest='critic_path',
+        help='Initial weights of the critic network')
+    argparser.add_argument(
+        '--capacity',
+        default=100_000,
+        type=int,
+        dest='capacity',
+        help='Replay buffer capacity, frames of the transitions are kept in memory (about 1.5 GiB per 100k)')
+    argparser.add_argument(
+        '--min_size',
+        default=int(1e4),
+        type=int,
+        dest='min_size',
+        help='Learner starts training when buffer has more transitions')
+    argparser.add_argument(
+        '--utd',
+        default=1.,
+        type=float,
+        dest='utd',
+        help='Max number of updates per transition received from actors, 0 trains without limit')
+    argparser.add_argument(
+        '--publish_every',
+        default=50,
+        type=int,
+        dest='publish_every',
+        help='Number of learner updates between published actor weights')
+    argparser.add_argument(
+        '--save_every',
+        default=5000,
+        type=int,
+        dest='save_every',
+        help='Number of learner updates between saved models')
+    argparser.add_argument(
+        '--queue_size',
+        default=4096,
+        type=int,
+        dest='queue_size',
+        help='Max number of transitions waiting for the learner')
+    argparser.add_argument(
+        '--report_every',
+        default=10.,
+        type=float,
+        dest='report_every',
+        help='Seconds between learner stats')
+    extra = argparser.parse_known_args()
+    if len(extra) > 1:
+        extra = extra[0]
+    vars(args).update(vars(extra))
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
@@ -0,0 +1,102 @@
+import queue
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+class AsyncWriter:
+    def __init__(self, workers:int=2, queue_size:int=512):
+        '''
+        Background writer for frames and episode rows, so simulation loop doesn't wait for the disk.
+        Tasks submitted with the same key are executed in submission order by the same worker thread.
+        When worker queue is full submit blocks (backpressure) until disk catches up.
+        :param workers: int, number of writer threads
+        :param queue_size: int, max number of pending tasks per worker
+        '''
+        self.queues = [queue.Queue(maxsize=queue_size) for i in range(workers)]
+        self.threads = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self.queues]
+        self.lock = threading.Lock()
+        self.errors = []
+        self.reset_stats()
+        for thread in self.threads:
+            thread.start()
+
+    def _worker(self, key) -> queue.Queue:
+        return self.queues[zlib.crc32(repr(key).encode()) % len(self.queues)]
+
+    def _work(self, tasks:queue.Queue) -> None:
+        while True:
+            submitted, fn, args, kwargs = tasks.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                latency = time.perf_counter() - submitted
+                with self.lock:
+                    self.latencies.append(latency)
+                tasks.task_done()
+
+    def submit(self, key, fn, *args, **kwargs) -> None:
+        '''
+        Enqueues fn(*args, **kwargs), blocks if worker queue is full
+        :param key: hashable, tasks with equal keys are serialized
+        :param fn: callable
+        :return: None
+        '''
+        tasks = self._worker(key)
+        start = time.perf_counter()
+        tasks.put((start, fn, args, kwargs))
+        self.blocked += time.perf_counter() - start
+        self.max_depth = max(self.max_depth, tasks.qsize())
+
+    def flush(self, key=None) -> None:
+        '''
+        Waits until tasks of the key (or all tasks if key is None) are written, re-raises worker errors
+        :param key: hashable
+        :return: None
+        '''
+        for tasks in ([self._worker(key)] if key is not None else self.queues):
+            tasks.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    @property
+    def depth(self) -> int:
+        return sum(tasks.qsize() for tasks in self.queues)
+
+    def stats(self) -> dict:
+        '''
+        :return: dict, current and max queue depth, write latency (submit to done) in ms
+        and total time simulation loop was blocked by backpressure in s
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {'queue_depth': self.depth,
+                'max_queue_depth': self.max_depth,
+                'latency_mean_ms': float(latencies.mean()),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+                'blocked_s': self.blocked}
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.latencies = []
+        self.max_depth = 0
+        self.blocked = .0
+
+
+_writer = None
+
+
+def get_async_writer(**kwargs) -> AsyncWriter:
+    '''
+    Returns process wide AsyncWriter, created on first call
+    :return: AsyncWriter
+    '''
+    global _writer
+    if _writer is None:
+        _writer = AsyncWriter(**kwargs)
+    return _writer
@@ -0,0 +1,97 @@
+#Script for scaling efficiency of data parallel offline training (train_rl with gradient all-reduce) for 1..N processes
+import argparse
+import os
+import time
+
+import torch
+from torch import distributed as dist
+from torch import multiprocessing as mp
+
+from benchmark_utils import img_shape, build_nets, random_batch, add_net_args, add_update_args
+from distributed import init_distributed, broadcast_state, cleanup
+from launch_ddp import set_env
+from offline_training import train_rl
+
+
+def worker(rank:int, world_size:int, args, results) -> None:
+    set_env(rank, world_size, master_port=args.master_port + world_size)
+    torch.set_num_threads(args.threads)
+    init_distributed()
+    torch.manual_seed(0)
+    actor_net, critic_net = build_nets(args)
+    broadcast_state(actor_net)
+    broadcast_state(critic_net)
+    actor_optimizer = torch.optim.Adam(actor_net.trained_parameters(), lr=0.001)
+    critic_optimizer = torch.optim.Adam(critic_net.parameters(), lr=0.001)
+    loss_fn = torch.nn.MSELoss(reduction='sum')
+    torch.manual_seed(rank + 1)
+    batches = [random_batch(img_shape(args.no_data), args.batch) for i in range(args.updates)]
+
+    def update(batch):
+        train_rl(batch=batch, actor_net=actor_net, critic_net=critic_net, actor_optimizer=actor_optimizer,
+                 critic_optimizer=critic_optimizer, loss_fn=loss_fn)
+
+    for i in range(args.warmup):
+        update(batches[i % len(batches)])
+    if world_size > 1:
+        dist.barrier()
+    start = time.perf_counter()
+    for batch in batches:
+        update(batch)
+    if world_size > 1:
+        dist.barrier()
+    if rank == 0:
+        results.put(len(batches) * args.batch * world_size / (time.perf_counter() - start))
+    cleanup()
+
+
+def main(args):
+    ctx = mp.get_context('spawn')
+    print(f'{args.threads} threads per process, batch {args.batch} per process')
+    print(f'{"processes":<12}{"samples/s":>12}{"speedup":>10}{"efficiency":>12}')
+    base = None
+    for world_size in range(1, args.nproc + 1):
+        results = ctx.SimpleQueue()
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size, join=True)
+        samples_per_s = results.get()
+        base = samples_per_s if base is None else base
+        print(f'{world_size:<12}{samples_per_s:>12.1f}{samples_per_s / base:>10.2f}'
+              f'{samples_per_s / (base * world_size):>12.2f}')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--nproc',
+        default=4,
+        type=int,
+        dest='nproc',
+        help='Max number of processes')
+    argparser.add_argument(
+        '--threads',
+        default=None,
+        type=int,
+        dest='threads',
+        help='Intra-op threads of every process, by default cores divided by max number of processes')
+    argparser.add_argument(
+        '--master_port',
+        default=29600,
+        type=int,
+        dest='master_port',
+        help='Base port of rank 0, shifted by number of processes')
+    add_update_args(argparser, updates=20, warmup=3, batch_help='Batch size of every process')
+    add_net_args(argparser)
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+    if args.threads is None:
+        args.threads = max(os.cpu_count() // args.nproc, 1)
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
@@ -0,0 +1,118 @@
+#Script for latency report of NNController.control in CPU inference modes
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from benchmark_utils import build_nets, add_net_args
+from control.nn_control import NNController
+from net.inference import set_threads
+
+#Configs
+from config import NUMERIC_FEATURES, IMAGE_SIZE
+
+MODES = {
+    'eager': None,
+    'frozen': {'channels_last': False, 'quantize': False},
+    'channels_last': {'channels_last': True, 'quantize': False},
+    'int8': {'channels_last': True, 'quantize': True},
+}
+
+
+def sensor_stream(length:int, seed:int=0) -> list:
+    '''
+    :return: list of (depth, segmentation) int8 frames in the layout of the sensors
+    '''
+    rng = np.random.RandomState(seed)
+    shape = (IMAGE_SIZE[1], IMAGE_SIZE[0], 3)
+    return [(rng.randint(-128, 128, shape).astype(np.int8), rng.randint(-128, 128, shape).astype(np.int8))
+            for i in range(length)]
+
+
+def measure(controller:NNController, stream:list, no_data_points:int, calls:int, warmup:int) -> (np.array, np.array):
+    '''
+    Calls controller.control on consecutive windows of the stream like the agent does every tick
+    :return: (np.array, np.array), latencies in ms and actions
+    '''
+    latencies, actions = [], []
+    for step in range(warmup + calls):
+        window = [stream[(step + i) % len(stream)] for i in range(no_data_points)]
+        state = {feature: float(np.sin(step + i)) for i, feature in enumerate(NUMERIC_FEATURES)}
+        state['depth_data'] = [depth for depth, segmentation in window]
+        state['segmentation_data'] = [segmentation for depth, segmentation in window]
+        start = time.perf_counter()
+        action = controller.control(state, agent='benchmark')
+        if step >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+            actions.append([action['steer'], action['gas_brake']])
+    return np.array(latencies), np.array(actions)
+
+
+def main(args):
+    set_threads(args.threads, args.interop_threads)
+    actor_net, critic_net = build_nets(args)
+    if args.actor_path:
+        actor_net.load_state_dict(torch.load(args.actor_path, map_location='cpu'))
+    stream = sensor_stream(length=64)
+
+    print(f'threads {torch.get_num_threads()}, interop threads {torch.get_num_interop_threads()}')
+    print(f'{"mode":<15}{"p50 ms":>10}{"p99 ms":>10}{"max |a - eager|":>18}')
+    reference = None
+    for mode, params in MODES.items():
+        controller = NNController(actor_net=actor_net, critic_net=critic_net, optimizer='adam', device='cpu',
+                                  no_data_points=args.no_data, epsilon=0.)
+        if params is not None:
+            controller.cpu_inference(**params)
+        latencies, actions = measure(controller, stream, no_data_points=args.no_data, calls=args.calls,
+                                     warmup=args.warmup)
+        reference = actions if reference is None else reference
+        print(f'{mode:<15}{np.percentile(latencies, 50):>10.3f}{np.percentile(latencies, 99):>10.3f}'
+              f'{np.abs(actions - reference).max():>18.4f}')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--threads',
+        default=None,
+        type=int,
+        dest='threads',
+        help='Number of intra-op threads, torch default if not set')
+    argparser.add_argument(
+        '--interop_threads',
+        default=None,
+        type=int,
+        dest='interop_threads',
+        help='Number of inter-op threads, torch default if not set')
+    argparser.add_argument(
+        '--calls',
+        default=500,
+        type=int,
+        dest='calls',
+        help='Number of measured control calls per mode')
+    argparser.add_argument(
+        '--warmup',
+        default=20,
+        type=int,
+        dest='warmup',
+        help='Number of control calls before measurement')
+    argparser.add_argument(
+        '--actor_path',
+        default=None,
+        type=str,
+        dest='actor_path',
+        help='Weights of the actor, random if not set')
+    add_net_args(argparser)
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
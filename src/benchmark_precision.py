@@ -0,0 +1,89 @@
+#Script for side by side comparison of float32 and bfloat16 autocast training of the actor and critic,
+#bfloat16 autocast requires torch >= 1.10
+import argparse
+import copy
+import time
+
+import torch
+
+from benchmark_utils import img_shape, build_nets, random_batch, add_net_args, add_update_args
+from net.ddpg_net import DDPGActor, DDPGCritic
+from offline_training import train_rl
+
+
+def fit(actor_net:DDPGActor, critic_net:DDPGCritic, batches:list, bf16:bool, warmup:int,
+        shared_encoder:bool) -> (float, float, float):
+    '''
+    Offline training updates of actor and critic with train_rl of offline_training
+    :return: (float, float, float), samples per second, actor and critic loss of the measured updates
+    '''
+    if shared_encoder:
+        actor_net.share_encoder(critic_net)
+    actor_optimizer = torch.optim.Adam(actor_net.trained_parameters(), lr=0.001)
+    critic_optimizer = torch.optim.Adam(critic_net.parameters(), lr=0.001)
+    loss_fn = torch.nn.MSELoss(reduction='sum')
+
+    def step(batch):
+        return train_rl(batch=batch, actor_net=actor_net, critic_net=critic_net, actor_optimizer=actor_optimizer,
+                        critic_optimizer=critic_optimizer, loss_fn=loss_fn, shared_encoder=shared_encoder, bf16=bf16)
+
+    for i in range(warmup):
+        step(batches[i % len(batches)])
+    start = time.perf_counter()
+    losses = [step(batch) for batch in batches]
+    samples_per_s = sum(len(batch['q']) for batch in batches) / (time.perf_counter() - start)
+    actor_loss = sum(float(actor_loss) for actor_loss, critic_loss in losses) / len(losses)
+    critic_loss = sum(float(critic_loss) for actor_loss, critic_loss in losses) / len(losses)
+    return samples_per_s, actor_loss, critic_loss
+
+
+def main(args):
+    device = torch.device(args.device)
+    shape = img_shape(args.no_data)
+    torch.manual_seed(0)
+    actor_net, critic_net = build_nets(args, device=device)
+    batches = [random_batch(shape, args.batch, device) for i in range(args.updates)]
+    test_batch = random_batch(shape, args.batch, device)
+
+    print(f'{"precision":<12}{"samples/s":>12}{"actor loss":>14}{"critic loss":>14}')
+    trained = {}
+    for name, bf16 in (('fp32', False), ('bf16', True)):
+        #Same init and batches for both runs, warmup updates are not measured but change the weights the same way
+        trained[name] = (copy.deepcopy(actor_net), copy.deepcopy(critic_net))
+        samples_per_s, actor_loss, critic_loss = fit(*trained[name], batches=batches, bf16=bf16, warmup=args.warmup,
+                                                     shared_encoder=args.shared_encoder)
+        print(f'{name:<12}{samples_per_s:>12.1f}{actor_loss / args.batch:>14.5f}{critic_loss / args.batch:>14.5f}')
+
+    #Evaluation in float32, only training precision differs
+    with torch.no_grad():
+        actions = {name: actor(**test_batch) for name, (actor, critic) in trained.items()}
+    print(f'Max |action fp32 - action bf16| on test batch {(actions["fp32"] - actions["bf16"]).abs().max():.4f}')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--device',
+        default='cpu',
+        type=str,
+        dest='device',
+        help='Device of the nets and batches')
+    add_update_args(argparser, updates=30, warmup=3)
+    add_net_args(argparser)
+    argparser.add_argument(
+        '--shared_encoder',
+        action='store_true',
+        dest='shared_encoder',
+        help='Benchmark shared encoder mode')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
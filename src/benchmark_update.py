@@ -0,0 +1,102 @@
+#Script for measuring DDPG updates per second of NNController against the previous update path
+import argparse
+import copy
+import time
+
+import torch
+
+from benchmark_utils import img_shape, build_nets, random_transitions, add_net_args, add_update_args
+from control.nn_control import NNController
+
+#Configs
+from config import GAMMA
+
+
+class LegacyNNController(NNController):
+    '''
+    Update path before in place target updates: targets are blended through state_dicts
+    and every result of train_on_batch is copied to host
+    '''
+    def alpha_sync(self, alpha):
+        for net, tgt_net in ((self.actor_net, self.actor_tgt_net), (self.critic_net, self.critic_tgt_net)):
+            state = net.state_dict()
+            tgt_state = tgt_net.state_dict()
+            for k, v in state.items():
+                tgt_state[k] = tgt_state[k] * alpha + (1 - alpha) * v
+            tgt_net.load_state_dict(tgt_state)
+
+    def train_on_batch(self, batch, gamma):
+        return tuple(value.cpu() for value in super(LegacyNNController, self).train_on_batch(batch, gamma))
+
+
+def benchmark(controller:NNController, batches:list, warmup:int) -> (float, float):
+    '''
+    :param controller: NNController in train mode
+    :param batches: list of batches, used in a loop
+    :param warmup: int, number of not measured updates
+    :return: (float, float), updates per second and ms per target sync
+    '''
+    for i in range(warmup):
+        controller.train_on_batch(batches[i % len(batches)], gamma=GAMMA)
+    synchronize(controller.device)
+    start = time.perf_counter()
+    for batch in batches:
+        controller.train_on_batch(batch, gamma=GAMMA)
+    synchronize(controller.device)
+    updates_per_s = len(batches) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(len(batches)):
+        controller.alpha_sync(1 - 1e-3)
+    synchronize(controller.device)
+    sync_ms = (time.perf_counter() - start) / len(batches) * 1000
+    return updates_per_s, sync_ms
+
+
+def synchronize(device:torch.device) -> None:
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    actor_net, critic_net = build_nets(args, device=device)
+    batches = [random_transitions(img_shape(args.no_data), args.batch, device) for i in range(args.updates)]
+
+    results = {}
+    for name, controller_class in (('legacy', LegacyNNController), ('fused', NNController)):
+        controller = controller_class(actor_net=copy.deepcopy(actor_net), critic_net=copy.deepcopy(critic_net),
+                                      optimizer='adam', train=True, device=device, shared_encoder=args.shared_encoder)
+        results[name] = benchmark(controller, batches, warmup=args.warmup)
+        print(f'{name}: {results[name][0]:.2f} updates/s, target sync {results[name][1]:.3f} ms')
+    print(f'Speedup {results["fused"][0] / results["legacy"][0]:.2f}x')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--device',
+        default='cuda:0' if torch.cuda.is_available() else 'cpu',
+        type=str,
+        dest='device',
+        help='Device of the nets and batches')
+    add_update_args(argparser, updates=50, warmup=5)
+    add_net_args(argparser)
+    argparser.add_argument(
+        '--shared_encoder',
+        action='store_true',
+        dest='shared_encoder',
+        help='Benchmark shared encoder mode')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
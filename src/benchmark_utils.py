@@ -0,0 +1,96 @@
+import argparse
+
+import torch
+
+from net.ddpg_net import DDPGActor, DDPGCritic
+
+#Configs
+from config import BATCH_SIZE, DATA_POINTS, IMAGE_SIZE, NUMERIC_FEATURES
+
+
+def img_shape(no_data:int) -> list:
+    '''
+    :param no_data: int, number of stacked frames
+    :return: list, (C, H, W) of stacked frames
+    '''
+    return [3, IMAGE_SIZE[1], IMAGE_SIZE[0] * no_data]
+
+
+def build_nets(args, device:torch.device=torch.device('cpu')) -> (DDPGActor, DDPGCritic):
+    '''
+    :param args: argparse.Namespace with conv, linear and no_data, see add_net_args
+    :param device: torch.device
+    :return: (DDPGActor, DDPGCritic)
+    '''
+    shape = img_shape(args.no_data)
+    cuda = torch.device(device).type == 'cuda'
+    actor_net = DDPGActor(img_shape=shape, numeric_shape=[len(NUMERIC_FEATURES)], output_shape=[2],
+                          linear_hidden=args.linear, conv_filters=args.conv, cuda=cuda)
+    critic_net = DDPGCritic(actor_out_shape=[2, ], img_shape=shape, numeric_shape=[len(NUMERIC_FEATURES)],
+                            linear_hidden=args.linear, conv_filters=args.conv, cuda=cuda)
+    return actor_net, critic_net
+
+
+def random_batch(img_shape:list, batch_size:int, device:torch.device=torch.device('cpu')) -> dict:
+    '''
+    :return: dict, batch of offline and imitation training
+    '''
+    return {'img': torch.rand(batch_size, *img_shape, device=device),
+            'x_numeric': torch.rand(batch_size, len(NUMERIC_FEATURES), device=device),
+            'action': torch.rand(batch_size, 2, device=device) * 2 - 1,
+            'q': torch.rand(batch_size, device=device)}
+
+
+def random_transitions(img_shape:list, batch_size:int, device:torch.device=torch.device('cpu')) -> dict:
+    '''
+    :return: dict, batch of state and next state like ReplayBuffer.sample
+    '''
+    def state():
+        batch = random_batch(img_shape, batch_size, device=device)
+        del batch['q']
+        batch['reward'] = torch.rand(batch_size, device=device)
+        batch['done'] = (torch.rand(batch_size, device=device) > .95).float()
+        return batch
+    return {'state': state(), 'next_state': state()}
+
+
+def add_net_args(argparser:argparse.ArgumentParser) -> None:
+    argparser.add_argument(
+        '-c', '--conv',
+        default=64,
+        type=int,
+        dest='conv',
+        help='Conv hidden size')
+    argparser.add_argument(
+        '-l', '--linear',
+        default=128,
+        type=int,
+        dest='linear',
+        help='Linear hidden size')
+    argparser.add_argument(
+        '--no_data',
+        default=DATA_POINTS,
+        type=int,
+        dest='no_data',
+        help='Number of stacked frames')
+
+
+def add_update_args(argparser:argparse.ArgumentParser, updates:int, warmup:int, batch_help:str='Batch size') -> None:
+    argparser.add_argument(
+        '--batch',
+        default=BATCH_SIZE,
+        type=int,
+        dest='batch',
+        help=batch_help)
+    argparser.add_argument(
+        '--updates',
+        default=updates,
+        type=int,
+        dest='updates',
+        help='Number of measured updates')
+    argparser.add_argument(
+        '--warmup',
+        default=warmup,
+        type=int,
+        dest='warmup',
+        help='Number of updates before measurement')
@@ -0,0 +1,141 @@
+#Script for precomputing model-ready training shards from experiments tree
+import argparse
+import json
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from config import DATE_TIME, DATA_PATH, DATA_POINTS, EXPERIMENTS_PATH, NUMERIC_FEATURES, SENSORS
+from net.utils import get_paths, episode_samples, episode_windows, normalize
+
+SHARD_KEYS = ['x_numeric', 'img', 'action', 'reward', 'q', 'done']
+FRAME_KEYS = ['x_numeric', 'frames', 'frame_start', 'action', 'reward', 'q', 'done']
+
+
+def write_shard(path:str, episodes:list, no_data_points:int=DATA_POINTS, dtype:str='uint8') -> (str, int):
+    '''
+    Builds single shard from the list of episodes, every key is saved as separate .npy file
+    :param path: str, shard directory
+    :param episodes: list of experiment folders
+    :param no_data_points: int, number of stacked frames
+    :param dtype: str, 'uint8' for (depth + segmentation) frames stored once and stacked at load time,
+    'float16' for normalized stacked frames
+    :return: (str, int), shard path and number of samples
+    '''
+    keys = FRAME_KEYS if dtype == 'uint8' else SHARD_KEYS
+    samples = {key: [] for key in keys}
+    length = 0
+    for episode in episodes:
+        if dtype == 'uint8':
+            frames, frame_start, episode_steps = episode_windows(episode, no_data_points=no_data_points,
+                                                                 features=NUMERIC_FEATURES)
+            if len(frame_start) == 0:
+                continue
+            #Windows index frames of the whole shard
+            samples['frame_start'].append(frame_start + sum(len(value) for value in samples['frames']))
+            samples['frames'].append(frames)
+            for key, value in episode_steps.items():
+                samples[key].append(value)
+            length += len(frame_start)
+            continue
+        for step, sample in episode_samples(episode, no_data_points=no_data_points, features=NUMERIC_FEATURES):
+            sample['img'] = normalize(sample['img'], dtype=np.float32).astype(np.float16)
+            for key, value in sample.items():
+                samples[key].append(value)
+            length += 1
+
+    os.makedirs(path, exist_ok=True)
+    for key, values in samples.items():
+        #uint8 shards collect arrays of whole episodes, float16 shards single samples
+        stack = np.concatenate if dtype == 'uint8' else np.stack
+        np.save(f'{path}/{key}.npy', stack(values) if values else np.zeros(0))
+    json.dump({'keys': keys, 'length': length, 'img_dtype': dtype, 'no_data_points': no_data_points,
+               'features': NUMERIC_FEATURES, 'episodes': episodes},
+              open(f'{path}/index.json', 'w'), indent=4)
+    return path, length
+
+
+def group_episodes(episodes:dict, shard_size:int) -> list:
+    '''
+    Greedily groups whole episodes into shards of at least shard_size samples
+    :param episodes: dict, path -> number of samples
+    :param shard_size: int
+    :return: list of lists of paths
+    '''
+    groups = [[]]
+    size = 0
+    for path, steps in sorted(episodes.items()):
+        if size >= shard_size:
+            groups.append([])
+            size = 0
+        groups[-1].append(path)
+        size += steps
+    return [group for group in groups if group]
+
+
+def main(args):
+    episodes = get_paths(path=args.path, sensors=SENSORS, tag=args.tag)
+    groups = group_episodes(episodes, shard_size=args.shard_size)
+    print(f'Building {len(groups)} shards from {len(episodes)} episodes in {args.out}')
+
+    fn = partial(write_shard, no_data_points=args.no_data, dtype=args.dtype)
+    with Pool(processes=args.workers) as pool:
+        results = pool.starmap(fn, [(f'{args.out}/shard_{idx:05d}', group) for idx, group in enumerate(groups)])
+    print(f'Done, {sum(length for path, length in results)} samples saved')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--path',
+        default=EXPERIMENTS_PATH,
+        dest='path',
+        help='Root of experiments tree')
+    argparser.add_argument(
+        '--out',
+        default=f'{DATA_PATH}/shards/{DATE_TIME}',
+        dest='out',
+        help='Output directory')
+    argparser.add_argument(
+        '--tag',
+        default=None,
+        dest='tag',
+        help='Filter for dataset')
+    argparser.add_argument(
+        '--no_data',
+        default=DATA_POINTS,
+        type=int,
+        dest='no_data',
+        help='Number of used datapoints')
+    argparser.add_argument(
+        '--shard_size',
+        default=20_000,
+        type=int,
+        dest='shard_size',
+        help='Approximate number of samples per shard')
+    argparser.add_argument(
+        '--dtype',
+        default='uint8',
+        choices=['uint8', 'float16'],
+        dest='dtype',
+        help='uint8 - frames stored once, stacked and normalized by the dataset, float16 - normalized stacks')
+    argparser.add_argument(
+        '--workers',
+        default=8,
+        type=int,
+        dest='workers',
+        help='Number of processes')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
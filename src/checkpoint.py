@@ -0,0 +1,153 @@
+import glob
+import os
+import random
+import re
+
+import numpy as np
+import torch
+
+from async_writer import AsyncWriter
+
+CHECKPOINT = 'checkpoint_{epoch:04d}_{batch:07d}.pt'
+CHECKPOINT_PATTERN = re.compile(r'checkpoint_(\d+)_(\d+)\.pt$')
+
+
+def to_cpu(state):
+    '''
+    Copies tensors of (nested) state dicts to host, so training can continue while the copy is written
+    :param state: dict, list, tuple or tensor
+    :return: copy with cloned CPU tensors
+    '''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def rng_state() -> dict:
+    '''
+    :return: dict, states of torch, numpy and python generators, numpy keys are stored as tensor,
+    so checkpoints load without unpickling numpy objects
+    '''
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {'torch': torch.get_rng_state(), 'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss,
+                                                      cached_gaussian), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state:dict) -> None:
+    torch.set_rng_state(state['torch'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state(args, epoch:int, batch:int, rng:dict, metrics:dict, **objects) -> dict:
+    '''
+    :param args: argparse.Namespace, arguments of the run
+    :param epoch: int, epoch to resume from
+    :param batch: int, number of already trained batches of the epoch
+    :param rng: dict, rng_state at the start of the epoch, data loader order is reproduced from it
+    :param metrics: dict, losses needed to continue logging and best model selection
+    :param objects: name -> nets, optimizers and schedulers
+    :return: dict
+    '''
+    return {'args': vars(args), 'position': {'epoch': epoch, 'batch': batch}, 'rng': rng, 'metrics': metrics,
+            **{name: obj.state_dict() for name, obj in objects.items()}}
+
+
+def restore(state:dict, **objects) -> None:
+    '''
+    :param state: dict, output of training_state
+    :param objects: name -> nets, optimizers and schedulers
+    :return: None
+    '''
+    for name, obj in objects.items():
+        obj.load_state_dict(state[name])
+
+
+class CheckpointManager:
+    def __init__(self, path:str, keep:int=3, enabled:bool=True):
+        '''
+        Writes checkpoints from a background thread. State is copied to host when saved, serialization and disk
+        writes don't block training. Files are written to a temporary file and renamed, so a run killed
+        during the write never leaves a truncated checkpoint.
+        :param path: str, directory of checkpoints
+        :param keep: int, number of kept checkpoints, older are removed, 0 keeps all
+        :param enabled: bool, if False saves are skipped, e.g. on ranks other than 0
+        '''
+        self.path = path
+        self.keep = keep
+        self.enabled = enabled
+        self.writer = AsyncWriter(workers=1, queue_size=2) if enabled else None
+        if enabled:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def write(state:dict, path:str) -> None:
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as file:
+            torch.save(state, file)
+            #Data must be on disk before the rename, else a crash can leave a renamed but empty checkpoint
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+
+    def save_weights(self, state_dict:dict, path:str) -> None:
+        '''
+        Asynchronous atomic torch.save of a single state dict, e.g. best model so far
+        :param state_dict: dict, state dict of the net
+        :param path: str, target file
+        :return: None
+        '''
+        if self.enabled:
+            self.writer.submit(self.path, self.write, to_cpu(state_dict), path)
+
+    def save(self, state:dict) -> None:
+        '''
+        :param state: dict, output of training_state
+        :return: None
+        '''
+        if self.enabled:
+            path = f'{self.path}/{CHECKPOINT.format(**state["position"])}'
+            self.writer.submit(self.path, self._write_checkpoint, to_cpu(state), path)
+
+    def _write_checkpoint(self, state:dict, path:str) -> None:
+        self.write(state, path)
+        if self.keep > 0:
+            for old in self.checkpoints(self.path)[:-self.keep]:
+                os.remove(old)
+
+    @staticmethod
+    def checkpoints(path:str) -> list:
+        '''
+        :param path: str, directory of checkpoints
+        :return: list, paths of checkpoints sorted by position, oldest first
+        '''
+        paths = [path for path in glob.glob(f'{path}/checkpoint_*.pt') if CHECKPOINT_PATTERN.search(path)]
+        return sorted(paths, key=lambda path: tuple(int(i) for i in CHECKPOINT_PATTERN.search(path).groups()))
+
+    @staticmethod
+    def load_latest(path:str) -> dict:
+        '''
+        :param path: str, directory of checkpoints
+        :return: dict, state of the latest checkpoint
+        '''
+        checkpoints = CheckpointManager.checkpoints(path)
+        assert checkpoints, f'No checkpoints in {path}'
+        print(f'Resuming from {checkpoints[-1]}')
+        return torch.load(checkpoints[-1], map_location='cpu')
+
+    def close(self) -> None:
+        '''
+        Waits for pending writes, re-raises errors of the writer thread
+        '''
+        if self.enabled:
+            self.writer.flush()
@@ -13,6 +13,11 @@ STORE_DATA = True
 DATA_PATH = '../data'
 TENSORBOARD_DATA = f'{DATA_PATH}/tensorboard'
 EXPERIMENTS_PATH = f'{DATA_PATH}/experiments'
+FRAME_CODEC = 'raw' # 'raw', 'zlib' or 'png', see frame_store.py
+IO_WORKERS = 2
+FRAME_CACHE_MB = 1024 # shared cache of decoded frames used by training datasets, 0 disables it
+IO_QUEUE_SIZE = 512
+LABELS_VERSION = None # version of relabeled reward/q/done columns used for training, see relabel.py
 
 #World and simulator config
 CARLA_IP = config_dict['carla_ip']
@@ -37,7 +42,7 @@ SENSORS = {
 }
 
 # RL config
-DEVICE = torch.device('cuda:0')
+DEVICE = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 EXTRA_REWARD = 100
 SLOW_FRAMES = 100
 # NUMERIC_FEATURES = ['state_steer', 'state_gas_brake','distance_2finish','velocity','collisions']
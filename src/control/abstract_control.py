@@ -6,6 +6,31 @@ class Controller(metaclass=ABCMeta):
     def control(self, state, **kwargs):
         pass
 
+    def control_batch(self, states:list, pts_3D:list, agents:list=None, **kwargs) -> list:
+        '''
+        Chooses actions of many agents sharing the controller, by default agent by agent
+        :param states: list of states
+        :param pts_3D: list of waypoints of the agents
+        :param agents: list of agents
+        :return: list of actions
+        '''
+        agents = agents if agents is not None else [None] * len(states)
+        return [self.control(state, pts_3D=points, agent=agent, **kwargs)
+                for state, points, agent in zip(states, pts_3D, agents)]
+
+    @property
+    def name(self) -> str:
+        '''
+        Controller tag of the experiment folders of its episodes, see environment.Agent
+        '''
+        return self.__class__.__name__
+
+    def reset(self) -> None:
+        '''
+        Drops per-agent state of the controller, called before new agents are spawned
+        '''
+        pass
+
     @staticmethod
     def _calc_closest_dists_and_location(actor_location_3D:np.array, pts_3D:np.array):
         dists = np.linalg.norm(pts_3D - actor_location_3D, axis=1)
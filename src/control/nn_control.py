@@ -1,4 +1,5 @@
 import copy
+import os
 import numpy as np
 import torch
 from torch import nn
@@ -10,12 +11,19 @@ from torchvision.transforms import transforms
 from config import NUMERIC_FEATURES
 from control.abstract_control import Controller
 from net.ddpg_net import DDPGActor, DDPGCritic
-from net.utils import img_to_pil, unpack_batch
+from net.inference import cpu_actor, copy_weights, set_threads, load_policy
+from net.utils import FrameRing, unpack_batch
 
 
 class NNController(Controller):
     def __init__(self, actor_net:DDPGActor, critic_net:DDPGCritic, optimizer:torch.optim, features:list=NUMERIC_FEATURES,
-                 no_data_points:int=4, train:bool=False, device:str='cuda:0', epsilon=0.3):
+                 no_data_points:int=4, train:bool=False, device:str='cuda:0', epsilon=0.3, shared_encoder:bool=False,
+                 hard_sync_every:int=0):
+        '''
+        :param shared_encoder: bool, in train mode actor uses the critic encoder, it's trained by the critic loss only
+        and image features are computed once per batch for critic and actor updates
+        :param hard_sync_every: int, copy weights to target nets every n updates instead of Polyak averaging, 0 disables
+        '''
         super(NNController, self).__init__()
         assert(no_data_points<=4), 'Max data points = 4'
         self.actor_net = actor_net
@@ -25,44 +33,150 @@ class NNController(Controller):
         self.transform = transforms.ToTensor()
         self.no_data_points = no_data_points
         self.epsilon = epsilon
+        self.frame_rings = {}
+        self.inference_net = None
+        self.inference_params = None
+        self.inference_refreshes = 0
+
+        if train and shared_encoder:
+            self.actor_net.share_encoder(self.critic_net)
+        self.shared_encoder = getattr(self.actor_net, 'shared_encoder', False)
+        self.policy = None
 
         if train:
             self.actor_tgt_net = copy.deepcopy(self.actor_net)
             self.critic_tgt_net = copy.deepcopy(self.critic_net)
-            self.actor_net_optimizer = Adam(params=self.actor_net.parameters(), lr=1e-3)
+            self.actor_net_optimizer = Adam(params=self.actor_net.trained_parameters(), lr=1e-3)
             self.critic_net_optimizer = Adam(params=self.critic_net.parameters(), lr=1e-3)
+            #Target nets are updated only in place by alpha_sync and hard_sync
+            for net in (self.actor_tgt_net, self.critic_tgt_net):
+                net.eval()
+                net.requires_grad_(False)
+            self.sync_sources = [*self.actor_net.parameters(), *self.actor_net.buffers(),
+                                 *self.critic_net.parameters(), *self.critic_net.buffers()]
+            self.sync_targets = [*self.actor_tgt_net.parameters(), *self.actor_tgt_net.buffers(),
+                                 *self.critic_tgt_net.parameters(), *self.critic_tgt_net.buffers()]
+            self.hard_sync_every = hard_sync_every
+            self.updates = 0
+
+    @classmethod
+    def from_policy(cls, path:str, device:str='cpu', epsilon:float=0., threads:int=None):
+        '''
+        Inference only controller driven by policy exported with export_policy.py, critic, optimizers
+        and target nets aren't created
+        :param path: str, path of the exported policy
+        :param device: str
+        :param epsilon: float, exploration noise
+        :param threads: int, number of intra-op threads, None keeps torch default
+        :return: NNController
+        '''
+        set_threads(threads)
+        policy, meta = load_policy(path, device=device)
+        controller = cls(actor_net=None, critic_net=None, optimizer=None, features=meta['numeric_features'],
+                         no_data_points=meta['no_data_points'], train=False, device=device, epsilon=epsilon)
+        controller.inference_net = policy
+        controller.policy = {**meta, 'path': path}
+        return controller
+
+    @property
+    def name(self) -> str:
+        '''
+        Episodes of exported policies are tagged with the policy name, so they aren't mistaken for training episodes
+        '''
+        if self.policy is None:
+            return self.__class__.__name__
+        #Underscores separate parts of experiment folder names, see manifest
+        policy = os.path.splitext(os.path.basename(self.policy['path']))[0].replace('_', '-')
+        return f'PolicyController-{policy}'
 
     def __str__(self):
 
-        return f'{self.__class__.__name__}_dpoints{self.no_data_points}'
+        return f'{self.name}_dpoints{self.no_data_points}'
 
     def dict(self):
-        controller = {'actor_net': self.actor_net.name,
-                      'critic_net': self.critic_net.name,
+        controller = {'actor_net': self.actor_net.name if self.policy is None else self.policy['actor_net']['name'],
+                      'critic_net': self.critic_net.name if self.critic_net is not None else None,
+                      'policy': self.policy,
                       'device': str(self.device),
+                      'inference': self.inference_params,
                       'features': self.features,
+                      'shared_encoder': self.shared_encoder,
                       'transform': repr(self.transform)}
         return controller
 
-    def preprocess(self, state:dict):
-        '''
+    def reset(self) -> None:
+        self.frame_rings = {}
 
-        :param state:
-        :return:
+    def preprocess(self, state:dict, agent=None):
         '''
-        x_numeric = torch.Tensor([state[feature] for feature in self.features]).unsqueeze(0).float().to(self.device)
-        imgs = [self.transform(img_to_pil(depth))+self.transform(img_to_pil(depth)) for depth, segmentation \
-                in zip(state['depth_data'][:self.no_data_points], state['segmentation_data'][:self.no_data_points])]
-        img = torch.cat(imgs, dim=2).unsqueeze(0).float().to(self.device)
-        img = img - img.min()
-        img = img / img.max()
+        Builds network input from the state, frames of the agent are kept in uint8 ring buffer, so only the newest frame
+        is converted every tick. Input is the same as DepthSegmentationPreprocess gives during training.
+        :param state: dict, state of the agent with depth_data and segmentation_data
+        :param agent: hashable, key of the agent's frame ring
+        :return: dict, x_numeric (1, features) and img (1, C, H, W*n)
+        '''
+        x_numeric = torch.Tensor([state[feature] for feature in self.features]).unsqueeze(0).float().to(self.input_device)
+        ring = self.frame_rings.setdefault(agent, FrameRing())
+        window = ring.update(state['depth_data'][:self.no_data_points], state['segmentation_data'][:self.no_data_points])
+        frames = torch.from_numpy(window)
+        n, height, width, channels = frames.shape
+        #Same layout as stack_windows, frames are reshaped (not transposed) to (C, H, W)
+        img = frames.reshape(n, channels, height, width).permute(1, 2, 0, 3).reshape(1, channels, height, n * width)
+        img = img.to(self.input_device).float()
+        img -= img.min()
+        img /= img.max()
 
         return {'x_numeric': x_numeric, 'img': img}
 
-    def control(self, state, **kwargs):
-        input = self.preprocess(state)
-        action = self.actor_net(**input).unsqueeze(0)
-        action = action.cpu().detach().view(-1).numpy()
+    def cpu_inference(self, threads:int=None, channels_last:bool=True, quantize:bool=False, freeze:bool=True,
+                      rebuild_every:int=1) -> None:
+        '''
+        Switches control to CPU inference copy of the actor, see net.inference.cpu_actor.
+        actor_net and training stay on the controller device, weights loaded into actor_net later
+        are picked up by refresh_inference.
+        :param threads: int, number of intra-op threads, None keeps torch default
+        :param channels_last: bool, run convolutions in NHWC layout
+        :param quantize: bool, dynamic int8 quantization of linear layers
+        :param freeze: bool, frozen TorchScript graph
+        :param rebuild_every: int, quantized or frozen copy is rebuilt every n-th refresh_inference
+        :return: None
+        '''
+        set_threads(threads)
+        self.inference_params = {'channels_last': channels_last, 'quantize': quantize, 'freeze': freeze}
+        self.inference_rebuild_every = max(rebuild_every, 1)
+        self.inference_net = None
+        self.refresh_inference()
+
+    def refresh_inference(self) -> None:
+        '''
+        Updates CPU inference copy with current weights of actor_net, no-op without cpu_inference.
+        Weights of plain copies are copied in place, quantized or frozen copies are rebuilt every
+        inference_rebuild_every calls
+        :return: None
+        '''
+        if self.inference_params is None:
+            return None
+        if self.inference_net is not None and not (self.inference_params['quantize'] or self.inference_params['freeze']):
+            copy_weights(self.inference_net, self.actor_net)
+            return None
+        self.inference_refreshes += 1
+        if self.inference_net is None or self.inference_refreshes >= self.inference_rebuild_every:
+            self.inference_net = cpu_actor(self.actor_net, **self.inference_params)
+            self.inference_refreshes = 0
+
+    @property
+    def input_device(self) -> torch.device:
+        return torch.device('cpu') if self.inference_params is not None else self.device
+
+    @property
+    def policy_net(self):
+        return self.inference_net if self.inference_net is not None else self.actor_net
+
+    def control(self, state, agent=None, **kwargs):
+        input = self.preprocess(state, agent=agent)
+        with torch.no_grad():
+            action = self.policy_net(**input).unsqueeze(0)
+        action = action.cpu().view(-1).numpy()
         action += self.epsilon * np.random.normal(size=action.shape)
         action = np.clip(action, -1, 1)
 
@@ -73,56 +187,108 @@ class NNController(Controller):
 
         return action
 
+    def control_batch(self, states:list, agents:list=None, **kwargs) -> list:
+        '''
+        Chooses actions of many agents with a single forward pass of the actor, exploration noise is drawn per agent
+        :param states: list of states
+        :param agents: list of agents, keys of the frame rings
+        :return: list of actions
+        '''
+        agents = agents if agents is not None else [None] * len(states)
+        inputs = [self.preprocess(state, agent=agent) for state, agent in zip(states, agents)]
+        input = {key: torch.cat([sample[key] for sample in inputs]) for key in inputs[0].keys()}
+        with torch.no_grad():
+            actions = self.policy_net(**input)
+        actions = actions.cpu().view(len(states), -1).numpy()
+        actions = actions + self.epsilon * np.random.normal(size=actions.shape)
+        actions = np.clip(actions, -1, 1)
+
+        return [{'steer': round(float(action[0]), 3), 'gas_brake': round(float(action[1]), 3)} for action in actions]
+
     def alpha_sync(self, alpha):
         """
             Method based on https://github.com/Shmuma/ptan/blob/master/ptan/agent.py
-            Blend params of target net with params from the model
+            Blend params of target net with params from the model, in place over flat lists of tensors
             :param alpha:
         """
         assert isinstance(alpha, float)
         assert 0.0 < alpha <= 1.0
-        actor_state = self.actor_net.state_dict()
-        tgt_state = self.actor_tgt_net.state_dict()
-        for k, v in actor_state.items():
-            tgt_state[k] = tgt_state[k] * alpha + (1 - alpha) * v
-        self.actor_tgt_net.load_state_dict(tgt_state)
-
-        critic_state = self.critic_net.state_dict()
-        tgt_state = self.critic_tgt_net.state_dict()
-        for k, v in critic_state.items():
-            tgt_state[k] = tgt_state[k] * alpha + (1 - alpha) * v
-        self.critic_tgt_net.load_state_dict(tgt_state)
+        with torch.no_grad():
+            #foreach kernels are available since torch 1.7
+            if hasattr(torch, '_foreach_mul_'):
+                torch._foreach_mul_(self.sync_targets, alpha)
+                torch._foreach_add_(self.sync_targets, self.sync_sources, alpha=1 - alpha)
+            else:
+                for target, source in zip(self.sync_targets, self.sync_sources):
+                    target.mul_(alpha).add_(source, alpha=1 - alpha)
+
+    def hard_sync(self) -> None:
+        '''
+        Copies weights of the nets to the target nets
+        :return: None
+        '''
+        with torch.no_grad():
+            for target, source in zip(self.sync_targets, self.sync_sources):
+                target.copy_(source)
 
     def train_on_batch(self, batch, gamma):
+        '''
+        Single DDPG update of critic and actor
+        :param batch: dict, sample of ReplayBuffer, optional 'weights' of PrioritizedReplayBuffer scale critic loss
+        :param gamma: float, discount factor
+        :return: actor loss, critic loss, mean q reference and per-sample absolute TD errors for priority updates,
+        all are tensors on the controller device, so reading them back is left to the caller
+        '''
         state = unpack_batch(batch['state'], device=self.device)
         next_state = unpack_batch(batch['next_state'], device=self.device)
 
-        self.critic_net_optimizer.zero_grad()
-        q_v = self.critic_net(**state)
-        last_act_v = self.actor_tgt_net(**next_state)
-
-        next_state['action'] = last_act_v
-
-        q_last_v = self.critic_tgt_net(**next_state)
+        #Targets, target actor and critic share encoder weights in shared encoder mode
+        with torch.no_grad():
+            next_features = self.critic_tgt_net.encode(next_state['img'])
+            if self.shared_encoder:
+                last_act_v = self.actor_tgt_net.head(x_numeric=next_state['x_numeric'], features=next_features)
+            else:
+                last_act_v = self.actor_tgt_net(**next_state)
+            q_last_v = self.critic_tgt_net.head(action=last_act_v, x_numeric=next_state['x_numeric'],
+                                                features=next_features)
         dones_mask = next_state['done'] > 0
         q_last_v[dones_mask] = 0.0
         q_ref_v = state['reward'].unsqueeze(dim=-1) + q_last_v * gamma
-        critic_loss_v = F.mse_loss(q_v, q_ref_v.detach())
+
+        self.critic_net_optimizer.zero_grad()
+        features = self.critic_net.encode(state['img'])
+        q_v = self.critic_net.head(action=state['action'], x_numeric=state['x_numeric'], features=features)
+        td_errors = (q_v - q_ref_v).detach()
+        if batch.get('weights') is not None:
+            weights = batch['weights'].float().to(self.device).view(-1, 1)
+            critic_loss_v = (weights * (q_v - q_ref_v) ** 2).mean()
+        else:
+            critic_loss_v = F.mse_loss(q_v, q_ref_v)
         critic_loss_v.backward()
         self.critic_net_optimizer.step()
 
-
         self.actor_net_optimizer.zero_grad()
-        batch['state']['action'] = self.actor_net(**state)
-        actor_loss_v = -self.critic_net(**state)
+        if self.shared_encoder:
+            #Features of the critic update are reused, encoder gets gradients of the critic loss only
+            features = features.detach()
+            action_v = self.actor_net.head(x_numeric=state['x_numeric'], features=features)
+            actor_loss_v = -self.critic_net.head(action=action_v, x_numeric=state['x_numeric'], features=features)
+        else:
+            action_v = self.actor_net(**state)
+            actor_loss_v = -self.critic_net(action=action_v, x_numeric=state['x_numeric'], img=state['img'])
         actor_loss_v = actor_loss_v.mean()
         actor_loss_v.backward()
         self.actor_net_optimizer.step()
 
-        self.alpha_sync(1 - 1e-3)
+        self.updates += 1
+        if not self.hard_sync_every:
+            self.alpha_sync(1 - 1e-3)
+        elif self.updates % self.hard_sync_every == 0:
+            #Targets stay frozen between hard syncs
+            self.hard_sync()
 
-        return actor_loss_v.detach().cpu().abs(), critic_loss_v.detach().cpu().abs(),\
-               q_ref_v.mean().detach().cpu()
+        return actor_loss_v.detach().abs(), critic_loss_v.detach().abs(), q_ref_v.mean().detach(), \
+               td_errors.abs().view(-1)
 
 
 # Torch multiprocessing
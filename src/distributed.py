@@ -0,0 +1,210 @@
+import copy
+import os
+
+import numpy as np
+import torch
+from torch import distributed as dist
+from torch.utils.data import DataLoader, Sampler
+
+from net.utils import ShardDataset, StreamingDataset
+
+BACKEND = 'gloo'
+
+
+def init_distributed(backend:str=BACKEND) -> (int, int):
+    '''
+    Joins the process group described by RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT env variables,
+    see launch_ddp.py. Single process runs (no WORLD_SIZE) don't create a process group.
+    :param backend: str, gloo runs collectives on CPU tensors
+    :return: (int, int), rank and world size
+    '''
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size < 2:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, rank=int(os.environ['RANK']), world_size=world_size)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def cleanup() -> None:
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+def split_episodes(episodes:dict, rank:int, world_size:int) -> dict:
+    '''
+    Assigns whole episodes to ranks, longest episodes first to the rank with the fewest samples,
+    so samples of one episode are never split between ranks and ranks get similar number of samples.
+    Assignment depends only on the episodes, so every rank computes the same split.
+    :param episodes: dict, episode (path or shard) -> number of samples
+    :param rank: int
+    :param world_size: int
+    :return: dict, episodes of the rank
+    '''
+    if len(episodes) < world_size:
+        raise ValueError(f'{len(episodes)} episodes can\'t be split between {world_size} ranks, '
+                         f'every rank needs at least one, use fewer processes')
+    samples = np.zeros(world_size, dtype=np.int64)
+    owners = {}
+    for episode in sorted(episodes, key=lambda episode: (-episodes[episode], str(episode))):
+        owner = int(samples.argmin())
+        owners[episode] = owner
+        samples[owner] += episodes[episode]
+    return {episode: length for episode, length in episodes.items() if owners[episode] == rank}
+
+
+def rank_dataset(dataset, rank:int, world_size:int):
+    '''
+    :param dataset: ShardDataset or StreamingDataset
+    :param rank: int
+    :param world_size: int
+    :return: copy of the dataset with episodes of the rank only
+    '''
+    if world_size < 2:
+        return dataset
+    dataset = copy.copy(dataset)
+    if isinstance(dataset, ShardDataset):
+        #Shards are built from whole episodes, see build_shards.py
+        if len(dataset.shards) < world_size:
+            raise ValueError(f'{len(dataset.shards)} shards can\'t be split between {world_size} ranks, every rank '
+                             f'needs at least one shard of the split, rebuild shards with smaller --shard_size '
+                             f'or use fewer processes')
+        shards = split_episodes(dict(zip(dataset.shards, dataset.lengths)), rank=rank, world_size=world_size)
+        keep = [idx for idx, shard in enumerate(dataset.shards) if shard in shards]
+        dataset.shards = [dataset.shards[idx] for idx in keep]
+        dataset.lengths = [dataset.lengths[idx] for idx in keep]
+        dataset.no_data_points = [dataset.no_data_points[idx] for idx in keep]
+    elif isinstance(dataset, StreamingDataset):
+        dataset.episodes = split_episodes(dataset.episodes, rank=rank, world_size=world_size)
+    else:
+        raise TypeError(f'{dataset.__class__.__name__} can not be split by episodes, use EpisodeSampler')
+    return dataset
+
+
+class EpisodeSampler(Sampler):
+    def __init__(self, ids:list, rank:int, world_size:int, shuffle:bool=True, seed:int=0):
+        '''
+        Sampler of map style datasets indexed by (path, step) tuples like SimpleDataset, ranks sample
+        steps of their own episodes only. Also used by single process runs, it shuffles deterministically
+        by epoch and leaves out already trained batches when resuming.
+        :param ids: list of (path, step) tuples, ids of the dataset
+        :param rank: int
+        :param world_size: int
+        :param shuffle: bool, shuffle steps of the rank every epoch
+        :param seed: int, base seed, shifted by epoch set with set_epoch
+        '''
+        episodes = {}
+        for idx, (path, step) in enumerate(ids):
+            episodes.setdefault(path, []).append(idx)
+        own = split_episodes({path: len(indexes) for path, indexes in episodes.items()}, rank=rank,
+                             world_size=world_size)
+        self.indexes = [idx for path in own for idx in episodes[path]]
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def set_epoch(self, epoch:int, skip:int=0, batch_size:int=1) -> None:
+        '''
+        :param epoch: int, shifts the seed of shuffling
+        :param skip: int, number of already trained batches of the epoch, their steps aren't sampled
+        :param batch_size: int, batch size of the DataLoader
+        '''
+        self.epoch = epoch
+        self.skip = skip * batch_size
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(self.indexes[self.skip:])
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.indexes))
+        return iter([self.indexes[idx] for idx in order[self.skip:]])
+
+
+def rank_samples(loader:DataLoader) -> int:
+    '''
+    :param loader: DataLoader of a dataset split with rank_dataset or EpisodeSampler
+    :return: int, number of samples of the rank in one epoch
+    '''
+    if isinstance(loader.sampler, EpisodeSampler):
+        return len(loader.sampler)
+    return len(loader.dataset)
+
+
+def min_batches(samples:int, batch_size:int) -> int:
+    '''
+    Ranks have to run the same number of updates, otherwise all-reduce of the rank with more batches blocks
+    :param samples: int, number of train samples of the rank
+    :param batch_size: int
+    :return: int, number of full batches of the rank with the fewest samples
+    '''
+    samples = torch.tensor([samples], dtype=torch.int64)
+    if is_distributed():
+        dist.all_reduce(samples, op=dist.ReduceOp.MIN)
+    if int(samples) < batch_size:
+        raise ValueError(f'Rank with the fewest samples has {int(samples)} train samples, less than a batch of '
+                         f'{batch_size}, use fewer processes or smaller batch')
+    return int(samples) // batch_size
+
+
+def all_reduce_gradients(parameters) -> None:
+    '''
+    Averages gradients of all ranks with one all-reduce of flattened gradients, no-op in single process runs.
+    Call after backward and before clipping and optimizer step.
+    :param parameters: iterable of parameters trained by the optimizer
+    :return: None
+    '''
+    if not is_distributed():
+        return None
+    grads = [p.grad for p in parameters if p.grad is not None]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def broadcast_state(net:torch.nn.Module) -> None:
+    '''
+    Copies parameters and buffers (batch norm statistics) of rank 0 to all ranks
+    :param net: torch.nn.Module
+    :return: None
+    '''
+    if not is_distributed():
+        return None
+    for tensor in list(net.parameters()) + list(net.buffers()):
+        dist.broadcast(tensor.data, src=0)
+
+
+def all_reduce_sum(value:torch.Tensor) -> torch.Tensor:
+    '''
+    :param value: torch.Tensor, summed over ranks, e.g. test loss of samples of the rank
+    :return: torch.Tensor, sum of all ranks
+    '''
+    value = torch.as_tensor(value, dtype=torch.float64).detach().cpu().clone()
+    if is_distributed():
+        dist.all_reduce(value)
+    return value
+
+
+class NullWriter:
+    '''
+    SummaryWriter of ranks other than 0, only rank 0 logs
+    '''
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
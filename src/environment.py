@@ -3,6 +3,7 @@ import copy
 import datetime
 import json
 import os
+import time
 try:
     import queue
 except ImportError:
@@ -14,17 +15,22 @@ import torch
 import torch.multiprocessing as mp
 
 #Local imports
-from config import IMAGE_DOWNSIZE_FACTOR, FRAMERATE, DATA_PATH, DATE_TIME, SENSORS, INVERT, DATA_POINTS
+from config import IMAGE_DOWNSIZE_FACTOR, FRAMERATE, DATA_PATH, DATE_TIME, SENSORS, INVERT, DATA_POINTS, FRAME_CODEC, \
+    IO_WORKERS, IO_QUEUE_SIZE
 from control.abstract_control import Controller
 from control.nn_control import NNController
 from spawn import sensors_config, numpy_to_transform, velocity_to_kmh, transform_to_numpy, location_to_numpy, \
     to_vehicle_control, control_to_gas_brake
 from utils import to_rgb, to_array, calc_distance, save_img, init_reporting
+from episode_log import open_writer
+from frame_store import FrameWriter
+from async_writer import AsyncWriter, get_async_writer
 
 
 class Agent:
     def __init__(self, world:carla.World, controller:Controller, vehicle:str, sensors:dict,
-                 spawn_points:np.array, spawn_point_idx:int=None, no_data_points:int=DATA_POINTS, invert:bool=False):
+                 spawn_points:np.array, spawn_point_idx:int=None, no_data_points:int=DATA_POINTS, invert:bool=False,
+                 io:AsyncWriter=None):
         '''
         All of the default data is stored in the form of numpy array,
         transforms to other formats are performed ad hoc.
@@ -35,6 +41,7 @@ class Agent:
         :param spawn_points: np.array
         :param spawn_point_idx:int,
         :param no_data_points:int,
+        :param io:AsyncWriter, background writer for frames and episode rows, process wide one by default
         '''
         self.world = world
         self.map = f'{world.get_map().name}{"_invert"*invert}'
@@ -50,9 +57,11 @@ class Agent:
         self.sensors_initialized = False
         self.no_data_points = no_data_points
         self.initial_distance = calc_distance(self.spawn_point[:3], self.waypoints)
+        self.frame_writers = {}
+        self.io = io if io is not None else get_async_writer(workers=IO_WORKERS, queue_size=IO_QUEUE_SIZE)
 
     def __str__(self) -> str:
-        return f'{self.controller.__class__.__name__}_{"_".join(self.sensors.keys())}_{self.spawn_point_idx}'
+        return f'{self.controller.name}_{"_".join(self.sensors.keys())}_{self.spawn_point_idx}'
 
     def dict(self) -> dict:
         agent = {'name': str(self),
@@ -105,18 +114,26 @@ class Agent:
         '''
         action = self.controller.control(
             state=state,
-            pts_3D=self.waypoints
+            pts_3D=self.waypoints,
+            agent=self
         )
 
         if not batch:
-            self.actor.apply_control(
-                to_vehicle_control(
-                    gas_brake=action['gas_brake'],
-                    steer=action['steer']
-                ))
+            self.apply_action(action)
 
         return action
 
+    def apply_action(self, action:dict) -> None:
+        '''
+        :param action:dict, action returned by the controller
+        :return: None
+        '''
+        self.actor.apply_control(
+            to_vehicle_control(
+                gas_brake=action['gas_brake'],
+                steer=action['steer']
+            ))
+
 
     def get_state(self, step, retrieve_data:bool=False, **kwargs):
         '''
@@ -271,10 +288,24 @@ class Agent:
         :return: None
         '''
         if save:
-            file = f'{sensor}_{step}.png'
-            save_img(img=self.sensors[sensor]['data'][-1], path=f'{self.save_path}/sensors/{file}')
+            if sensor not in self.frame_writers:
+                self.frame_writers[sensor] = FrameWriter(path=self.save_path, sensor=sensor, codec=FRAME_CODEC)
+            self.io.submit((self.save_path, sensor), self.frame_writers[sensor].write,
+                           idx=step, frame=self.sensors[sensor]['data'][-1])
         self.sensors[sensor]['data'].pop(0)
 
+    def _close_frames(self) -> None:
+        '''
+        Private method closing frame containers of the episode and waiting for all of the agent's pending writes.
+        :return: None
+        '''
+        for sensor, writer in self.frame_writers.items():
+            self.io.submit((self.save_path, sensor), writer.close)
+        for sensor in self.frame_writers.keys():
+            self.io.flush((self.save_path, sensor))
+        self.io.flush(self.save_path)
+        self.frame_writers = {}
+
 
     def destroy(self, data:bool=False, step:bool=False) -> None:
         '''
@@ -288,6 +319,7 @@ class Agent:
                     for i in range(len(self.sensors[sensor]['data'])):
                         self._release_data(sensor=sensor, step=step+i)
                 self.sensors[sensor]['actor'].destroy()
+        self._close_frames()
 
         self.actor.destroy()
 
@@ -319,12 +351,8 @@ class Agent:
         if len(self.save_path.split('/')) > 1:
             os.makedirs(name='/'.join(self.save_path.split('/')), exist_ok=True)
 
-        keys = state_keys + list(action.keys())
-        header = ','.join([f'{k}' for k in keys])
-        header = f'{header},reward,done\n'
-
-        with open(f'{self.save_path}/episode_info.csv', 'w+') as file:
-            file.write(header)
+        keys = state_keys + list(action.keys()) + ['reward', 'done']
+        open_writer(path=self.save_path, columns=keys)
 
         json.dump(self.dict(), open(f'{self.save_path}/agent_info.json', 'w+'), indent=4)
 
@@ -344,6 +372,7 @@ class Environment:
         self.client = client
         self.world = None
         self.agents = []
+        self.inference_times = []
 
 
     def reset_env(self, args:argparse.ArgumentParser) -> carla.World:
@@ -385,6 +414,7 @@ class Environment:
         :param agent_config:
         :return:
         '''
+        agent_config['controller'].reset()
         points_len = len(agent_config['spawn_points'])
         spawn_point_indexes = (np.linspace(0, points_len - (points_len/no_agents), no_agents, dtype=np.int) + \
                                np.random.randint(0, points_len)) % points_len
@@ -443,10 +473,47 @@ class Environment:
             agent.init_reporting()
 
     def get_agents_actions(self, states:list) -> list:
-        pass
+        '''
+        Chooses and applies actions of all agents. Agents sharing a controller are batched,
+        so NNController runs one forward pass per tick regardless of the number of agents.
+        :param states: list of states, ordered as self.agents
+        :return: list of actions, ordered as self.agents
+        '''
+        start = time.perf_counter()
+        actions = [None] * len(self.agents)
+        controllers = {}
+        for idx, agent in enumerate(self.agents):
+            controllers.setdefault(id(agent.controller), []).append(idx)
+        for indexes in controllers.values():
+            controller = self.agents[indexes[0]].controller
+            batch_actions = controller.control_batch(states=[states[idx] for idx in indexes],
+                                                     pts_3D=[self.agents[idx].waypoints for idx in indexes],
+                                                     agents=[self.agents[idx] for idx in indexes])
+            for idx, action in zip(indexes, batch_actions):
+                actions[idx] = action
+        self.inference_times.append(time.perf_counter() - start)
+
+        for agent, action in zip(self.agents, actions):
+            agent.apply_action(action)
 
-    def get_agents_states_actions(self, step:int, retrieve_data:bool=False) -> dict:
-        pass
+        return actions
+
+    def get_agents_states_actions(self, step:int, retrieve_data:bool=False) -> (list, list):
+        '''
+        Retrieves states of all agents and applies their batched actions
+        :param step:int, step number
+        :param retrieve_data:bool, retrieve sensors data
+        :return: (list, list), states and actions ordered as self.agents
+        '''
+        states = [agent.get_state(step, retrieve_data=retrieve_data) for agent in self.agents]
+        return states, self.get_agents_actions(states)
+
+    def inference_stats(self) -> dict:
+        '''
+        :return: dict, mean and max time of choosing actions of all agents per tick in ms
+        '''
+        times = np.array(self.inference_times) * 1000 if self.inference_times else np.zeros(1)
+        return {'inference_mean_ms': float(times.mean()), 'inference_max_ms': float(times.max())}
 
     def destroy_agents(self):
         for agent in self.agents:
@@ -0,0 +1,385 @@
+import ast
+import os
+
+import numpy as np
+import pandas as pd
+
+EPISODE_FILE = 'episode_info.npz'
+EPISODE_CSV = 'episode_info.csv'
+#Rows flushed during the episode, replaced by EPISODE_FILE when the episode is written as a whole
+EPISODE_CHUNK = 'episode_info.chunk_{chunk:05d}.npz'
+LABELS_FILE = 'labels_{version}.npz'
+
+#Vector columns are stored as 2D float arrays and exposed as `{column}_{i}` columns in DataFrames
+VECTOR_SEPARATOR = '_'
+
+_writers = {}
+
+
+class _Column:
+    def __init__(self, value, capacity:int):
+        '''
+        Typed, growable column. Type is inferred from the first value.
+        :param value: first value of the column, scalar, list or np.array
+        :param capacity: int, initial number of preallocated rows
+        '''
+        value = np.asarray(value)
+        self.width = value.shape[0] if value.ndim > 0 else None
+        if np.issubdtype(value.dtype, np.integer) or np.issubdtype(value.dtype, np.bool_):
+            self.dtype = np.int64
+        else:
+            self.dtype = np.float64
+        shape = (capacity,) if self.width is None else (capacity, self.width)
+        self.data = np.zeros(shape, dtype=self.dtype) if self.dtype is np.int64 else np.full(shape, np.nan)
+
+    def set(self, idx:int, value) -> None:
+        if idx >= self.data.shape[0]:
+            self.grow(max(idx + 1, 2 * self.data.shape[0]))
+        value = np.asarray(value)
+        if (self.dtype is np.int64) and not np.issubdtype(value.dtype, np.integer):
+            #Column started as int but received float, promote to keep values intact
+            self.data = self.data.astype(np.float64)
+            self.dtype = np.float64
+        self.data[idx] = value
+
+    def grow(self, capacity:int) -> None:
+        shape = (capacity,) if self.width is None else (capacity, self.width)
+        data = np.zeros(shape, dtype=self.dtype)
+        if self.dtype is np.float64:
+            data[...] = np.nan
+        data[:self.data.shape[0]] = self.data
+        self.data = data
+
+
+class EpisodeWriter:
+    def __init__(self, path:str, columns:list=None, chunk_size:int=500, csv:bool=True):
+        '''
+        Buffers episode rows in memory in typed columns. Every chunk of rows is appended to disk as its own file
+        (EPISODE_CHUNK), the whole episode is written to a binary columnar file (`episode_info.npz`) once on close.
+        Vector values (location, velocity_vec, *_indexes) are stored as real 2D arrays.
+        :param path: str, path to experiment folder
+        :param columns: list, optional order of columns, new columns are appended when they appear
+        :param chunk_size: int, number of rows after which buffer is written to disk, None - only on close
+        :param csv: bool, if to export legacy episode_info.csv on close
+        '''
+        self.path = path
+        self.order = list(columns) if columns else []
+        self.columns = {}
+        self.chunk_size = chunk_size
+        self.csv = csv
+        self.length = 0
+        self.flushed = 0
+        self.chunks = 0
+        self.capacity = chunk_size or 512
+
+    def __len__(self):
+        return self.length
+
+    def append(self, row:dict) -> None:
+        '''
+        Adds single row to the buffer
+        :param row: dict, column -> scalar or vector value
+        :return: None
+        '''
+        for key, value in row.items():
+            if key not in self.columns:
+                self.columns[key] = _Column(value, capacity=max(self.capacity, self.length + 1))
+                if key not in self.order:
+                    self.order.append(key)
+            self.columns[key].set(self.length, value)
+        self.length += 1
+
+        if self.chunk_size and (self.length - self.flushed) >= self.chunk_size:
+            self.flush()
+
+    def arrays(self) -> dict:
+        '''
+        :return: dict of column -> np.array trimmed to the number of written rows
+        '''
+        return {key: self.columns[key].data[:self.length] for key in self.order if key in self.columns}
+
+    def to_frame(self) -> pd.DataFrame:
+        return arrays_to_frame(self.arrays())
+
+    def flush(self) -> None:
+        '''
+        Appends rows buffered since the last flush as a new chunk file, already flushed rows aren't rewritten
+        :return: None
+        '''
+        if self.length == self.flushed:
+            return None
+        arrays = {key: value[self.flushed:] for key, value in self.arrays().items()}
+        save_arrays(path=self.path, arrays=arrays, file=EPISODE_CHUNK.format(chunk=self.chunks))
+        self.chunks += 1
+        self.flushed = self.length
+
+    def close(self, save:bool=True, csv:bool=None) -> None:
+        '''
+        Writes columnar file of the whole episode and optionally legacy csv export, chunk files are removed
+        :param save: bool, False if the caller writes the episode itself with write_episode
+        :param csv: bool, overrides csv export of the writer
+        :return: None
+        '''
+        if not save:
+            return None
+        save_arrays(path=self.path, arrays=self.arrays())
+        if self.csv if csv is None else csv:
+            export_csv(path=self.path, df=self.to_frame())
+
+
+def open_writer(path:str, columns:list=None, **kwargs) -> EpisodeWriter:
+    '''
+    Creates episode writer for the experiment folder and registers it, so save_info can find it by path
+    :param path: str, path to experiment folder
+    :param columns: list, column order
+    :return: EpisodeWriter
+    '''
+    os.makedirs(path, exist_ok=True)
+    _writers[path] = EpisodeWriter(path=path, columns=columns, **kwargs)
+    return _writers[path]
+
+
+def get_writer(path:str) -> EpisodeWriter:
+    if path not in _writers:
+        return open_writer(path)
+    return _writers[path]
+
+
+def close_writer(path:str, save:bool=True, csv:bool=None) -> None:
+    '''
+    Writes and unregisters episode writer
+    :param path: str, path to experiment folder
+    :param save: bool, False if the episode is written with write_episode right after, see EpisodeWriter.close
+    :param csv: bool, overrides csv export of the writer
+    :return: None
+    '''
+    writer = _writers.pop(path, None)
+    if writer is not None:
+        writer.close(save=save, csv=csv)
+
+
+def save_arrays(path:str, arrays:dict, file:str=EPISODE_FILE) -> None:
+    '''
+    Atomically writes arrays to npz file of the episode, writing EPISODE_FILE removes chunk files it replaces
+    :param path: str, path to experiment folder
+    :param arrays: dict, column -> np.array
+    :param file: str, name of the file
+    :return: None
+    '''
+    tmp_file = f'{path}/.{file}'
+    with open(tmp_file, 'wb') as tmp:
+        np.savez(tmp, **arrays)
+    os.replace(tmp_file, f'{path}/{file}')
+    if file == EPISODE_FILE:
+        for chunk in chunk_files(path):
+            os.remove(chunk)
+
+
+def chunk_files(path:str) -> list:
+    '''
+    :param path: str, path to experiment folder
+    :return: list, chunk files of the episode in order of rows
+    '''
+    prefix, suffix = EPISODE_CHUNK.split('{')[0], '.npz'
+    return [f'{path}/{file}' for file in sorted(os.listdir(path)) if file.startswith(prefix) and file.endswith(suffix)]
+
+
+def read_chunks(path:str, columns:list=None) -> dict:
+    '''
+    Reads rows of an episode that is still running or was interrupted before it was written as a whole
+    :param path: str, path to experiment folder
+    :param columns: list, optional subset of columns
+    :return: dict, column -> np.array, columns missing in earlier chunks are filled with nan
+    '''
+    chunks, rows = [], []
+    for chunk in chunk_files(path):
+        with np.load(chunk) as file:
+            rows.append(len(file[file.files[0]]))
+            chunks.append({key: file[key] for key in file.files if (columns is None) or (key in columns)})
+    arrays = {}
+    for chunk in chunks:
+        for key, value in chunk.items():
+            arrays.setdefault(key, value)
+    for key, first in arrays.items():
+        arrays[key] = np.concatenate([chunk[key] if key in chunk else np.full((length, *first.shape[1:]), np.nan)
+                                      for chunk, length in zip(chunks, rows)])
+    return arrays
+
+
+def arrays_to_frame(arrays:dict) -> pd.DataFrame:
+    '''
+    Converts columnar arrays to DataFrame, 2D arrays are expanded to `{column}_{i}` float columns
+    :param arrays: dict
+    :return: pd.DataFrame
+    '''
+    columns = {}
+    for key, value in arrays.items():
+        if value.ndim > 1:
+            for i in range(value.shape[1]):
+                columns[f'{key}{VECTOR_SEPARATOR}{i}'] = value[:, i]
+        else:
+            columns[key] = value
+    return pd.DataFrame(columns)
+
+
+def frame_to_arrays(df:pd.DataFrame, vectors:list=None) -> dict:
+    '''
+    Inverse of arrays_to_frame, packs `{column}_{i}` columns back into 2D arrays
+    :param df: pd.DataFrame
+    :param vectors: list of vector column names, inferred from column names if None
+    :return: dict
+    '''
+    vectors = vectors if vectors is not None else vector_columns(df.columns)
+    arrays = {}
+    for column in df.columns:
+        base = column.rsplit(VECTOR_SEPARATOR, 1)[0]
+        if base in vectors:
+            if base not in arrays:
+                arrays[base] = df[vectors[base]].values
+                if 'indexes' in base:
+                    arrays[base] = arrays[base].astype(np.int64)
+        else:
+            arrays[column] = df[column].values
+    return arrays
+
+
+def vector_columns(columns) -> dict:
+    '''
+    :param columns: iterable of DataFrame column names
+    :return: dict, vector name -> list of its expanded columns
+    '''
+    vectors = {}
+    for column in columns:
+        base, _, suffix = column.rpartition(VECTOR_SEPARATOR)
+        if base and suffix.isdigit() and ('location' in base or 'velocity_vec' in base or 'indexes' in base):
+            vectors.setdefault(base, []).append(column)
+    return vectors
+
+
+def read_episode(path:str, columns:list=None, labels:str=None) -> pd.DataFrame:
+    '''
+    Reads episode info from columnar file, falls back to legacy csv.
+    Vector columns are returned as `{column}_{i}` float columns in both cases.
+    :param path: str, path to experiment folder
+    :param columns: list, optional subset of columns, vector columns can be requested by their base name
+    :param labels: str, version of relabeled columns overriding saved ones, see write_labels
+    :return: pd.DataFrame
+    '''
+    if path in _writers and len(_writers[path]) > 0:
+        df = _writers[path].to_frame()
+    elif os.path.exists(f'{path}/{EPISODE_FILE}'):
+        with np.load(f'{path}/{EPISODE_FILE}') as file:
+            keys = [key for key in file.files if (columns is None) or (key in columns)]
+            df = arrays_to_frame({key: file[key] for key in keys})
+    elif os.path.isdir(path) and chunk_files(path):
+        df = arrays_to_frame(read_chunks(path, columns=columns))
+    else:
+        df = read_legacy_csv(path, columns=columns)
+
+    if labels and os.path.exists(f'{path}/{LABELS_FILE.format(version=labels)}'):
+        with np.load(f'{path}/{LABELS_FILE.format(version=labels)}') as file:
+            for key in file.files:
+                if (columns is None) or (key in columns):
+                    df[key] = file[key]
+
+    if columns is not None:
+        vectors = vector_columns(df.columns)
+        selected = [c for column in columns for c in vectors.get(column, [column]) if c in df.columns]
+        df = df[selected]
+    return df
+
+
+def read_columns(path:str, labels:str=None) -> list:
+    '''
+    Returns column names of the episode without loading the data
+    :param path: str, path to experiment folder
+    :param labels: str, version of relabeled columns, see write_labels
+    :return: list
+    '''
+    if os.path.exists(f'{path}/{EPISODE_FILE}'):
+        with np.load(f'{path}/{EPISODE_FILE}') as file:
+            columns = list(file.files)
+    elif chunk_files(path):
+        columns = list(read_chunks(path).keys())
+    else:
+        columns = list(pd.read_csv(f'{path}/{EPISODE_CSV}', nrows=0).columns)
+    if labels and os.path.exists(f'{path}/{LABELS_FILE.format(version=labels)}'):
+        with np.load(f'{path}/{LABELS_FILE.format(version=labels)}') as file:
+            columns += [key for key in file.files if key not in columns]
+    return columns
+
+
+def write_labels(path:str, labels:pd.DataFrame, version:str) -> None:
+    '''
+    Saves relabeled columns (reward, q, done...) as a new version next to the episode,
+    original episode file is left untouched
+    :param path: str, path to experiment folder
+    :param labels: pd.DataFrame, relabeled columns
+    :param version: str, name of the version
+    :return: None
+    '''
+    tmp_file = f'{path}/.{LABELS_FILE.format(version=version)}'
+    with open(tmp_file, 'wb') as file:
+        np.savez(file, **{column: labels[column].values for column in labels.columns})
+    os.replace(tmp_file, f'{path}/{LABELS_FILE.format(version=version)}')
+
+
+def list_episodes(path:str) -> list:
+    '''
+    Returns experiment folders containing episode info under the path
+    :param path: str, root of experiments tree
+    :return: list
+    '''
+    chunk = EPISODE_CHUNK.split('{')[0]
+    return sorted(root for root, dirs, files in os.walk(path)
+                  if (EPISODE_FILE in files or EPISODE_CSV in files or any(file.startswith(chunk) for file in files))
+                  and '.ipynb_checkpoints' not in root)
+
+
+def read_legacy_csv(path:str, columns:list=None) -> pd.DataFrame:
+    '''
+    Reads episode_info.csv with stringified python lists and expands them into float columns
+    :param path: str, path to experiment folder
+    :param columns: list, optional subset of columns
+    :return: pd.DataFrame
+    '''
+    df = pd.read_csv(f'{path}/{EPISODE_CSV}', usecols=columns)
+    for column in list(df.columns):
+        if not pd.api.types.is_numeric_dtype(df[column]) and str(df[column].iloc[0]).startswith('['):
+            values = np.array([ast.literal_eval(value) for value in df[column]], dtype=np.float64)
+            position = list(df.columns).index(column)
+            df = df.drop(columns=column)
+            for i in range(values.shape[1]):
+                df.insert(position + i, f'{column}{VECTOR_SEPARATOR}{i}', values[:, i])
+    return df
+
+
+def write_episode(path:str, df:pd.DataFrame, csv:bool=True) -> None:
+    '''
+    Writes DataFrame of the whole episode to columnar file and optionally to legacy csv, chunk files are removed
+    :param path: str, path to experiment folder
+    :param df: pd.DataFrame in the format returned by read_episode
+    :param csv: bool, if to export legacy csv as well
+    :return: None
+    '''
+    save_arrays(path=path, arrays=frame_to_arrays(df))
+    if csv:
+        export_csv(path=path, df=df)
+
+
+def export_csv(path:str, df:pd.DataFrame) -> None:
+    '''
+    Exports episode to csv in the legacy format (vectors as stringified lists)
+    :param path: str, path to experiment folder
+    :param df: pd.DataFrame in the format returned by read_episode
+    :return: None
+    '''
+    df = df.copy()
+    for base, vector in vector_columns(df.columns).items():
+        position = list(df.columns).index(vector[0])
+        values = df[vector].values
+        if 'indexes' in base:
+            values = values.astype(np.int64)
+        df = df.drop(columns=vector)
+        df.insert(position, base, [str(list(row)) for row in values.tolist()])
+    df.to_csv(f'{path}/{EPISODE_CSV}', index=False)
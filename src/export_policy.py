@@ -0,0 +1,112 @@
+#Script for exporting trained DDPGActor as standalone TorchScript policy, see NNController.from_policy
+import argparse
+import os
+import time
+
+import torch
+
+from net.ddpg_net import DDPGActor
+from net.inference import cpu_actor, save_policy, load_policy
+
+#Configs
+from config import DATA_POINTS, NUMERIC_FEATURES, IMAGE_SIZE, DATE_TIME
+
+
+def export(args) -> dict:
+    '''
+    :param args: argparse.args, config
+    :return: dict, metadata of the policy
+    '''
+    img_shape = [3, IMAGE_SIZE[1], IMAGE_SIZE[0] * args.no_data]
+    actor_net = DDPGActor(img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)], output_shape=[2],
+                          linear_hidden=args.linear, conv_filters=args.conv, cuda=False)
+    actor_net.load_state_dict(torch.load(args.actor_path, map_location='cpu'))
+    model = cpu_actor(actor_net, channels_last=args.channels_last, quantize=args.quantize, freeze=True)
+
+    meta = {'actor_net': {'name': actor_net.name, **actor_net.dict()},
+            'numeric_features': NUMERIC_FEATURES,
+            'no_data_points': args.no_data,
+            'image_size': list(IMAGE_SIZE),
+            'depth_channels': 3,
+            #Frames are depth + segmentation summed as uint8, stacked along width and min/max normalized
+            'preprocessing': 'depth_segmentation_minmax',
+            'channels_last': args.channels_last,
+            'quantized': args.quantize,
+            'source': os.path.abspath(args.actor_path),
+            'date': DATE_TIME,
+            'torch': torch.__version__}
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_policy(model, args.output, meta=meta)
+
+    #Exported policy has to give the same actions as the actor
+    policy, meta = load_policy(args.output)
+    x_numeric, img = torch.rand(8, len(NUMERIC_FEATURES)), torch.rand(8, *img_shape)
+    with torch.no_grad():
+        difference = (policy(x_numeric=x_numeric, img=img) - actor_net.eval()(x_numeric=x_numeric, img=img)).abs().max()
+    tolerance = 5e-2 if args.quantize else 1e-5
+    assert difference < tolerance, f'Exported policy differs from the actor by {difference}'
+    print(f'Max difference to the actor {float(difference):.2e}')
+    return meta
+
+
+def main(args):
+    start = time.perf_counter()
+    meta = export(args)
+    print(f'Policy {meta["actor_net"]["name"]} saved in {args.output} '
+          f'({os.path.getsize(args.output) / 2**20:.2f} MB, {time.perf_counter() - start:.1f} s)')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--actor_path',
+        required=True,
+        type=str,
+        dest='actor_path',
+        help='State dict of trained DDPGActor')
+    argparser.add_argument(
+        '--output',
+        default=f'../data/models/policies/{DATE_TIME}/policy.pt',
+        type=str,
+        dest='output',
+        help='Path of exported policy')
+    argparser.add_argument(
+        '-c', '--conv',
+        default=64,
+        type=int,
+        dest='conv',
+        help='Conv hidden size')
+    argparser.add_argument(
+        '-l', '--linear',
+        default=128,
+        type=int,
+        dest='linear',
+        help='Linear hidden size')
+    argparser.add_argument(
+        '--no_data',
+        default=DATA_POINTS,
+        type=int,
+        dest='no_data',
+        help='Number of stacked frames')
+    argparser.add_argument(
+        '--no_channels_last',
+        action='store_false',
+        dest='channels_last',
+        help='Run convolutions in default NCHW layout instead of NHWC')
+    argparser.add_argument(
+        '--quantize',
+        action='store_true',
+        dest='quantize',
+        help='Dynamic int8 quantization of linear layers')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
@@ -0,0 +1,169 @@
+import hashlib
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from config import FRAME_CACHE_MB, IMAGE_SIZE
+
+COUNTERS = ['hits', 'misses', 'evictions']
+
+
+def frame_key(path:str, sensor:str, idx:int) -> int:
+    '''
+    :param path: str, path to experiment folder
+    :param sensor: str, sensor name
+    :param idx: int, global frame index
+    :return: int, 63 bit hash of the frame
+    '''
+    digest = hashlib.blake2b(f'{path}|{sensor}|{idx}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+class SharedFrameCache:
+    def __init__(self, max_bytes:int, frame_shape:tuple, ways:int=8, locks:int=64):
+        '''
+        Bounded cache of decoded uint8 frames kept in shared memory, created before DataLoader workers start
+        so all of them see the same cache. Frames are stored in fixed size slots, number of slots is
+        max_bytes // frame size. Frames of other shapes are not cached.
+        Slots form a hash table with bounded probing: key of the frame selects a set of `ways` slots, lookups
+        and inserts only look at the slots of the set. Full sets evict with CLOCK (approximate LRU), sets are
+        guarded by striped locks, so workers only wait for each other on the same lock stripe.
+        :param max_bytes: int, memory limit of cached frames
+        :param frame_shape: tuple, (H, W, C) of cached frames
+        :param ways: int, number of slots per set, i.e. max probe length
+        :param locks: int, number of lock stripes
+        '''
+        self.frame_shape = tuple(frame_shape)
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self.ways = max(min(ways, int(max_bytes // self.frame_bytes)), 1)
+        self.sets = max(int(max_bytes // self.frame_bytes) // self.ways, 1)
+        self.slots = self.sets * self.ways
+        self.locks = [mp.Lock() for i in range(min(locks, self.sets))]
+        self._data = RawArray('B', self.slots * self.frame_bytes)
+        self._keys = RawArray('q', self.slots)
+        self._referenced = RawArray('b', self.slots)
+        self._hands = RawArray('i', self.sets)
+        self._counters = RawArray('q', len(self.locks) * len(COUNTERS))
+        self._views()
+        self.keys[:] = -1
+
+    def _views(self) -> None:
+        self.data = np.frombuffer(self._data, dtype=np.uint8).reshape(self.slots, *self.frame_shape)
+        self.keys = np.frombuffer(self._keys, dtype=np.int64)
+        self.referenced = np.frombuffer(self._referenced, dtype=np.int8)
+        self.hands = np.frombuffer(self._hands, dtype=np.int32)
+        #Counters per lock stripe, updated under the lock of the stripe
+        self.counters = np.frombuffer(self._counters, dtype=np.int64).reshape(len(self.locks), len(COUNTERS))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for view in ('data', 'keys', 'referenced', 'hands', 'counters'):
+            del state[view]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    def __len__(self):
+        return int((self.keys >= 0).sum())
+
+    def _locate(self, key:int) -> (int, int):
+        '''
+        :return: (int, int), first slot of the set of the key and its lock stripe
+        '''
+        frame_set = key % self.sets
+        return frame_set * self.ways, frame_set % len(self.locks)
+
+    def get(self, path:str, sensor:str, idx:int) -> np.array:
+        '''
+        :return: np.array copy of the cached frame or None
+        '''
+        key = frame_key(path, sensor, idx)
+        start, stripe = self._locate(key)
+        with self.locks[stripe]:
+            keys = self.keys[start:start + self.ways].tolist()
+            if key not in keys:
+                self.counters[stripe, COUNTERS.index('misses')] += 1
+                return None
+            slot = start + keys.index(key)
+            self.counters[stripe, COUNTERS.index('hits')] += 1
+            self.referenced[slot] = 1
+            return self.data[slot].copy()
+
+    def put(self, path:str, sensor:str, idx:int, frame:np.array) -> None:
+        '''
+        Caches the frame in a free slot of its set, or evicts a slot not referenced since the last
+        pass of the clock hand
+        :return: None
+        '''
+        frame = np.asarray(frame, dtype=np.uint8)
+        if frame.size != self.frame_bytes:
+            return None
+        key = frame_key(path, sensor, idx)
+        start, stripe = self._locate(key)
+        frame_set = start // self.ways
+        with self.locks[stripe]:
+            keys = self.keys[start:start + self.ways].tolist()
+            if key in keys:
+                return None
+            if -1 in keys:
+                way = keys.index(-1)
+            else:
+                way = int(self.hands[frame_set])
+                while self.referenced[start + way]:
+                    self.referenced[start + way] = 0
+                    way = (way + 1) % self.ways
+                self.hands[frame_set] = (way + 1) % self.ways
+                self.counters[stripe, COUNTERS.index('evictions')] += 1
+            slot = start + way
+            self.data[slot] = frame.reshape(self.frame_shape)
+            self.keys[slot] = key
+            self.referenced[slot] = 1
+
+    def load(self, path:str, sensor:str, indexes:list, loader) -> np.array:
+        '''
+        Returns frames under indexes, missing frames are loaded with loader(indexes) at once and cached
+        :param path: str, path to experiment folder
+        :param sensor: str, sensor name
+        :param indexes: list of global frame indexes
+        :param loader: callable, list of indexes -> (n, H, W, C) uint8
+        :return: np.array, (n, H, W, C) uint8
+        '''
+        indexes = list(indexes)
+        frames = [self.get(path, sensor, idx) for idx in indexes]
+        missing = [i for i, frame in enumerate(frames) if frame is None]
+        if missing:
+            loaded = loader([indexes[i] for i in missing])
+            for i, frame in zip(missing, loaded):
+                self.put(path, sensor, indexes[i], frame)
+                frames[i] = frame.reshape(self.frame_shape) if frame.size == self.frame_bytes else frame
+        return np.stack(frames)
+
+    def stats(self) -> dict:
+        '''
+        :return: dict, hits, misses, evictions, hit rate and cached bytes
+        '''
+        hits, misses, evictions = self.counters.sum(axis=0).tolist()
+        return {'hits': hits,
+                'misses': misses,
+                'evictions': evictions,
+                'hit_rate': hits / max(hits + misses, 1),
+                'cached_mb': len(self) * self.frame_bytes / 2**20}
+
+    def reset_stats(self) -> None:
+        for stripe, lock in enumerate(self.locks):
+            with lock:
+                self.counters[stripe] = 0
+
+
+def make_frame_cache(max_mb:int=FRAME_CACHE_MB, frame_shape:tuple=(IMAGE_SIZE[1], IMAGE_SIZE[0], 3)) -> SharedFrameCache:
+    '''
+    :param max_mb: int, memory limit in MB, 0 disables the cache
+    :param frame_shape: tuple, (H, W, C) of cached frames
+    :return: SharedFrameCache or None
+    '''
+    if not max_mb:
+        return None
+    return SharedFrameCache(max_bytes=max_mb * 2**20, frame_shape=frame_shape)
@@ -0,0 +1,262 @@
+import io
+import json
+import os
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+CODECS = ('raw', 'zlib', 'png')
+
+#Readers keep memory maps (and their file descriptors) open, only the recently used are cached
+MAX_READERS = 64
+_readers = OrderedDict()
+
+
+def frames_path(path:str, sensor:str) -> str:
+    '''
+    :param path: str, path to experiment folder
+    :param sensor: str, sensor name
+    :return: str, path of the frame container without extension
+    '''
+    return f'{path}/sensors/{sensor}'
+
+
+def encode(frame:np.array, codec:str) -> bytes:
+    if codec == 'zlib':
+        return zlib.compress(np.ascontiguousarray(frame).tobytes(), 1)
+    elif codec == 'png':
+        file = io.BytesIO()
+        frame = frame[..., 0] if (frame.ndim == 3 and frame.shape[2] == 1) else frame
+        Image.fromarray(frame).save(file, format='PNG', compress_level=1)
+        return file.getvalue()
+    return np.ascontiguousarray(frame).tobytes()
+
+
+def decode(data, codec:str, shape:tuple) -> np.array:
+    if codec == 'zlib':
+        return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(shape)
+    elif codec == 'png':
+        return np.asarray(Image.open(io.BytesIO(data))).astype(np.uint8).reshape(shape)
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+class FrameWriter:
+    def __init__(self, path:str, sensor:str, codec:str='raw', capacity:int=4096):
+        '''
+        Per-episode, per-sensor frame container. Frames are stored under their global index
+        (the one used in {sensor}_indexes columns).
+        'raw' codec keeps frames in a preallocated (N, H, W, C) uint8 file which can be memory-mapped by readers,
+        'zlib' and 'png' append encoded frames to a single data file with offsets index.
+        :param path: str, path to experiment folder
+        :param sensor: str, sensor name
+        :param codec: str, one of CODECS
+        :param capacity: int, number of preallocated frames, container grows twice when exceeded
+        '''
+        assert codec in CODECS, f'Codec has to be one of {CODECS}'
+        self.file = frames_path(path, sensor)
+        self.codec = codec
+        self.capacity = capacity
+        self.shape = None
+        self.count = 0
+        self.data = None
+        self.offsets = None
+        self.lengths = None
+        self.position = 0
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+
+    def _init(self, shape:tuple) -> None:
+        self.shape = tuple(shape) if len(shape) == 3 else (*shape, 1)
+        if self.codec == 'raw':
+            self.data = np.memmap(f'{self.file}.frames', dtype=np.uint8, mode='w+',
+                                  shape=(self.capacity, *self.shape))
+        else:
+            self.data = open(f'{self.file}.frames', 'wb')
+            self.offsets = np.zeros(self.capacity, dtype=np.int64)
+            self.lengths = np.zeros(self.capacity, dtype=np.int64)
+
+    def _grow(self, capacity:int) -> None:
+        if self.codec == 'raw':
+            self.data.flush()
+            del self.data
+            with open(f'{self.file}.frames', 'r+b') as file:
+                file.truncate(capacity * int(np.prod(self.shape)))
+            self.data = np.memmap(f'{self.file}.frames', dtype=np.uint8, mode='r+',
+                                  shape=(capacity, *self.shape))
+        else:
+            self.offsets = np.concatenate([self.offsets, np.zeros(capacity - self.capacity, dtype=np.int64)])
+            self.lengths = np.concatenate([self.lengths, np.zeros(capacity - self.capacity, dtype=np.int64)])
+        self.capacity = capacity
+
+    def write(self, idx:int, frame:np.array) -> None:
+        '''
+        Writes single frame, frames written twice under the same index are overwritten
+        :param idx: int, global frame index
+        :param frame: np.array, (H, W, C) uint8
+        :return: None
+        '''
+        frame = np.asarray(frame, dtype=np.uint8)
+        if self.shape is None:
+            self._init(frame.shape)
+        if idx >= self.capacity:
+            self._grow(max(idx + 1, 2 * self.capacity))
+
+        if self.codec == 'raw':
+            self.data[idx] = frame.reshape(self.shape)
+            self.count = max(self.count, idx + 1)
+        else:
+            self._append(idx, encode(frame, self.codec))
+
+    def write_encoded(self, idx:int, data:bytes, shape:tuple) -> None:
+        '''
+        Writes already encoded frame as is, e.g. bytes of legacy png file into 'png' container
+        :param idx: int, global frame index
+        :param data: bytes, frame encoded with the codec of the container
+        :param shape: tuple, shape of decoded frame
+        :return: None
+        '''
+        assert self.codec != 'raw', 'Encoded frames can be written only to compressed containers'
+        if self.shape is None:
+            self._init(shape)
+        if idx >= self.capacity:
+            self._grow(max(idx + 1, 2 * self.capacity))
+        self._append(idx, data)
+
+    def _append(self, idx:int, data:bytes) -> None:
+        self.offsets[idx] = self.position
+        self.lengths[idx] = len(data)
+        self.data.write(data)
+        self.position += len(data)
+        self.count = max(self.count, idx + 1)
+
+    def close(self) -> None:
+        '''
+        Trims container to the number of written frames and saves index
+        :return: None
+        '''
+        if self.shape is None:
+            return None
+        if self.codec == 'raw':
+            self.data.flush()
+            del self.data
+            with open(f'{self.file}.frames', 'r+b') as file:
+                file.truncate(self.count * int(np.prod(self.shape)))
+        else:
+            self.data.close()
+            np.save(f'{self.file}.offsets.npy', np.stack([self.offsets[:self.count], self.lengths[:self.count]]))
+        self.data = None
+        json.dump({'codec': self.codec, 'shape': list(self.shape), 'dtype': 'uint8', 'count': self.count},
+                  open(f'{self.file}.json', 'w'), indent=4)
+        reader = _readers.pop(self.file, None)
+        if reader is not None:
+            reader.close()
+
+
+class FrameReader:
+    def __init__(self, path:str, sensor:str):
+        '''
+        Read only access to frame container written by FrameWriter.
+        For 'raw' codec slices are zero-copy views of memory-mapped file.
+        :param path: str, path to experiment folder
+        :param sensor: str, sensor name
+        '''
+        self.file = frames_path(path, sensor)
+        self.stamp = index_stamp(self.file)
+        index = json.load(open(f'{self.file}.json'))
+        self.codec = index['codec']
+        self.shape = tuple(index['shape'])
+        self.count = index['count']
+        if self.count == 0:
+            self.data = np.zeros((0, *self.shape), dtype=np.uint8)
+        elif self.codec == 'raw':
+            self.data = np.memmap(f'{self.file}.frames', dtype=np.uint8, mode='r', shape=(self.count, *self.shape))
+        else:
+            self.data = np.memmap(f'{self.file}.frames', dtype=np.uint8, mode='r')
+            self.offsets, self.lengths = np.load(f'{self.file}.offsets.npy')
+
+    def __len__(self):
+        return self.count
+
+    def close(self) -> None:
+        '''
+        Closes the memory map, frames still referenced as views keep it open until they are released
+        :return: None
+        '''
+        mmap = getattr(self.data, '_mmap', None)
+        self.data = None
+        if mmap is not None:
+            try:
+                mmap.close()
+            except BufferError:
+                pass
+
+    def __getitem__(self, item):
+        if self.codec == 'raw':
+            return self.data[item]
+        if isinstance(item, slice):
+            return self.read(range(*item.indices(self.count)))
+        return decode(self.encoded(item), self.codec, self.shape)
+
+    def encoded(self, idx:int) -> bytes:
+        '''
+        :param idx: int, global frame index
+        :return: bytes, frame as stored in the container
+        '''
+        if self.codec == 'raw':
+            return self.data[idx].tobytes()
+        return bytes(self.data[self.offsets[idx]:self.offsets[idx] + self.lengths[idx]])
+
+    def read(self, indexes) -> np.array:
+        '''
+        Reads frames under given indexes, consecutive indexes are read with one contiguous read
+        :param indexes: iterable of ints
+        :return: np.array, (n, H, W, C) uint8
+        '''
+        indexes = list(indexes)
+        contiguous = len(indexes) > 0 and indexes == list(range(indexes[0], indexes[0] + len(indexes)))
+        if self.codec == 'raw':
+            if contiguous:
+                return self.data[indexes[0]:indexes[-1] + 1]
+            return self.data[indexes]
+        if contiguous:
+            start = min(self.offsets[idx] for idx in indexes)
+            end = max(self.offsets[idx] + self.lengths[idx] for idx in indexes)
+            chunk = bytes(self.data[start:end])
+            return np.stack([decode(chunk[self.offsets[idx] - start:self.offsets[idx] - start + self.lengths[idx]],
+                                    self.codec, self.shape) for idx in indexes])
+        return np.stack([self[idx] for idx in indexes])
+
+
+def index_stamp(file:str) -> tuple:
+    '''
+    :param file: str, path of the frame container without extension
+    :return: tuple, mtime and size of the index, changes when the container is rewritten
+    '''
+    stat = os.stat(f'{file}.json')
+    return stat.st_mtime_ns, stat.st_size
+
+
+def has_frames(path:str, sensor:str) -> bool:
+    return os.path.exists(f'{frames_path(path, sensor)}.json')
+
+
+def open_frames(path:str, sensor:str) -> FrameReader:
+    '''
+    Returns cached FrameReader for the sensor container of the episode. At most MAX_READERS readers are cached,
+    the least recently used is closed, readers of containers rewritten since they were opened are reopened.
+    :param path: str, path to experiment folder
+    :param sensor: str, sensor name
+    :return: FrameReader
+    '''
+    file = frames_path(path, sensor)
+    reader = _readers.pop(file, None)
+    if reader is not None and reader.stamp != index_stamp(file):
+        reader.close()
+        reader = None
+    if reader is None:
+        reader = FrameReader(path, sensor)
+    _readers[file] = reader
+    while len(_readers) > MAX_READERS:
+        _readers.popitem(last=False)[1].close()
+    return reader
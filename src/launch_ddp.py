@@ -0,0 +1,87 @@
+#Script for launching data parallel CPU training, one process per rank, e.g.
+#python launch_ddp.py --nproc 4 offline_training.py --stream -e 10
+import argparse
+import os
+import runpy
+import sys
+
+import torch
+from torch import multiprocessing as mp
+
+
+def set_env(rank:int, world_size:int, master_addr:str='127.0.0.1', master_port:int=29500) -> None:
+    '''
+    Sets env variables read by distributed.init_distributed
+    '''
+    os.environ.update({'RANK': str(rank), 'WORLD_SIZE': str(world_size),
+                       'MASTER_ADDR': master_addr, 'MASTER_PORT': str(master_port)})
+
+
+def run(rank:int, args, script_args:list) -> None:
+    set_env(rank, args.nproc, master_addr=args.master_addr, master_port=args.master_port)
+    #Ranks share the cores, without the limit every rank would start a thread per core
+    torch.set_num_threads(args.threads)
+    if rank != 0 and not args.all_output:
+        sys.stdout = open(os.devnull, 'w')
+    sys.argv = [args.script] + script_args
+    runpy.run_path(args.script, run_name='__main__')
+
+
+def main(args):
+    print(f'Starting {args.nproc} ranks of {args.script} with {args.threads} threads each')
+    mp.spawn(run, args=(args, args.script_args), nprocs=args.nproc, join=True)
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--nproc',
+        default=2,
+        type=int,
+        dest='nproc',
+        help='Number of training processes')
+    argparser.add_argument(
+        '--threads',
+        default=None,
+        type=int,
+        dest='threads',
+        help='Intra-op threads of every rank, by default cores are divided between ranks')
+    argparser.add_argument(
+        '--master_addr',
+        default='127.0.0.1',
+        type=str,
+        dest='master_addr',
+        help='Address of rank 0')
+    argparser.add_argument(
+        '--master_port',
+        default=29500,
+        type=int,
+        dest='master_port',
+        help='Port of rank 0')
+    argparser.add_argument(
+        '--all_output',
+        action='store_true',
+        dest='all_output',
+        help='Print output of all ranks, by default only rank 0 prints')
+    argparser.add_argument(
+        'script',
+        type=str,
+        help='Training script, offline_training.py or supervised_training.py')
+    argparser.add_argument(
+        'script_args',
+        nargs=argparse.REMAINDER,
+        help='Arguments of the training script')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+    if args.threads is None:
+        args.threads = max(os.cpu_count() // args.nproc, 1)
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from config import EXPERIMENTS_PATH
+from episode_log import EPISODE_FILE, EPISODE_CSV, read_episode, read_columns
+
+MANIFEST_FILE = 'manifest.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS episodes (
+    path TEXT PRIMARY KEY,
+    map TEXT,
+    invert INTEGER,
+    controller TEXT,
+    sensors TEXT,
+    max_step INTEGER,
+    length INTEGER,
+    status TEXT,
+    has_q INTEGER,
+    has_done INTEGER,
+    labels TEXT,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS episode_sensors (
+    path TEXT,
+    sensor TEXT,
+    PRIMARY KEY (path, sensor)
+);
+CREATE INDEX IF NOT EXISTS episodes_map ON episodes (map, invert);
+CREATE INDEX IF NOT EXISTS episodes_controller ON episodes (controller);
+CREATE INDEX IF NOT EXISTS episodes_has_q ON episodes (has_q);
+CREATE INDEX IF NOT EXISTS episode_sensors_sensor ON episode_sensors (sensor);
+'''
+#Columns of the episodes table, the only names accepted as query filters
+EPISODE_COLUMNS = tuple(re.findall(r'^\s+(\w+) (?:TEXT|INTEGER)', SCHEMA.split(');')[0], re.MULTILINE))
+
+
+def fingerprint(path:str) -> str:
+    '''
+    Cheap fingerprint of the episode files based on modification time and size
+    :param path: str, path to experiment folder
+    :return: str
+    '''
+    files = sorted(file for file in os.listdir(path)
+                   if file in (EPISODE_FILE, EPISODE_CSV) or (file.startswith('labels_') and file.endswith('.npz')))
+    stats = [(file, os.stat(f'{path}/{file}')) for file in files]
+    return ';'.join(f'{file}:{stat.st_mtime_ns}:{stat.st_size}' for file, stat in stats)
+
+
+def under_root(root:str) -> (str, list):
+    '''
+    SQL condition selecting paths of the root directory and below, unlike LIKE prefix it doesn't match sibling
+    directories sharing the prefix (e.g. experiments_old) and doesn't treat _ and % as wildcards
+    :param root: str, normalized root path
+    :return: (str, list), condition and its parameters
+    '''
+    prefix = root.rstrip(os.sep) + os.sep
+    return '(path = ? OR substr(path, 1, ?) = ?)', [root, len(prefix), prefix]
+
+
+def termination_status(last_row) -> str:
+    '''
+    Infers how the episode ended from its terminal row, same statuses as in runners
+    :param last_row: pd.Series
+    :return: str
+    '''
+    if last_row.get('collisions', 0) == 2500:
+        return 'Stuck'
+    elif last_row.get('collisions', 0) > 0:
+        return 'Collision'
+    elif last_row.get('distance_2finish', np.inf) < 50:
+        return 'Finished'
+    return 'Max steps exceeded'
+
+
+class EpisodeManifest:
+    def __init__(self, db_path:str=f'{EXPERIMENTS_PATH}/{MANIFEST_FILE}'):
+        '''
+        Persistent SQLite index of episodes in experiments tree, so datasets don't have to open every episode
+        to find out which ones are usable.
+        :param db_path: str, path to the sqlite file
+        '''
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def update(self, path:str, status:str=None) -> dict:
+        '''
+        Reads single episode and inserts or replaces its record
+        :param path: str, path to experiment folder
+        :param status: str, termination status if known, inferred from the terminal row otherwise
+        :return: dict, record
+        '''
+        path = os.path.normpath(path)
+        columns = read_columns(path)
+        df = read_episode(path, columns=['step', 'collisions', 'distance_2finish'])
+        map_name = path.split(os.sep)[-3]
+        name = os.path.basename(path)
+        if os.path.exists(f'{path}/agent_info.json'):
+            sensors = json.load(open(f'{path}/agent_info.json'))['sensors']
+        else:
+            sensors = [sensor for sensor in ('depth', 'rgb', 'segmentation', 'collisions') if sensor in name]
+        labels = sorted(file[len('labels_'):-len('.npz')] for file in os.listdir(path)
+                        if file.startswith('labels_') and file.endswith('.npz'))
+
+        record = {
+            'path': path,
+            'map': map_name.replace('_invert', ''),
+            'invert': int(map_name.endswith('_invert')),
+            'controller': name.split('_')[0],
+            'sensors': ','.join(sensors),
+            'max_step': int(df['step'].max()) if len(df) else 0,
+            'length': len(df),
+            'status': status or (termination_status(df.iloc[-1]) if len(df) else None),
+            'has_q': int('q' in columns),
+            'has_done': int('done' in columns),
+            'labels': ','.join(labels),
+            'fingerprint': fingerprint(path),
+        }
+        with self.connection:
+            self.connection.execute(f'INSERT OR REPLACE INTO episodes ({",".join(record.keys())}) '
+                                    f'VALUES ({",".join("?" * len(record))})', tuple(record.values()))
+            self.connection.execute('DELETE FROM episode_sensors WHERE path = ?', (path,))
+            self.connection.executemany('INSERT INTO episode_sensors (path, sensor) VALUES (?, ?)',
+                                        [(path, sensor) for sensor in sensors])
+        return record
+
+    def scan(self, root:str=EXPERIMENTS_PATH) -> int:
+        '''
+        Incrementally synchronizes manifest with the tree, only new or modified episodes are read,
+        records of removed episodes are deleted. Sensor folders aren't listed.
+        :param root: str, root of experiments tree
+        :return: int, number of updated records
+        '''
+        root = os.path.normpath(root)
+        condition, params = under_root(root)
+        known = dict(self.connection.execute(f'SELECT path, fingerprint FROM episodes WHERE {condition}',
+                                             params).fetchall())
+        found = set()
+        updated = 0
+        for directory, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if d != 'sensors' and '.ipynb_checkpoints' not in d]
+            if EPISODE_FILE not in files and EPISODE_CSV not in files:
+                continue
+            directory = os.path.normpath(directory)
+            found.add(directory)
+            if known.get(directory) != fingerprint(directory):
+                try:
+                    self.update(directory)
+                    updated += 1
+                except Exception as e:
+                    print(f'Manifest: skipping {directory}, {e}')
+
+        removed = [(path,) for path in known.keys() if path not in found]
+        with self.connection:
+            self.connection.executemany('DELETE FROM episodes WHERE path = ?', removed)
+            self.connection.executemany('DELETE FROM episode_sensors WHERE path = ?', removed)
+        return updated
+
+    def query(self, root:str=None, sensors:list=None, tag:str=None, has_q:bool=True, labels:str=None,
+              **filters) -> list:
+        '''
+        Selects episodes from manifest
+        :param root: str, only episodes under the root
+        :param sensors: list, episodes have to use all of the sensors
+        :param tag: str, substring of episode path
+        :param has_q: bool, episodes have to have q column (in saved columns or in labels version)
+        :param labels: str, labels version considered by has_q
+        :param filters: equality filters on columns, e.g. map='circut_spa', controller='MPCController'
+        :return: list of (path, max_step) tuples
+        '''
+        unknown = sorted(set(filters) - set(EPISODE_COLUMNS))
+        if unknown:
+            raise ValueError(f'Unknown episode columns {unknown}, filters have to be one of {EPISODE_COLUMNS}')
+        sql = 'SELECT path, max_step FROM episodes WHERE 1=1'
+        params = []
+        if root:
+            condition, root_params = under_root(os.path.normpath(root))
+            sql += f' AND {condition}'
+            params.extend(root_params)
+        if has_q:
+            if labels:
+                sql += " AND (has_q = 1 OR instr(',' || labels || ',', ?) > 0)"
+                params.append(f',{labels},')
+            else:
+                sql += ' AND has_q = 1'
+        if tag:
+            #Case sensitive substring match like the path filters of get_paths
+            sql += ' AND instr(path, ?) > 0'
+            params.append(tag)
+        for column, value in filters.items():
+            sql += f' AND {column} = ?'
+            params.append(value)
+        for sensor in sensors or []:
+            sql += ' AND path IN (SELECT path FROM episode_sensors WHERE sensor = ?)'
+            params.append(sensor)
+        sql += ' ORDER BY path'
+        return self.connection.execute(sql, params).fetchall()
@@ -5,6 +5,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from net.utils import norm_col_init, weights_init
 
+ENCODER_LAYERS = ['conv', 'conv2', 'conv3', 'conv4', 'conv5', 'conv6', 'linear_conv']
+
 
 class DDPG(torch.nn.Module):
     def __init__(self, img_shape, numeric_shape, linear_hidden: int = 256, conv_filters: int = 64):
@@ -36,6 +38,8 @@ class DDPG(torch.nn.Module):
         self.linear2 = nn.Linear(self.linear_conv.out_features + self.linear.out_features,
                                  int(linear_hidden / 2))
 
+        self.shared_encoder = False
+
         self.apply(weights_init)
         relu_gain = nn.init.calculate_gain('relu')
         self.conv.weight.data.mul_(relu_gain)
@@ -84,6 +88,44 @@ class DDPG(torch.nn.Module):
 
         return x
 
+    def encode(self, img: torch.Tensor) -> torch.Tensor:
+        '''
+        Image encoder, conv trunk and linear_conv
+        :param img: torch.Tensor, (N, C, H, W)
+        :return: torch.Tensor, (N, linear_hidden) image features
+        '''
+        x = F.relu(self.conv(img))
+        x = F.relu(self.conv2(x))
+        x = F.relu(self.conv3(x))
+        x = F.relu(self.conv4(x))
+        x = F.relu(self.conv5(x))
+        x = F.relu(self.conv6(x))
+
+        x = x.reshape(x.size(0), -1)
+        x = torch.tanh(self.linear_conv(x))
+
+        return x
+
+    def share_encoder(self, other) -> None:
+        '''
+        Replaces own encoder with the encoder of the other net, weights of own encoder are dropped.
+        Shared encoder is trained only by the loss of the other net, see trained_parameters.
+        :param other: DDPG
+        :return: None
+        '''
+        for layer in ENCODER_LAYERS:
+            setattr(self, layer, getattr(other, layer))
+        self.shared_encoder = True
+
+    def trained_parameters(self) -> list:
+        '''
+        :return: list, parameters optimized with the loss of this net, without the encoder if it's shared
+        '''
+        if not self.shared_encoder:
+            return list(self.parameters())
+        encoder = {id(p) for layer in ENCODER_LAYERS for p in getattr(self, layer).parameters()}
+        return [p for p in self.parameters() if id(p) not in encoder]
+
     def _get_conv_out(self, shape):
         x = torch.zeros(1, *shape)
         x = F.relu(self.conv(x))
@@ -98,7 +140,7 @@ class DDPG(torch.nn.Module):
 #TODO add dict representation
 class DDPGActor(DDPG):
     def __init__(self, img_shape, numeric_shape, output_shape,
-                 linear_hidden: int = 256, conv_filters: int = 32, cuda: bool = True):
+                 linear_hidden: int = 256, conv_filters: int = 32, cuda: bool = torch.cuda.is_available()):
         super(DDPGActor, self).__init__(img_shape=img_shape, numeric_shape=numeric_shape,
                                         linear_hidden=linear_hidden, conv_filters=conv_filters)
 
@@ -112,18 +154,16 @@ class DDPGActor(DDPG):
 
 
     def forward(self, x_numeric: torch.Tensor, img: torch.Tensor, **kwargs) -> object:
-        x_numeric = torch.tanh(self.linear(x_numeric))
-
-        x = F.relu(self.conv(img))
-        x = F.relu(self.conv2(x))
-        x = F.relu(self.conv3(x))
-        x = F.relu(self.conv4(x))
-        x = F.relu(self.conv5(x))
-        x = F.relu(self.conv6(x))
+        return self.head(x_numeric=x_numeric, features=self.encode(img))
 
-        x = x.view(x.size(0), -1)
-        x = torch.tanh(self.linear_conv(x))
-        x = torch.cat((x_numeric, x), dim=1)
+    def head(self, x_numeric: torch.Tensor, features: torch.Tensor, **kwargs) -> object:
+        '''
+        :param x_numeric: torch.Tensor, numeric features
+        :param features: torch.Tensor, output of encode
+        :return: torch.Tensor, action
+        '''
+        x_numeric = torch.tanh(self.linear(x_numeric))
+        x = torch.cat((x_numeric, features), dim=1)
         x = torch.tanh(self.linear2(x))
         x = F.hardtanh(self.actor_linear(x))
         return x
@@ -131,7 +171,7 @@ class DDPGActor(DDPG):
 
 #TODO add dict representation
 class DDPGCritic(DDPG):
-    def __init__(self, actor_out_shape, img_shape, numeric_shape, linear_hidden: int = 256, conv_filters: int = 32, cuda: bool = True):
+    def __init__(self, actor_out_shape, img_shape, numeric_shape, linear_hidden: int = 256, conv_filters: int = 32, cuda: bool = torch.cuda.is_available()):
         super(DDPGCritic, self).__init__(img_shape=img_shape, numeric_shape=numeric_shape,
                                          linear_hidden=linear_hidden, conv_filters=conv_filters)
 
@@ -149,19 +189,17 @@ class DDPGCritic(DDPG):
 
     def forward(self, action: torch.Tensor, x_numeric: torch.Tensor,
                 img: torch.Tensor, **kwargs) -> object:
+        return self.head(action=action, x_numeric=x_numeric, features=self.encode(img))
 
+    def head(self, action: torch.Tensor, x_numeric: torch.Tensor, features: torch.Tensor, **kwargs) -> object:
+        '''
+        :param action: torch.Tensor
+        :param x_numeric: torch.Tensor, numeric features
+        :param features: torch.Tensor, output of encode
+        :return: torch.Tensor, q value
+        '''
         x_numeric = torch.tanh(self.linear(x_numeric))
-
-        x = F.relu(self.conv(img))
-        x = F.relu(self.conv2(x))
-        x = F.relu(self.conv3(x))
-        x = F.relu(self.conv4(x))
-        x = F.relu(self.conv5(x))
-        x = F.relu(self.conv6(x))
-
-        x = x.view(x.size(0), -1)
-        x = torch.tanh(self.linear_conv(x))
-        x = torch.cat((x_numeric, x), dim=1)
+        x = torch.cat((x_numeric, features), dim=1)
         x = torch.tanh(self.linear2(x))
 
         action = action.view(action.size(0), -1)
@@ -0,0 +1,103 @@
+import copy
+import json
+
+import torch
+from torch import nn
+
+POLICY_META = 'policy.json'
+
+
+class ActorInference(nn.Module):
+    def __init__(self, actor_net:nn.Module, channels_last:bool=True):
+        '''
+        Inference wrapper of DDPGActor, images are converted to the memory format of the convolutions
+        :param actor_net: DDPGActor
+        :param channels_last: bool, run convolutions in channels last (NHWC) layout
+        '''
+        super(ActorInference, self).__init__()
+        self.actor_net = actor_net
+        self.channels_last = channels_last
+
+    def forward(self, x_numeric:torch.Tensor, img:torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            img = img.contiguous(memory_format=torch.channels_last)
+        return self.actor_net(x_numeric=x_numeric, img=img)
+
+
+def set_threads(threads:int=None, interop_threads:int=None) -> None:
+    '''
+    :param threads: int, number of intra-op threads, None keeps torch default
+    :param interop_threads: int, number of inter-op threads, can be set only before the first parallel work
+    :return: None
+    '''
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print(f'Inter-op threads not set, {e}')
+
+
+def cpu_actor(actor_net:nn.Module, channels_last:bool=True, quantize:bool=False, freeze:bool=True) -> nn.Module:
+    '''
+    Builds CPU inference copy of the actor: eval mode without autograd, optional channels last layout,
+    dynamic int8 quantization of linear layers and frozen TorchScript graph
+    :param actor_net: DDPGActor, not modified
+    :param channels_last: bool, run convolutions in NHWC layout
+    :param quantize: bool, quantize weights of nn.Linear layers to int8, activations are quantized dynamically
+    :param freeze: bool, trace and freeze the graph, weights become constants of the graph
+    :return: nn.Module, callable as actor_net(x_numeric=..., img=...)
+    '''
+    actor_net = copy.deepcopy(actor_net).cpu().eval()
+    actor_net.requires_grad_(False)
+    if channels_last:
+        actor_net = actor_net.to(memory_format=torch.channels_last)
+    if quantize:
+        actor_net = torch.quantization.quantize_dynamic(actor_net, {nn.Linear}, dtype=torch.qint8)
+    model = ActorInference(actor_net, channels_last=channels_last).eval()
+    if not freeze:
+        return model
+
+    example = (torch.zeros(1, actor_net.numeric_shape[0]), torch.zeros(1, *actor_net.img_shape))
+    with torch.no_grad():
+        model = torch.jit.trace(model, example)
+    #torch.jit.freeze is available since torch 1.8
+    if hasattr(torch.jit, 'freeze'):
+        model = torch.jit.freeze(model)
+    return model
+
+
+def copy_weights(model:ActorInference, actor_net:nn.Module) -> None:
+    '''
+    Copies current weights of actor_net in place into CPU copy built by cpu_actor without quantization and freezing,
+    memory format of the copy is kept
+    :param model: ActorInference, output of cpu_actor(..., quantize=False, freeze=False)
+    :param actor_net: DDPGActor the copy was built from, on any device
+    :return: None
+    '''
+    with torch.no_grad():
+        for target, source in zip(model.actor_net.state_dict().values(), actor_net.state_dict().values()):
+            target.copy_(source)
+
+
+def save_policy(model:torch.jit.ScriptModule, path:str, meta:dict) -> None:
+    '''
+    Saves TorchScript policy with its metadata (numeric features, stacked frames, preprocessing) as extra file
+    :param model: torch.jit.ScriptModule, output of cpu_actor
+    :param path: str, path of the artifact
+    :param meta: dict, json serializable metadata
+    :return: None
+    '''
+    torch.jit.save(model, path, _extra_files={POLICY_META: json.dumps(meta, indent=4)})
+
+
+def load_policy(path:str, device:str='cpu') -> (torch.jit.ScriptModule, dict):
+    '''
+    :param path: str, path of the artifact saved with save_policy
+    :param device: str, device the policy is loaded to
+    :return: (torch.jit.ScriptModule, dict), policy callable as policy(x_numeric=..., img=...) and its metadata
+    '''
+    files = {POLICY_META: ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=files)
+    return model.eval(), json.loads(files[POLICY_META])
@@ -1,7 +1,11 @@
 import ast
+import contextlib
 import copy
+import json
 import os
 import random
+import threading
+from collections import deque
 from itertools import chain, cycle, islice
 
 import torch
@@ -12,10 +16,14 @@ from torch.utils.data import Dataset, DataLoader, IterableDataset
 from torch.utils.data.dataloader import default_collate
 from torchvision import transforms
 
-from config import SENSORS, FEATURES_FOR_BATCH, DEVICE, NUMERIC_FEATURES
+from config import SENSORS, FEATURES_FOR_BATCH, DEVICE, NUMERIC_FEATURES, LABELS_VERSION
+from episode_log import read_episode, read_columns
+from frame_store import has_frames, open_frames
+from manifest import EpisodeManifest, MANIFEST_FILE
 
 to_list = lambda x: ast.literal_eval(x)
 img_to_pil = lambda img: Image.fromarray(img, 'RGB')
+identity = lambda x: x
 
 
 def norm_col_init(weights, std=1.0):
@@ -42,26 +50,26 @@ def weights_init(m, cuda:bool = True):
 
 
 def get_paths(path:str='../data/experiments', sensors:dict=SENSORS, as_tuples:bool=False,
-              shuffle:bool=False, tag:str=None) -> dict:
+              shuffle:bool=False, tag:str=None, rescan:bool=True) -> dict:
     '''
-    Method to
-    :param path:
-    :param sensors:
-    :return:
+    Returns usable episodes (with q values) from the episode manifest of the experiments tree
+    :param path: str, root of experiments tree
+    :param sensors: dict, episodes have to use all of the enabled sensors
+    :param as_tuples: bool, if to return list of (path, step) tuples instead of dict path -> number of steps
+    :param shuffle: bool, shuffle tuples
+    :param tag: str, filter for episode paths
+    :param rescan: bool, incrementally synchronize manifest with the tree before the query
+    :return: dict or list
     '''
-    sensors_config = list(filter(lambda x: len(x)>1, [sensor*value for sensor, value in sensors.items()]))
-    paths = [f'{root}/{dir}' for root, dirs, files in os.walk(path) for dir in dirs \
-             if ('sensors' not in dir) and ('.ipynb_checkpoints' not in dir)]
-    for sensor in sensors_config:
-        paths = [path for path in paths if sensor in path]
-
-    paths = [path for path in paths if 'q' in pd.read_csv(f"{path}/episode_info.csv", nrows=1).columns]
-
-    if tag:
-        paths = [path for path in paths if tag in path]
+    manifest = EpisodeManifest(f'{path}/{MANIFEST_FILE}')
+    if rescan:
+        manifest.scan(path)
+    episodes = manifest.query(root=path, sensors=[sensor for sensor, value in sensors.items() if value],
+                              tag=tag, has_q=True, labels=LABELS_VERSION)
+    manifest.close()
 
     #Were substracting one step in order not to choose terminal state
-    steps = {path:max(pd.read_csv(f'{path}/episode_info.csv', usecols=['step'])['step']) - 1 for path in paths}
+    steps = {episode:max_step - 1 for episode, max_step in episodes}
 
     if as_tuples:
         steps = [(path, step) for path, steps_q in steps.items() for step in range(steps_q)]
@@ -71,21 +79,34 @@ def get_paths(path:str='../data/experiments', sensors:dict=SENSORS, as_tuples:bo
     return steps
 
 
-def load_frames(path:str, sensor:str, indexes:list, convert=lambda x:x) -> list:
+def load_frames(path:str, sensor:str, indexes:list, convert=identity, cache=None) -> np.array:
     '''
-
-    :param path:
-    :param sensor:
-    :param indexes:
-    :return:
+    Loads frames of the sensor, from the frame container if episode has one or from legacy png files.
+    Consecutive indexes from 'raw' container are a single memory-mapped slice.
+    :param path: str, path to experiment folder
+    :param sensor: str, sensor name
+    :param indexes: list of global frame indexes
+    :param convert: conversion applied to PIL image, identity skips conversion
+    :param cache: SharedFrameCache of decoded frames, used only without conversion
+    :return: np.array, (n, H, W, C) uint8
     '''
+    if cache is not None and convert is identity:
+        return cache.load(path, sensor, indexes, loader=lambda missing: load_frames(path, sensor, missing))
+
+    if has_frames(path, sensor):
+        frames = open_frames(path, sensor).read(indexes)
+        if convert is identity:
+            return frames
+        frames = frames[..., 0] if frames.shape[-1] == 1 else frames
+        return np.stack([np.array(convert(Image.fromarray(img))).astype(np.uint8) for img in frames])
+
     frames = []
     for idx in indexes:
         img = convert(Image.open(f'{path}/sensors/{sensor}_{idx}.png'))
         img = np.array(img).astype(np.uint8)
         frames.append(img)
 
-    return frames
+    return np.stack(frames)
 
 
 def get_n_params(model):
@@ -106,10 +127,254 @@ def unpack_batch(batch, device=DEVICE):
     :return:
     '''
     for k, v in batch.items():
-        batch[k] = v.float().to(device)
+        batch[k] = v.float().to(device, non_blocking=True)
     return batch
 
 
+def autocast(enabled:bool=False, device=DEVICE):
+    '''
+    bfloat16 autocast of forward passes, weights and optimizer state stay in float32.
+    Losses should be computed outside of the context on outputs cast back to float32.
+    bfloat16 has float32 exponent range, so losses don't need scaling.
+    :param enabled: bool, no-op context if False
+    :param device: torch.device or str, device of the nets
+    :return: context manager
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    #torch.autocast with CPU support is available since torch 1.10
+    assert hasattr(torch, 'autocast'), 'bfloat16 autocast requires torch >= 1.10'
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+class GradientStats:
+    def __init__(self, net:torch.nn.Module, every:int=10, parameters:list=None):
+        '''
+        Gradient norms, max and mean of abs gradients computed on device, call update after backward.
+        Stats are computed only every n-th update and kept on device until write, so no host sync
+        happens in between. Gradients are taken before clipping, max and mean are logged as *_unclipped
+        to tell them from max_grad and mean_grad of older runs, which were taken after clipping
+        :param net: torch.nn.Module, net with name attribute used in tags
+        :param every: int, compute stats every n-th update, 0 disables stats
+        :param parameters: list, parameters of the net trained by its optimizer, net.parameters() if None
+        '''
+        self.name = net.name
+        self.every = every
+        self.updates = 0
+        named = dict(net.named_parameters())
+        ids = {id(p) for p in (net.parameters() if parameters is None else parameters)}
+        self.names = [name for name, p in named.items() if id(p) in ids]
+        self.parameters = [named[name] for name in self.names]
+        #Per layer norms are aggregated over parameters of one child module (conv, bn, linear...)
+        self.layers = list(dict.fromkeys(name.split('.')[0] for name in self.names))
+        self.layer_index = None
+        self.numel = None
+        self.pending = None
+
+    def update(self) -> None:
+        self.updates += 1
+        if not self.every or self.updates % self.every:
+            return
+        grads = [p.grad.detach() for p in self.parameters if p.grad is not None]
+        if not grads:
+            return
+        names = [name for name, p in zip(self.names, self.parameters) if p.grad is not None]
+        #foreach norm runs as one fused kernel launch per device since torch 1.13, max abs gradient is the inf norm
+        #and sum of abs gradients the 1-norm, so no copy of the gradients is made
+        if hasattr(torch, '_foreach_norm'):
+            norms = torch.stack(torch._foreach_norm(grads))
+            maxes = torch.stack(torch._foreach_norm(grads, float('inf')))
+            sums = torch.stack(torch._foreach_norm(grads, 1))
+        else:
+            norms = torch.stack([grad.norm() for grad in grads])
+            maxes = torch.stack([grad.norm(p=float('inf')) for grad in grads])
+            sums = torch.stack([grad.norm(p=1) for grad in grads])
+        if self.layer_index is None or len(self.layer_index) != len(names):
+            self.layer_index = torch.tensor([self.layers.index(name.split('.')[0]) for name in names],
+                                            device=norms.device)
+            self.numel = sum(grad.numel() for grad in grads)
+        layer_norms = torch.zeros(len(self.layers), device=norms.device, dtype=norms.dtype)
+        layer_norms = layer_norms.index_add_(0, self.layer_index, norms.pow(2)).sqrt()
+        self.pending = (norms.norm(), maxes.max(), sums.sum() / self.numel, layer_norms)
+
+    def stats(self) -> dict:
+        '''
+        :return: dict, last computed stats as floats, empty if nothing was computed since last call
+        '''
+        if self.pending is None:
+            return {}
+        values = torch.cat([torch.stack(self.pending[:3]), self.pending[3]]).tolist()
+        self.pending = None
+        stats = {'grad_norm': values[0], 'max_grad_unclipped': values[1], 'mean_grad_unclipped': values[2]}
+        stats.update({f'grad_norm/{layer}': value for layer, value in zip(self.layers, values[3:])})
+        return stats
+
+    def write(self, writer, global_step:int) -> dict:
+        '''
+        :param writer: tensorboardX.SummaryWriter
+        :param global_step: int
+        :return: dict, written stats
+        '''
+        stats = self.stats()
+        for key, value in stats.items():
+            writer.add_scalar(tag=f'{self.name}/{key}', scalar_value=value, global_step=global_step)
+        return stats
+
+
+def stack_frames(depth:np.array, segmentation:np.array, depth_channels:int=3) -> np.array:
+    '''
+    Sums depth and segmentation frames (uint8, wrapping) and concatenates them along width
+    in the layout the networks are trained on.
+    :param depth: np.array, (n, H, W, C) uint8
+    :param segmentation: np.array, (n, H, W, C) uint8
+    :param depth_channels: int
+    :return: np.array, (C, H, W*n) uint8
+    '''
+    data = depth + segmentation
+    return stack_windows(data if data.ndim == 4 else data[..., np.newaxis], depth_channels=depth_channels)
+
+
+def stack_windows(frames:np.array, depth_channels:int=3) -> np.array:
+    '''
+    Concatenates windows of already summed frames along width, every frame is reshaped (not transposed)
+    to (C, H, W) like in stack_frames. Works for a single window and for a batch of windows.
+    :param frames: np.array, (..., n, H, W, C) uint8
+    :param depth_channels: int
+    :return: np.array, (..., C, H, W*n) uint8
+    '''
+    *lead, n, height, width = frames.shape[:-1]
+    frames = frames.reshape(*lead, n, depth_channels, height, width)
+    axes = [*range(len(lead)), len(lead) + 1, len(lead) + 2, len(lead), len(lead) + 3]
+    return frames.transpose(axes).reshape(*lead, depth_channels, height, n * width)
+
+
+class FrameRing:
+    def __init__(self):
+        '''
+        Last window of summed depth + segmentation frames (uint8) of a single agent.
+        Every frame is written twice, at slot and slot + window length, so the window is always
+        a contiguous slice, oldest frame first. Only frames that weren't in the previous window are converted.
+        '''
+        self.frames = None
+        self.sources = []
+        self.pos = 0
+
+    def update(self, depth:list, segmentation:list) -> np.array:
+        '''
+        :param depth: list of depth frames of the window, (H, W, C), oldest first
+        :param segmentation: list of segmentation frames of the window
+        :return: np.array, (n, H, W, C) uint8 view of the window
+        '''
+        n = len(depth)
+        sources = list(zip(depth, segmentation))
+        shape = (2 * n, *np.shape(depth[0]))
+        if self.frames is None or self.frames.shape != shape:
+            self.frames = np.empty(shape, dtype=np.uint8)
+            self.sources = []
+            self.pos = 0
+        #Window moved by shift frames, frames are recognized by identity of the sensor arrays
+        shift = n
+        if len(self.sources) == n:
+            shift = next(shift for shift in range(n + 1) if all(d is old_d and s is old_s for (d, s), (old_d, old_s)
+                                                                in zip(sources, self.sources[shift:])))
+        for d, s in sources[n - shift:]:
+            self.frames[self.pos] = np.asarray(d, dtype=np.uint8) + np.asarray(s, dtype=np.uint8)
+            self.frames[self.pos + n] = self.frames[self.pos]
+            self.pos = (self.pos + 1) % n
+        self.sources = sources
+        return self.frames[self.pos:self.pos + n]
+
+
+def normalize(img:np.array, dtype=np.float64) -> np.array:
+    '''
+    Min/max normalization of the stacked frames
+    :param img: np.array, output of stack_frames
+    :param dtype: float dtype of the result, float32 gives the same values as float64 cast to float32
+    :return: np.array
+    '''
+    img = img.astype(dtype)
+    img = img - img.min()
+    return img / img.max()
+
+
+def iter_frames(path:str, sensor:str, length:int, chunk:int=256):
+    '''
+    Sequentially reads frames 0..length-1 of the sensor in chunks of consecutive indexes
+    :param path: str, path to experiment folder
+    :param sensor: str, sensor name
+    :param length: int, number of frames
+    :param chunk: int, number of frames read at once
+    :return: generator of (H, W, C) uint8 frames
+    '''
+    for start in range(0, length, chunk):
+        yield from load_frames(path=path, sensor=sensor, indexes=range(start, min(start + chunk, length)))
+
+
+def episode_samples(path:str, no_data_points:int=4, features:list=NUMERIC_FEATURES, depth_channels:int=3,
+                    stacked:bool=True):
+    '''
+    Generator of model-ready samples of the whole episode. Frames are read sequentially and kept
+    in a rolling window of no_data_points frames, so every frame is decoded once.
+    :param path: str, path to experiment folder
+    :param no_data_points: int, number of stacked frames
+    :param features: list, numeric features
+    :param depth_channels: int
+    :param stacked: bool, if False sample has (n, H, W, C) 'frames' window of depth + segmentation instead of 'img'
+    :return: generator of (step, sample) where sample has uint8 'img' in stack_frames layout
+    '''
+    df = read_episode(path, labels=LABELS_VERSION)
+    #Were substracting one step in order not to choose terminal state
+    steps = int(df['step'].max())
+    length = steps - 2 + no_data_points
+    x_numeric = df[features].values.astype(np.float32)
+    action = df[['steer', 'gas_brake']].values.astype(np.float32)
+    reward = df['reward'].values.astype(np.float32)
+    q = df['q'].values.astype(np.float32)
+    done = df['done'].values.astype(np.float32) if 'done' in df.columns else np.zeros(len(df), dtype=np.float32)
+
+    window = deque(maxlen=no_data_points)
+    frames = zip(iter_frames(path, 'depth', length), iter_frames(path, 'segmentation', length))
+    for idx, (depth, segmentation) in enumerate(frames):
+        frame = depth + segmentation
+        window.append(frame if frame.ndim == 3 else frame[..., np.newaxis])
+        step = idx - no_data_points + 1
+        if step < 0:
+            continue
+        sample = {'x_numeric': x_numeric[step],
+                  'action': action[step],
+                  'reward': reward[step],
+                  'q': q[step],
+                  'done': done[step]}
+        if stacked:
+            sample['img'] = stack_windows(np.stack(window), depth_channels=depth_channels)
+        else:
+            sample['frames'] = np.stack(window)
+        yield step, sample
+
+
+def episode_windows(path:str, no_data_points:int=4, features:list=NUMERIC_FEATURES) -> (np.array, np.array, dict):
+    '''
+    Frames of the whole episode stored once with the start of the frame window of every step, layout of uint8 shards
+    and sweep caches. Window of a step is frames[frame_start[step] + np.arange(no_data_points)], see stack_windows.
+    :param path: str, path to experiment folder
+    :param no_data_points: int, number of stacked frames
+    :param features: list, numeric features
+    :return: (np.array, np.array, dict), (n, H, W, C) uint8 depth + segmentation frames, frame_start of every step
+    and key -> np.array of x_numeric, action, reward, q and done of every step, empty arrays if there are no steps
+    '''
+    frames, frame_start, samples = [], [], {}
+    for step, sample in episode_samples(path, no_data_points=no_data_points, features=features, stacked=False):
+        #Consecutive windows share all but the last frame
+        window = sample.pop('frames')
+        frames.extend(window if step == 0 else window[-1:])
+        frame_start.append(len(frames) - no_data_points)
+        for key, value in sample.items():
+            samples.setdefault(key, []).append(value)
+    if not frames:
+        return np.zeros((0, 0, 0, 0), dtype=np.uint8), np.zeros(0, dtype=np.int64), {}
+    return np.stack(frames), np.array(frame_start, dtype=np.int64), {key: np.stack(value) for key, value in samples.items()}
+
+
 class ToSupervised(object):
     def __init__(self, features:list=NUMERIC_FEATURES):
         self.features = features
@@ -140,12 +405,13 @@ class ToReinforcement(object):
 
 
 class DepthSegmentationPreprocess(object):
-    def __init__(self, no_data_points:int, depth_channels:int=3):
+    def __init__(self, no_data_points:int, depth_channels:int=3, cache=None):
         assert(no_data_points<=4), 'Max datapoints = 4'
         assert (no_data_points <= 4), 'Max datapoints = 4'
         assert (isinstance(depth_channels, int)), 'depth_channels has to be int'
         self.no_data_points = no_data_points
         self.depth_channels = depth_channels
+        self.cache = cache
 
     def __call__(self, sample):
         step = sample['item'][1]
@@ -157,17 +423,10 @@ class DepthSegmentationPreprocess(object):
             del sample['data'][key]
         indexes = [idx for idx in range(step, step+self.no_data_points)]
         depth = load_frames(path=sample['item'][0], sensor='depth',
-                                              indexes=indexes)
+                                              indexes=indexes, cache=self.cache)
         segmentation = load_frames(path=sample['item'][0], sensor='segmentation',
-                            indexes=indexes)
-        data = [depth_img+seg_img for depth_img,seg_img in zip(depth, segmentation)]
-
-        data_concat = np.concatenate([img.reshape(self.depth_channels, img.shape[0], img.shape[1])
-                                      for img in data], axis=2)
-        data_concat = (data_concat - data_concat.min())
-        data_concat = data_concat / data_concat.max()
-
-        sample['data']['img'] = data_concat
+                            indexes=indexes, cache=self.cache)
+        sample['data']['img'] = normalize(stack_frames(depth, segmentation, depth_channels=self.depth_channels))
 
         return sample
 
@@ -186,11 +445,10 @@ class DepthPreprocess(object):
             self.convert = lambda x: x
 
     def __call__(self, sample):
-        step = max(to_list(sample['data']['depth_indexes']))
+        step = sample['item'][1]
         indexes = [idx for idx in range(step, step+self.no_data_points)]
         imgs = load_frames(path=sample['item'][0], sensor='depth', convert=self.convert,
                                               indexes=indexes)
-        del sample['data']['depth_indexes']
 
         imgs = np.concatenate([img.reshape(self.depth_channels, img.shape[0], img.shape[1])
                                                   for img in imgs], axis=2)
@@ -219,9 +477,8 @@ class SimpleDataset(Dataset):
         #     ids.pop(idx)
         self.ids = ids[:-(len(ids) % batch_size)] if ((len(ids) % batch_size) != 0) else ids
         self.dfs = list(set([id[0] for id in ids]))
-        self.dfs = {directory:pd.read_csv(f'{directory}/episode_info.csv') for directory in self.dfs}
-        self.features = features + list(filter(lambda x: len(x) > 1,
-                                               ['depth_indexes'*depth, 'rgb_indexes'*rgb, 'segmentation_indexes'*segmentation]))
+        self.dfs = {directory:read_episode(directory, labels=LABELS_VERSION) for directory in self.dfs}
+        self.features = features
         self.transform = transform if transform else lambda x: x
 
     def __len__(self):
@@ -235,98 +492,595 @@ class SimpleDataset(Dataset):
         return self.transform(sample)
 
 
+def transition(path:str, state:dict, action:dict, reward:float, done:float=0., features:list=NUMERIC_FEATURES,
+               no_data_points:int=4) -> dict:
+    '''
+    Converts online step of the agent to arguments of ReplayBuffer.add
+    :param path: str, path to experiment folder
+    :param state: dict, state returned by get_state(retrieve_data=True)
+    :param action: dict, action of the controller
+    :param reward: float, saved reward
+    :param done: float, 1 if the step terminates the episode
+    :param features: list, numeric features
+    :param no_data_points: int, number of stacked frames
+    :return: dict
+    '''
+    depth = np.stack([np.asarray(img, dtype=np.uint8) for img in state['depth_data'][:no_data_points]])
+    segmentation = np.stack([np.asarray(img, dtype=np.uint8) for img in state['segmentation_data'][:no_data_points]])
+    return {'path': path,
+            'step': state['step'],
+            'frames': depth + segmentation,
+            'x_numeric': np.array([state[feature] for feature in features], dtype=np.float32),
+            'action': np.array([action['steer'], action['gas_brake']], dtype=np.float32),
+            'reward': float(reward),
+            'done': float(done)}
+
+
 class ReplayBuffer:
     '''
-        TODO https://github.com/pytorch/pytorch/blob/master/torch/utils/data/_utils/collate.py
+        Ring buffer of transitions kept in preallocated numpy arrays. Every (depth + segmentation) frame
+        of an episode is stored once in a frame ring, transitions keep indexes of their no_data_points frames
+        and stacks in stack_frames layout are rebuilt at sample time. Next state of a transition
+        is the next step of the same episode.
 
         Class inspired with ptan
         https://github.com/Shmuma/ptan/blob/049ff123f5967eaeeaa268684e13e5aec5029d9f/ptan/experience.py
     '''
-    def __init__(self, capacity, features:list=FEATURES_FOR_BATCH, depth:bool=True, rgb:bool=False,
-                 segmentation:bool=True, transform:list=None, batch_size:int=32, **kwargs):
-        self.capacity = capacity
-        self.buffer = []
-        self.dfs = {}
-        self.features = features + list(filter(lambda x: len(x) > 1,
-                                               ['depth_indexes' * depth, 'rgb_indexes' * rgb,
-                                                'segmentation_indexes' * segmentation, 'done']))
-        self.transform = transform if transform else lambda x: x
-        self.pos = 0
+    def __init__(self, capacity:int, features:list=NUMERIC_FEATURES, no_data_points:int=4, depth_channels:int=3,
+                 batch_size:int=32, frame_capacity:int=None, **kwargs):
+        '''
+        :param capacity: int, number of transitions
+        :param frame_capacity: int, number of stored frames, by default slightly more than capacity
+        to cover first no_data_points - 1 frames of every episode
+        '''
+        self.capacity = int(capacity)
+        self.features = features
+        self.no_data_points = no_data_points
+        self.depth_channels = depth_channels
         self.batch_size = batch_size
-
+        self.pos = 0
+        self.size = 0
+
+        self.frame_capacity = int(frame_capacity or self.capacity * 1.1 + no_data_points)
+        self.frames = None
+        self.frame_pos = 0
+        self.frame_episode = np.full(self.frame_capacity, -1, dtype=np.int64)
+        self.frame_number = np.zeros(self.frame_capacity, dtype=np.int64)
+        self.frame_idx = np.zeros((self.capacity, no_data_points), dtype=np.int64)
+
+        self.x_numeric = np.zeros((self.capacity, len(features)), dtype=np.float32)
+        self.action = np.zeros((self.capacity, 2), dtype=np.float32)
+        self.reward = np.zeros(self.capacity, dtype=np.float32)
+        self.done = np.zeros(self.capacity, dtype=np.float32)
+        self.episode = np.full(self.capacity, -1, dtype=np.int64)
+        self.step = np.zeros(self.capacity, dtype=np.int64)
+        self.next = np.full(self.capacity, -1, dtype=np.int64)
+
+        self.episodes = {}
+        self.last = {}
+        self.episode_frames = {}
+        #Guards slots between add and sample when batches are prefetched in another thread
+        self.lock = threading.RLock()
 
     def __len__(self):
-        return len(self.buffer)
+        return self.size
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.frames, self.frame_episode, self.frame_number, self.frame_idx, self.x_numeric, self.action,
+                  self.reward, self.done, self.episode, self.step, self.next]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def _episode_id(self, path:str) -> int:
+        if path not in self.episodes:
+            self.episodes[path] = len(self.episodes)
+        return self.episodes[path]
+
+    def _add_frame(self, episode:int, number:int, frame:np.array) -> int:
+        slot = self.frame_pos
+        self.frames[slot] = frame
+        self.frame_episode[slot] = episode
+        self.frame_number[slot] = number
+        self.frame_pos = (self.frame_pos + 1) % self.frame_capacity
+        return slot
+
+    def add(self, path:str, step:int, frames:np.array, x_numeric:np.array, action:np.array, reward:float,
+            done:float=0.) -> int:
+        '''
+        Writes single transition to the next slot, overwriting the oldest one when buffer is full.
+        Frame i of the window is frame step + i of the episode, frames already stored for the episode are reused.
+        :param path: str, path to experiment folder, identifies the episode
+        :param step: int, step of the episode
+        :param frames: np.array, (n, H, W, C) uint8 window of depth + segmentation frames
+        :param x_numeric: np.array, numeric features
+        :param action: np.array, [steer, gas_brake]
+        :param reward: float
+        :param done: float, 1 if transition ends the episode
+        :return: int, slot index
+        '''
+        with self.lock:
+            return self._add(path=path, step=step, frames=frames, x_numeric=x_numeric, action=action, reward=reward,
+                             done=done)
+
+    def _add(self, path:str, step:int, frames:np.array, x_numeric:np.array, action:np.array, reward:float,
+             done:float=0.) -> int:
+        if self.frames is None:
+            self.frames = np.empty((self.frame_capacity, *frames.shape[1:]), dtype=np.uint8)
+        idx = self.pos
+        episode = self._episode_id(path)
+        stored = self.episode_frames.setdefault(episode, {})
+        for i, frame in enumerate(frames):
+            number = step + i
+            slot = stored.get(number)
+            if slot is None or self.frame_episode[slot] != episode or self.frame_number[slot] != number:
+                slot = self._add_frame(episode, number, frame)
+                stored[number] = slot
+            self.frame_idx[idx, i] = slot
+        for number in [number for number in stored.keys() if number <= step]:
+            stored.pop(number)
+        self.x_numeric[idx] = x_numeric
+        self.action[idx] = action
+        self.reward[idx] = reward
+        self.done[idx] = done
+        self.episode[idx] = episode
+        self.step[idx] = step
+        self.next[idx] = -1
+        if episode in self.last:
+            self.next[self.last[episode]] = idx
+        self.last[episode] = idx
+        if done:
+            self.last.pop(episode)
+            self.episode_frames.pop(episode)
+
+        self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return idx
+
+    def add_step(self, path:str, state:dict, action:dict, reward:float, done:float=0.) -> int:
+        '''
+        Adds online step of the agent, frames are taken from the state returned by get_state(retrieve_data=True)
+        :param path: str, path to experiment folder
+        :param state: dict, state of the agent
+        :param action: dict, action of the controller
+        :param reward: float, saved reward
+        :param done: float, 1 if the step terminates the episode
+        :return: int, slot index
+        '''
+        return self.add(**transition(path=path, state=state, action=action, reward=reward, done=done,
+                                     features=self.features, no_data_points=self.no_data_points))
+
+    def add_episode(self, path:str) -> int:
+        '''
+        Adds saved episode, frames are read sequentially with episode_samples
+        :param path: str, path to experiment folder
+        :return: int, number of added transitions
+        '''
+        added = 0
+        for step, sample in episode_samples(path, no_data_points=self.no_data_points, features=self.features,
+                                            depth_channels=self.depth_channels, stacked=False):
+            self.add(path=path, step=step, frames=sample['frames'], x_numeric=sample['x_numeric'],
+                     action=sample['action'], reward=sample['reward'], done=sample['done'])
+            added += 1
+        self.last.pop(self.episodes.get(path), None)
+        self.episode_frames.pop(self.episodes.get(path), None)
+        return added
+
+    def frames_valid(self, idx:np.array) -> np.array:
+        '''
+        :param idx: np.array of slot indexes
+        :return: np.array of bools, none of the frames of the transitions was overwritten
+        '''
+        slots = self.frame_idx[idx]
+        numbers = self.step[idx][:, np.newaxis] + np.arange(self.no_data_points)
+        return ((self.frame_episode[slots] == self.episode[idx][:, np.newaxis]) &
+                (self.frame_number[slots] == numbers)).all(axis=1)
+
+    def valid(self, idx:np.array) -> np.array:
+        '''
+        Transition can be sampled if its frames are stored and it's terminal or its next step wasn't overwritten yet
+        :param idx: np.array of slot indexes
+        :return: np.array of bools
+        '''
+        following = self.next[idx]
+        has_next = (following >= 0) & (self.episode[following] == self.episode[idx]) & \
+                   (self.step[following] == self.step[idx] + 1)
+        has_next &= self.frames_valid(np.where(has_next, following, idx))
+        return self.frames_valid(idx) & ((self.done[idx] > 0) | has_next)
+
+    def sample_indexes(self, batch_size:int=None) -> (np.array, np.array):
+        '''
+        :param batch_size: int
+        :return: (np.array, np.array), slot indexes of states and next states
+        '''
+        batch_size = batch_size or self.batch_size
+        idx = np.zeros(0, dtype=np.int64)
+        for i in range(100):
+            candidates = np.random.randint(self.size, size=batch_size)
+            idx = np.concatenate([idx, candidates[self.valid(candidates)]])[:batch_size]
+            if len(idx) == batch_size:
+                break
+        following = np.where(self.done[idx] > 0, idx, self.next[idx])
+        return idx, following
+
+    def _copy(self, idx:np.array) -> dict:
+        return {'x_numeric': self.x_numeric[idx],
+                'frames': self.frames[self.frame_idx[idx]],
+                'action': self.action[idx],
+                'reward': self.reward[idx],
+                'done': self.done[idx]}
+
+    def _to_tensors(self, arrays:dict) -> dict:
+        img = stack_windows(arrays.pop('frames'), depth_channels=self.depth_channels)
+        flat = img.reshape(len(img), -1)
+        low = flat.min(axis=1).astype(np.float32).reshape(-1, 1, 1, 1)
+        high = flat.max(axis=1).astype(np.float32).reshape(-1, 1, 1, 1)
+        img = torch.from_numpy(img).float()
+        img.sub_(torch.from_numpy(low)).div_(torch.from_numpy(high - low))
+        return {'x_numeric': torch.from_numpy(arrays['x_numeric']),
+                'img': img,
+                'action': torch.from_numpy(arrays['action']),
+                'reward': torch.from_numpy(arrays['reward']),
+                'done': torch.from_numpy(arrays['done'])}
+
+    def gather(self, idx:np.array) -> dict:
+        '''
+        :param idx: np.array of slot indexes
+        :return: dict of tensors, img normalized with min/max of every sample
+        '''
+        with self.lock:
+            arrays = self._copy(idx)
+        return self._to_tensors(arrays)
 
-    # def __iter__(self):
-    #     while True:
-    #         yield self.sample()
+    def sample(self, batch_size:int=None) -> dict:
+        '''
+        Slots are copied under the lock, stacking and normalization run without it
+        :param batch_size: int
+        :return: dict, batch of states and next states as tensors
+        '''
+        with self.lock:
+            idx, following = self.sample_indexes(batch_size)
+            state, next_state = self._copy(idx), self._copy(following)
+        state, next_state = self._to_tensors(state), self._to_tensors(next_state)
+        #done marks terminal transitions, so q of the next state is masked for them
+        next_state['done'] = state['done']
+        return {'state': state, 'next_state': next_state}
+
+
+class SumTree:
+    def __init__(self, capacity:int):
+        '''
+        Binary tree stored in array where every node is the sum of its children and leaves are priorities,
+        updates and prefix sum search take O(log n), both are vectorized over batch.
+        :param capacity: int, number of leaves
+        '''
+        self.capacity = int(capacity)
+        self.size = 1
+        while self.size < self.capacity:
+            self.size *= 2
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
 
     def __getitem__(self, idx):
-        try:
-            path, step  = self.buffer[idx]
-            state = {'item': (path, step),
-                    'data': self.dfs[path].loc[step, self.features]}
-            next_state = {'item': (path, step),
-                          'data': self.dfs[path].loc[step, self.features]}
-            state = self.transform(state)
-            next_state = self.transform(next_state)
-            sample = {'state':state,
-                      'next_state':next_state}
-
-            return sample
-        except:
-            return self[idx-1]
+        return self.tree[np.asarray(idx) + self.size]
+
+    def update(self, idx, priorities) -> None:
+        '''
+        :param idx: array of leaf indexes
+        :param priorities: array of new priorities
+        :return: None
+        '''
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1)
+        priorities = np.broadcast_to(np.asarray(priorities, dtype=np.float64).reshape(-1), idx.shape)
+        idx, last = np.unique(idx[::-1], return_index=True)
+        nodes = idx + self.size
+        self.tree[nodes] = priorities[::-1][last]
+        nodes = np.unique(nodes // 2)
+        while len(nodes) > 0 and nodes[0] > 0:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values:np.array) -> np.array:
+        '''
+        :param values: np.array of prefix sums in [0, total)
+        :return: np.array of leaf indexes
+        '''
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64).copy()
+        while nodes[0] < self.size:
+            left = 2 * nodes
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.)
+            nodes = np.where(go_right, left + 1, left)
+        return np.minimum(nodes - self.size, self.capacity - 1)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''
+        Proportional prioritized replay, https://arxiv.org/abs/1511.05952.
+        Transitions are sampled with probability p_i^alpha / sum(p^alpha) from SumTree, sample returns
+        importance sampling weights normalized by max weight in the batch and slot indexes for update_priorities.
+        Transitions without next step have zero priority until the next step is added.
+    '''
+    def __init__(self, capacity:int, alpha:float=.6, beta:float=.4, beta_steps:int=100_000, eps:float=1e-5,
+                 **kwargs):
+        super(PrioritizedReplayBuffer, self).__init__(capacity=capacity, **kwargs)
+        self.tree = SumTree(self.capacity)
+        self.alpha = alpha
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.max_priority = 1.
+        self.samples = 0
 
     @property
-    def df_paths(self):
-            return list(set([sample[0] for sample in self.buffer]))
+    def beta(self) -> float:
+        return min(1., self.beta_start + (1. - self.beta_start) * self.samples / self.beta_steps)
+
+    def _add(self, path:str, step:int, frames:np.array, x_numeric:np.array, action:np.array, reward:float,
+             done:float=0.) -> int:
+        previous = self.last.get(self.episodes.get(path))
+        idx = super(PrioritizedReplayBuffer, self)._add(path=path, step=step, frames=frames, x_numeric=x_numeric,
+                                                         action=action, reward=reward, done=done)
+        priority = self.max_priority ** self.alpha
+        self.tree.update([idx], priority if done else 0.)
+        if previous is not None and previous != idx:
+            self.tree.update([previous], priority)
+        return idx
+
+    def sample_indexes(self, batch_size:int=None) -> (np.array, np.array):
+        batch_size = batch_size or self.batch_size
+        idx = np.zeros(0, dtype=np.int64)
+        for i in range(100):
+            total = self.tree.total
+            #Stratified sampling, one sample from every of batch_size equal segments of priorities sum
+            values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * total / batch_size
+            candidates = self.tree.find(values)
+            valid = self.valid(candidates) & (candidates < self.size) & (self.tree[candidates] > 0)
+            #Next step of these transitions was overwritten, they can't be sampled anymore
+            self.tree.update(candidates[~valid], 0.)
+            idx = np.concatenate([idx, candidates[valid]])[:batch_size]
+            if len(idx) == batch_size:
+                break
+        following = np.where(self.done[idx] > 0, idx, self.next[idx])
+        return idx, following
+
+    def sample(self, batch_size:int=None) -> dict:
+        '''
+        :param batch_size: int
+        :return: dict, batch of states and next states, 'weights' tensor and 'idx' array of slots
+        '''
+        with self.lock:
+            idx, following = self.sample_indexes(batch_size)
+            state, next_state = self._copy(idx), self._copy(following)
+            probabilities = self.tree[idx] / self.tree.total
+        state, next_state = self._to_tensors(state), self._to_tensors(next_state)
+        next_state['done'] = state['done']
+
+        weights = (len(self) * probabilities) ** -self.beta
+        self.samples += 1
+        return {'state': state, 'next_state': next_state,
+                'weights': torch.from_numpy((weights / weights.max()).astype(np.float32)),
+                'idx': idx}
+
+    def update_priorities(self, idx:np.array, td_errors) -> None:
+        '''
+        :param idx: np.array, slot indexes returned by sample
+        :param td_errors: array or tensor of TD errors of the sampled transitions
+        :return: None
+        '''
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self.eps
+        with self.lock:
+            self.max_priority = max(self.max_priority, float(priorities.max()))
+            self.tree.update(idx, priorities ** self.alpha)
 
-    def add_step(self, path:str, step:pd.Series):
 
-        self._add((path, step['step'][0]))
-        if path in self.dfs.keys():
-            self.dfs[path].append(step)
-        else:
-            self.dfs[path] = step
+def worker_split(items:list, lengths:list, skip:int=0, batch_size:int=1) -> (list, int, int, int):
+    '''
+    Splits items of IterableDataset (shards, episodes) between DataLoader workers. Workers batch their own samples
+    and DataLoader takes batches from the workers in turn, exhausted workers are left out. The first skip batches
+    are left out, workers take over the split of the worker next in turn, so the remaining batches keep their order.
+    :param items: list, items in order of the epoch
+    :param lengths: list, number of samples of every item
+    :param skip: int, number of already consumed batches
+    :param batch_size: int
+    :return: (list, int, int, int), items of the worker, number of its samples to skip, index of its split
+    and number of workers
+    '''
+    worker = torch.utils.data.get_worker_info()
+    workers = worker.num_workers if worker is not None else 1
+    samples = [sum(lengths[idx::workers]) for idx in range(workers)]
+    remaining = [-(-length // batch_size) for length in samples]
+    taken = [0] * workers
+    turn = 0
+    while skip > 0 and any(remaining):
+        if remaining[turn] > 0:
+            remaining[turn] -= 1
+            taken[turn] += 1
+            skip -= 1
+        turn = (turn + 1) % workers
+    split = (turn + (worker.id if worker is not None else 0)) % workers
+    return items[split::workers], min(taken[split] * batch_size, samples[split]), split, workers
+
+
+class ShardDataset(IterableDataset):
+    def __init__(self, shards:list, shuffle:bool=True, seed:int=0):
+        '''
+        Reads precomputed shards written by build_shards.py. Every shard is read sequentially as a whole,
+        shards are split between DataLoader workers and shuffled within the shard.
+        Stacks of uint8 shards are rebuilt from frames stored once.
+        :param shards: list of shard directories
+        :param shuffle: bool, shuffle order of shards and samples within shard
+        :param seed: int, base seed, shifted by epoch set with set_epoch
+        '''
+        super(ShardDataset, self).__init__()
+        self.shards = sorted(shards)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+        self.batch_size = 1
+        indexes = [json.load(open(f'{shard}/index.json')) for shard in self.shards]
+        self.lengths = [index['length'] for index in indexes]
+        self.no_data_points = [index['no_data_points'] for index in indexes]
 
-    def _load_dfs(self, prievous=[]):
+    def __len__(self):
+        return sum(self.lengths)
+
+    def set_epoch(self, epoch:int, skip:int=0, batch_size:int=1) -> None:
         '''
-        Reloading DFs utilized by buffer
-        :param prievous:
-        :return:
+        :param epoch: int, shifts the seed of shuffling
+        :param skip: int, number of already trained batches of the epoch, e.g. when resuming from checkpoint
+        :param batch_size: int, batch size of the DataLoader
         '''
-        paths = self.df_paths
+        self.epoch = epoch
+        self.skip = skip
+        self.batch_size = batch_size
 
-        for path in prievous:
-            if path not in paths:
-                self.dfs.pop(path)
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.shards)) if self.shuffle else np.arange(len(self.shards))
+        order, skip, _, _ = worker_split(list(order), [self.lengths[idx] for idx in order], skip=self.skip,
+                                         batch_size=self.batch_size)
+
+        for shard_idx in order:
+            length = self.lengths[shard_idx]
+            if skip >= length:
+                #Already trained shard isn't read, its permutation is drawn to keep shuffling of the next shards
+                if self.shuffle:
+                    rng.permutation(length)
+                skip -= length
+                continue
+            shard = read_shard(self.shards[shard_idx])
+            frames, frame_start = shard.pop('frames', None), shard.pop('frame_start', None)
+            window = np.arange(self.no_data_points[shard_idx])
+            samples = rng.permutation(length) if self.shuffle else np.arange(length)
+            samples, skip = samples[skip:], 0
+            for idx in samples:
+                sample = {key: value[idx] for key, value in shard.items()}
+                if frames is not None:
+                    sample['img'] = stack_windows(frames[frame_start[idx] + window])
+                if sample['img'].dtype == np.uint8:
+                    sample['img'] = normalize(sample['img'], dtype=np.float32)
+                yield sample
+
+
+class StreamingDataset(IterableDataset):
+    def __init__(self, episodes:dict, no_data_points:int=4, features:list=NUMERIC_FEATURES, shuffle:bool=True,
+                 shuffle_buffer_mb:int=128, seed:int=0):
+        '''
+        Streams whole episodes with episode_samples, so frames are read sequentially and decoded once.
+        Episodes are split between DataLoader workers, samples are shuffled with a shuffle buffer.
+        Buffer keeps uint8 stacks, images are normalized when the sample leaves the buffer.
+        :param episodes: dict, path -> number of steps, as returned by get_paths
+        :param no_data_points: int, number of stacked frames
+        :param features: list, numeric features
+        :param shuffle: bool, shuffle order of episodes and samples
+        :param shuffle_buffer_mb: int, memory limit of shuffle buffers of all workers in MB
+        :param seed: int, base seed, shifted by epoch set with set_epoch
+        '''
+        super(StreamingDataset, self).__init__()
+        self.episodes = dict(sorted(episodes.items()))
+        self.no_data_points = no_data_points
+        self.features = features
+        self.shuffle = shuffle
+        self.shuffle_buffer_mb = shuffle_buffer_mb
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+        self.batch_size = 1
+
+    def __len__(self):
+        return sum(self.episodes.values())
+
+    def set_epoch(self, epoch:int, skip:int=0, batch_size:int=1) -> None:
+        '''
+        :param epoch: int, shifts the seed of shuffling
+        :param skip: int, number of already trained batches of the epoch, e.g. when resuming from checkpoint
+        :param batch_size: int, batch size of the DataLoader
+        '''
+        self.epoch = epoch
+        self.skip = skip
+        self.batch_size = batch_size
 
+    def _samples(self, paths:list, skip:int=0):
+        '''
+        :param paths: list, episodes of the worker
+        :param skip: int, number of samples left out, whole episodes are left out without reading
+        :return: generator of samples with uint8 'img'
+        '''
         for path in paths:
-            if path not in prievous:
-                self.dfs[path] = pd.read_csv(f'{path}/episode_info.csv')
+            if skip >= self.episodes[path]:
+                skip -= self.episodes[path]
+                continue
+            for step, sample in episode_samples(path, no_data_points=self.no_data_points, features=self.features):
+                if skip > 0:
+                    skip -= 1
+                    continue
+                yield sample
+
+    @staticmethod
+    def _normalized(sample:dict) -> dict:
+        sample['img'] = normalize(sample['img'], dtype=np.float32)
+        return sample
 
-    def _add(self, sample):
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(sample)
-        else:
-            self.buffer[self.pos] = sample
-        self.pos = (self.pos + 1) % self.capacity
+    def _shuffled(self, paths:list, rng:np.random.RandomState, workers:int):
+        '''
+        :return: generator of samples of the episodes in order of the shuffle buffer
+        '''
+        buffer = []
+        capacity = None
+        for sample in self._samples(paths):
+            if capacity is None:
+                sample_bytes = sum(np.asarray(value).nbytes for value in sample.values())
+                capacity = max(self.shuffle_buffer_mb * 2**20 // (sample_bytes * workers), 1)
+            if len(buffer) < capacity:
+                buffer.append(sample)
+                continue
+            idx = rng.randint(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+        for idx in rng.permutation(len(buffer)):
+            yield buffer[idx]
+
+    def __iter__(self):
+        paths = list(self.episodes.keys())
+        if self.shuffle:
+            paths = [paths[i] for i in np.random.RandomState(self.seed + self.epoch).permutation(len(paths))]
+        paths, skip, split, workers = worker_split(paths, [self.episodes[path] for path in paths], skip=self.skip,
+                                                   batch_size=self.batch_size)
+        rng = np.random.RandomState(self.seed + self.epoch + split * 7919)
+
+        if not self.shuffle:
+            for sample in self._samples(paths, skip=skip):
+                yield self._normalized(sample)
+            return None
+
+        #Content of the buffer depends on all samples, samples of already trained batches are read
+        #but neither normalized nor sent to the main process
+        for idx, sample in enumerate(self._shuffled(paths, rng, workers)):
+            if idx >= skip:
+                yield self._normalized(sample)
+
+
+def read_shard(path:str) -> dict:
+    '''
+    :param path: str, shard directory
+    :return: dict, key -> np.array
+    '''
+    index = json.load(open(f'{path}/index.json'))
+    return {key: np.load(f'{path}/{key}.npy') for key in index['keys']}
 
-    def _add_bulk(self, samples):
-        for sample in samples:
-            if len(self.buffer) < self.capacity:
-                self.buffer.append(sample)
-            else:
-                self.buffer[self.pos] = sample
-            self.pos = (self.pos + 1) % self.capacity
 
-    def sample(self):
-        if len(self.buffer) <= self.batch_size:
-            return default_collate([self[key] for key in range(len(self.buffer))])
-        keys = np.random.choice(range(len(self.buffer)), self.batch_size, replace=False)
+def get_shards(path:str) -> list:
+    '''
+    :param path: str, directory with shards written by build_shards.py
+    :return: list of shard directories
+    '''
+    return sorted(f'{path}/{shard}' for shard in os.listdir(path) if os.path.exists(f'{path}/{shard}/index.json'))
 
-        return default_collate([self[key] for key in keys])
 
 # https://github.com/Shmuma/ptan/blob/049ff123f5967eaeeaa268684e13e5aec5029d9f/ptan/experience.py#L327
 class BufferedDataset(Dataset):
@@ -341,9 +1095,9 @@ class BufferedDataset(Dataset):
 
         self.ids = ids
         self.dfs = list(set([id[0] for id in ids]))
-        self.dfs = {directory: pd.read_csv(f'{directory}/episode_info.csv') for directory in self.dfs}
+        self.dfs = {directory: read_episode(directory, labels=LABELS_VERSION) for directory in self.dfs}
         # [path for path, df in dataset.dfs.items() if 'q' not in df.columns] dont use csvs without q
-        self.features = features + list(filter(lambda x: len(x) > 1, ['depth_indexes' * depth, 'rgb_indexes' * rgb]))
+        self.features = features
         self.transform = transform if transform else lambda x: x
         self.buffer = []
         self.capacity = buffer_size
@@ -396,9 +1150,9 @@ class BufferedAdHocDataset(Dataset):
 
         self.ids = ids
         self.dfs = list(set([id[0] for id in ids]))
-        self.dfs = {directory: pd.read_csv(f'{directory}/episode_info.csv') for directory in self.dfs}
+        self.dfs = {directory: read_episode(directory, labels=LABELS_VERSION) for directory in self.dfs}
         # [path for path, df in dataset.dfs.items() if 'q' not in df.columns] dont use csvs without q
-        self.features = features + list(filter(lambda x: len(x) > 1, ['depth_indexes' * depth, 'rgb_indexes' * rgb]))
+        self.features = features
         self.transform = transform if transform else lambda x: x
         self.buffer = []
         self.capacity = buffer_size
@@ -1,19 +1,34 @@
-import pandas as pd
+from episode_log import read_episode
+from net.utils import load_frames
+
 
 class Observation:
     """Class storing data about a single step"""
     def __init__(self, observation_filename = "../data/experiments/", step_id = 0):
-        self.camera_data_dir = observation_filename+'sensors/'
-        df = pd.read_csv(observation_filename)
-        raw_obs_data = df[df['step']==step_id].values.tolist()[0]
-        self.step, self.depth_camera_files, self.rgb_camera_files, self.collisions, self.velocity, self.velocity_cev, self.yaw, \
-        self.location, self.distance_2finish, self.steer, self.gas_break, self.reward = raw_obs_data
-        self.depth_camera_data = extract_camera_data(self.depth_camera_files,'img')
-        self.rgb_camera_data = extract_camera_data(self.rgb_camera_files, 'rgb')
-        
-    def __extract_camera_data(file_indices = [0, 1, 2, 3], camera_type = 'img'):
-        camera_data = []
-        for index in file_indices:
-            camera_data.append(np.array(Image.open(self.camera_data_dir+'{}_{}.png'.format(camera_type, str(index)))).astype(np.uint8)) 
-        return camera_data
-        
\ No newline at end of file
+        self.path = observation_filename
+        df = read_episode(observation_filename)
+        raw_obs_data = df[df['step']==step_id].iloc[0]
+        self.step = int(raw_obs_data['step'])
+        self.collisions = raw_obs_data.get('collisions')
+        self.velocity = raw_obs_data.get('velocity')
+        self.distance_2finish = raw_obs_data.get('distance_2finish')
+        self.steer = raw_obs_data.get('steer')
+        self.gas_break = raw_obs_data.get('gas_brake')
+        self.reward = raw_obs_data.get('reward')
+        self.location = raw_obs_data.filter(like='location_').values
+        self.depth_camera_files = self.__frame_indexes(raw_obs_data, 'depth')
+        self.rgb_camera_files = self.__frame_indexes(raw_obs_data, 'rgb')
+        self.depth_camera_data = self.__extract_camera_data(self.depth_camera_files, 'depth')
+        self.rgb_camera_data = self.__extract_camera_data(self.rgb_camera_files, 'rgb')
+
+    def __frame_indexes(self, row, camera_type = 'depth'):
+        indexes = row.filter(like=f'{camera_type}_indexes_')
+        return [int(idx) for idx in indexes.values]
+
+    def __extract_camera_data(self, file_indices = [0, 1, 2, 3], camera_type = 'depth'):
+        '''
+        Frames are read from the frame container or legacy png files, whichever the episode has
+        '''
+        if not file_indices:
+            return []
+        return list(load_frames(path=self.path, sensor=camera_type, indexes=file_indices))
@@ -4,12 +4,14 @@ import json
 import os
 from subprocess import check_call
 import gc
+import time
+from itertools import islice
 
 import numpy as np
 from torch.optim.lr_scheduler import OneCycleLR, CosineAnnealingWarmRestarts
 from torch.utils.data import DataLoader
 
-from config import NUMERIC_FEATURES, DEVICE, DATE_TIME, SENSORS, DATA_POINTS
+from config import NUMERIC_FEATURES, DEVICE, DATE_TIME, SENSORS, FRAME_CACHE_MB, DATA_POINTS
 from net.ddpg_net import DDPGActor, DDPGCritic
 
 np.random.seed(0)
@@ -21,14 +23,27 @@ from torchvision import transforms
 from torch import multiprocessing as mp, nn
 from tensorboardX import SummaryWriter
 
+from checkpoint import CheckpointManager, training_state, restore, rng_state, set_rng_state
+from distributed import init_distributed, cleanup, rank_dataset, EpisodeSampler, rank_samples, min_batches, \
+    all_reduce_gradients, broadcast_state, all_reduce_sum, NullWriter
+from frame_cache import make_frame_cache
 from net.utils import get_paths, DepthPreprocess, ToSupervised, SimpleDataset, unpack_batch, get_n_params, \
-    DepthSegmentationPreprocess
+    DepthSegmentationPreprocess, ShardDataset, StreamingDataset, get_shards, autocast, \
+    GradientStats
 
 def main(args):
 
     args = parse_args()
+    state = None
+    if args.resume:
+        #Run continues with arguments, weights, optimizer and data order of the latest checkpoint
+        state = CheckpointManager.load_latest(f'{args.resume}/checkpoints')
+        args = argparse.Namespace(**{**state['args'], 'resume': args.resume})
     tag = args.tag
-    device = torch.device('cuda:0')
+    #Data parallel ranks started by launch_ddp.py train on CPU, every rank reads its own episodes
+    rank, world_size = init_distributed()
+    device = DEVICE if world_size == 1 else torch.device('cpu')
+    is_main = rank == 0
 
     no_epochs = args.epochs
     batch_size = args.batch
@@ -36,28 +51,59 @@ def main(args):
     linear_hidden = args.linear
     conv_hidden = args.conv
 
-    #Get train test paths -> later on implement cross val
-    steps = get_paths(as_tuples=True, shuffle=True, tag=tag)
-    steps_train, steps_test = steps[:int(len(steps)*.8)], steps[int(len(steps)*.2):]
-
-    transform = transforms.Compose([DepthSegmentationPreprocess(no_data_points=args.no_data), ToSupervised()])
-
-    dataset_train = SimpleDataset(ids=steps_train, batch_size=batch_size, transform=transform, **SENSORS)
-    dataset_test = SimpleDataset(ids=steps_test, batch_size=batch_size, transform=transform, **SENSORS)
-
-    dataloader_params = {'batch_size': batch_size, 'shuffle': True, 'num_workers': 8} #we've already shuffled paths
-
-    dataset_train = DataLoader(dataset_train, **dataloader_params)
-    dataset_test = DataLoader(dataset_test, **dataloader_params)
-
-    batch = next(iter(dataset_test))
+    cache = None
+    if args.shards:
+        #Shards are split by episodes, see build_shards.py
+        shards = get_shards(args.shards)
+        dataset_train = rank_dataset(ShardDataset(shards=shards[:int(len(shards)*.8)], shuffle=True), rank, world_size)
+        dataset_test = rank_dataset(ShardDataset(shards=shards[int(len(shards)*.8):], shuffle=False), rank, world_size)
+        steps = range(len(dataset_train) + len(dataset_test))
+        dataloader_params = {'batch_size': batch_size, 'num_workers': max(8 // world_size, 1)}
+        dataset_train = DataLoader(dataset_train, **dataloader_params)
+        dataset_test = DataLoader(dataset_test, **dataloader_params)
+    elif args.stream:
+        #Train test split by episodes, samples of one episode are streamed by one worker
+        episodes = get_paths(tag=tag)
+        paths = [str(path) for path in np.random.permutation(sorted(episodes.keys()))]
+        paths_train, paths_test = paths[:int(len(paths)*.8)], paths[int(len(paths)*.8):]
+        dataset_train = StreamingDataset({path: episodes[path] for path in paths_train}, no_data_points=args.no_data,
+                                         shuffle=True, shuffle_buffer_mb=args.shuffle_buffer_mb)
+        dataset_test = StreamingDataset({path: episodes[path] for path in paths_test}, no_data_points=args.no_data,
+                                        shuffle=False)
+        dataset_train = rank_dataset(dataset_train, rank, world_size)
+        dataset_test = rank_dataset(dataset_test, rank, world_size)
+        steps = range(len(dataset_train) + len(dataset_test))
+        dataloader_params = {'batch_size': batch_size, 'num_workers': max(8 // world_size, 1)}
+        dataset_train = DataLoader(dataset_train, **dataloader_params)
+        dataset_test = DataLoader(dataset_test, **dataloader_params)
+    else:
+        #Get train test paths -> later on implement cross val
+        steps = get_paths(as_tuples=True, shuffle=True, tag=tag)
+        steps_train, steps_test = steps[:int(len(steps)*.8)], steps[int(len(steps)*.2):]
+
+        cache = make_frame_cache(max_mb=args.cache_mb)
+        transform = transforms.Compose([DepthSegmentationPreprocess(no_data_points=args.no_data, cache=cache), ToSupervised()])
+
+        dataset_train = SimpleDataset(ids=steps_train, batch_size=batch_size, transform=transform, **SENSORS)
+        dataset_test = SimpleDataset(ids=steps_test, batch_size=batch_size, transform=transform, **SENSORS)
+
+        #EpisodeSampler shuffles by epoch, so resumed epochs start at the first untrained batch
+        dataloader_params = {'batch_size': batch_size, 'num_workers': max(8 // world_size, 1)}
+        dataset_train = DataLoader(dataset_train, **dataloader_params,
+                                   sampler=EpisodeSampler(dataset_train.ids, rank=rank, world_size=world_size))
+        dataset_test = DataLoader(dataset_test, **dataloader_params,
+                                  sampler=EpisodeSampler(dataset_test.ids, rank=rank, world_size=world_size,
+                                                         shuffle=False))
+
+    #Every rank has train samples, see rank_dataset
+    batch = next(iter(dataset_train))
     action_shape = batch['action'][0].shape
     img_shape = batch['img'][0].shape
     #Nets
     actor_net = DDPGActor(img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)], output_shape=[2],
-                          linear_hidden=linear_hidden, conv_filters=conv_hidden)
+                          linear_hidden=linear_hidden, conv_filters=conv_hidden, cuda=device.type == 'cuda')
     critic_net = DDPGCritic(actor_out_shape=action_shape, img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)],
-                            linear_hidden=linear_hidden, conv_filters=conv_hidden)
+                            linear_hidden=linear_hidden, conv_filters=conv_hidden, cuda=device.type == 'cuda')
 
     print(len(steps))
     print(actor_net)
@@ -65,21 +111,38 @@ def main(args):
     print(critic_net)
     print(get_n_params(critic_net))
     # save path
-    actor_net_path = f'../data/models/offline/{DATE_TIME}/{actor_net.name}'
-    critic_net_path = f'../data/models/offline/{DATE_TIME}/{critic_net.name}'
-    os.makedirs(actor_net_path, exist_ok=True)
-    os.makedirs(critic_net_path, exist_ok=True)
+    run_path = args.resume or f'../data/models/offline/{DATE_TIME}'
+    actor_net_path = f'{run_path}/{actor_net.name}'
+    critic_net_path = f'{run_path}/{critic_net.name}'
+    checkpoints = CheckpointManager(f'{run_path}/checkpoints', keep=args.keep_checkpoints, enabled=is_main)
     optim_steps = args.optim_steps
-    logging_idx = int(len(dataset_train.dataset) / (batch_size * optim_steps))
-
-    actor_writer_train = SummaryWriter(f'{actor_net_path}/train', max_queue=30, flush_secs=5)
-    critic_writer_train = SummaryWriter(f'{critic_net_path}/train', max_queue=1, flush_secs=5)
-    actor_writer_test = SummaryWriter(f'{actor_net_path}/test', max_queue=30, flush_secs=5)
-    critic_writer_test = SummaryWriter(f'{critic_net_path}/test', max_queue=1, flush_secs=5)
+    #All ranks run the same number of updates per epoch, limited by the rank with the fewest samples
+    train_batches = min_batches(rank_samples(dataset_train), batch_size) if world_size > 1 else None
+    train_samples = train_batches * batch_size if world_size > 1 else len(dataset_train.dataset)
+    test_samples = int(all_reduce_sum(rank_samples(dataset_test)))
+    logging_idx = int(train_samples / (batch_size * optim_steps))
+
+    if is_main:
+        os.makedirs(actor_net_path, exist_ok=True)
+        os.makedirs(critic_net_path, exist_ok=True)
+        actor_writer_train = SummaryWriter(f'{actor_net_path}/train', max_queue=30, flush_secs=5)
+        critic_writer_train = SummaryWriter(f'{critic_net_path}/train', max_queue=1, flush_secs=5)
+        actor_writer_test = SummaryWriter(f'{actor_net_path}/test', max_queue=30, flush_secs=5)
+        critic_writer_test = SummaryWriter(f'{critic_net_path}/test', max_queue=1, flush_secs=5)
+    else:
+        actor_writer_train, critic_writer_train, actor_writer_test, critic_writer_test = [NullWriter()] * 4
+
+    if args.shared_encoder:
+        actor_net.share_encoder(critic_net)
+    broadcast_state(actor_net)
+    broadcast_state(critic_net)
 
     #Optimizers
-    actor_optimizer = torch.optim.Adam(actor_net.parameters(), lr=0.001)
+    actor_optimizer = torch.optim.Adam(actor_net.trained_parameters(), lr=0.001)
     critic_optimizer = torch.optim.Adam(critic_net.parameters(), lr=0.001)
+    grad_log_every = args.grad_log_every if is_main else 0
+    actor_grad_stats = GradientStats(actor_net, every=grad_log_every, parameters=actor_net.trained_parameters())
+    critic_grad_stats = GradientStats(critic_net, every=grad_log_every)
 
     actor_scheduler = CosineAnnealingWarmRestarts(actor_optimizer, T_0=optim_steps, T_mult=2)
     critic_scheduler = CosineAnnealingWarmRestarts(critic_optimizer, T_0=optim_steps, T_mult=2)
@@ -91,27 +154,41 @@ def main(args):
     actor_best_test_loss = 1e10
     critic_best_test_loss = 1e10
 
-    for epoch_idx in range(no_epochs):
+    start_epoch, start_batch = 0, 0
+    if state is not None:
+        restore(state, actor_net=actor_net, critic_net=critic_net, actor_optimizer=actor_optimizer,
+                critic_optimizer=critic_optimizer, actor_scheduler=actor_scheduler, critic_scheduler=critic_scheduler)
+        actor_best_train_loss, critic_best_train_loss, actor_best_test_loss, critic_best_test_loss = \
+            state['metrics']['best']
+        start_epoch, start_batch = state['position']['epoch'], state['position']['batch']
+
+    for epoch_idx in range(start_epoch, no_epochs):
         actor_train_loss = .0
         critic_train_loss = .0
         actor_running_loss = .0
         critic_running_loss = .0
-        actor_avg_max_grad = .0
-        critic_avg_max_grad = .0
-        actor_avg_avg_grad = .0
-        critic_avg_avg_grad = .0
-        for idx, batch in enumerate(iter(dataset_train)):
-            global_step = int((len(dataset_train.dataset) / batch_size * epoch_idx) + idx)
+        skip = 0
+        if state is not None and epoch_idx == start_epoch:
+            #Same shuffling as the interrupted epoch, already trained batches are skipped
+            set_rng_state(state['rng'])
+            actor_train_loss, critic_train_loss, actor_running_loss, critic_running_loss = state['metrics']['epoch']
+            skip = start_batch
+        #Skipped at the source, already trained batches are never loaded
+        if isinstance(dataset_train.dataset, (ShardDataset, StreamingDataset)):
+            dataset_train.dataset.set_epoch(epoch_idx, skip=skip, batch_size=batch_size)
+        if isinstance(dataset_train.sampler, EpisodeSampler):
+            dataset_train.sampler.set_epoch(epoch_idx, skip=skip, batch_size=batch_size)
+        epoch_rng = rng_state()
+        epoch_start = time.perf_counter()
+        for idx, batch in enumerate(islice(dataset_train, train_batches - skip if train_batches is not None else None),
+                                    start=skip):
+            global_step = int((train_samples / batch_size * epoch_idx) + idx)
             batch = unpack_batch(batch=batch, device=device)
-            actor_loss, critic_loss, actor_grad, critic_grad = train_rl(batch=batch, actor_net=actor_net, critic_net=critic_net,
-                                  actor_optimizer=actor_optimizer, critic_optimizer=critic_optimizer, loss_fn=loss_function)
+            actor_loss, critic_loss = train_rl(batch=batch, actor_net=actor_net, critic_net=critic_net,
+                                  actor_optimizer=actor_optimizer, critic_optimizer=critic_optimizer, loss_fn=loss_function,
+                                  shared_encoder=args.shared_encoder, bf16=args.bf16,
+                                  actor_grad_stats=actor_grad_stats, critic_grad_stats=critic_grad_stats)
             del batch
-            gc.collect()
-
-            actor_avg_max_grad  += max([element.max() for element in actor_grad])
-            critic_avg_max_grad += max([element.max() for element in critic_grad])
-            actor_avg_avg_grad  += sum([element.mean() for element in actor_grad]) / len(actor_grad)
-            critic_avg_avg_grad += sum([element.mean() for element in critic_grad]) / len(critic_grad)
 
             actor_running_loss += actor_loss
             critic_train_loss += critic_loss
@@ -121,26 +198,20 @@ def main(args):
             actor_writer_train.add_scalar(tag=f'{actor_net.name}/running_loss',
                                           scalar_value=actor_loss/batch_size,
                                           global_step=global_step)
-            actor_writer_train.add_scalar(tag=f'{actor_net.name}/max_grad', scalar_value=actor_avg_max_grad,
-                                          global_step=global_step)
-            actor_writer_train.add_scalar(tag=f'{actor_net.name}/mean_grad', scalar_value=actor_avg_avg_grad,
-                                          global_step=global_step)
+            actor_grad_stats.write(actor_writer_train, global_step=global_step)
 
             critic_writer_train.add_scalar(tag=f'{critic_net.name}/running_loss',
                                           scalar_value=critic_loss/batch_size,
                                           global_step=global_step)
-            critic_writer_train.add_scalar(tag=f'{critic_net.name}/max_grad', scalar_value=critic_avg_max_grad,
-                                          global_step=global_step)
-            critic_writer_train.add_scalar(tag=f'{critic_net.name}/mean_grad', scalar_value=critic_avg_avg_grad,
-                                          global_step=global_step)
+            critic_grad_stats.write(critic_writer_train, global_step=global_step)
 
             if idx % logging_idx == logging_idx-1:
                 print(f'Actor Epoch: {epoch_idx + 1}, Batch: {idx+1}, Loss: {actor_running_loss/logging_idx}')
                 print(f'Critic Epoch: {epoch_idx + 1}, Batch: {idx+1}, Loss: {critic_running_loss/logging_idx}')
                 if (critic_running_loss/logging_idx) < critic_best_train_loss:
                     critic_best_train_loss = critic_running_loss/logging_idx
-                    torch.save(actor_net.state_dict(), f'{actor_net_path}/train/train.pt')
-                    torch.save(critic_net.state_dict(), f'{critic_net_path}/train/train.pt')
+                    checkpoints.save_weights(actor_net.state_dict(), f'{actor_net_path}/train/train.pt')
+                    checkpoints.save_weights(critic_net.state_dict(), f'{critic_net_path}/train/train.pt')
 
                 actor_writer_train.add_scalar(tag=f'{actor_net.name}/lr', scalar_value=actor_scheduler.get_last_lr()[0],
                                         global_step=global_step)
@@ -150,16 +221,31 @@ def main(args):
                 actor_scheduler.step()
                 critic_scheduler.step()
                 actor_running_loss = .0
-                actor_avg_max_grad = .0
-                actor_avg_avg_grad = .0
                 critic_running_loss = .0
-                critic_avg_max_grad = .0
-                critic_avg_avg_grad = .0
+
+            if args.checkpoint_every and (idx + 1) % args.checkpoint_every == 0:
+                checkpoints.save(training_state(
+                    args, epoch=epoch_idx, batch=idx + 1, rng=epoch_rng,
+                    metrics={'best': [actor_best_train_loss, critic_best_train_loss, actor_best_test_loss,
+                                      critic_best_test_loss],
+                             'epoch': [actor_train_loss, critic_train_loss, actor_running_loss, critic_running_loss]},
+                    actor_net=actor_net, critic_net=critic_net, actor_optimizer=actor_optimizer,
+                    critic_optimizer=critic_optimizer, actor_scheduler=actor_scheduler,
+                    critic_scheduler=critic_scheduler))
 
         print(f'{critic_net.name} best train loss for epoch {epoch_idx+1} - {critic_best_train_loss}')
-        actor_writer_train.add_scalar(tag=f'{actor_net.name}/global_loss', scalar_value=(actor_train_loss/(len(dataset_train.dataset))),
+        #Throughput next to the losses, so bf16 and fp32 runs can be compared
+        samples_per_s = train_samples * world_size / (time.perf_counter() - epoch_start)
+        print(f'Train throughput {samples_per_s:.1f} samples/s, {"bf16" if args.bf16 else "fp32"}')
+        critic_writer_train.add_scalar(tag=f'{critic_net.name}/samples_per_s', scalar_value=samples_per_s,
+                                       global_step=(epoch_idx+1))
+        if cache is not None:
+            for key, value in cache.stats().items():
+                critic_writer_train.add_scalar(tag=f'cache/{key}', scalar_value=value, global_step=(epoch_idx+1))
+            print(f'Frame cache: {cache.stats()}')
+        actor_writer_train.add_scalar(tag=f'{actor_net.name}/global_loss', scalar_value=(actor_train_loss/train_samples),
                                       global_step=(epoch_idx+1))
-        critic_writer_train.add_scalar(tag=f'{critic_net.name}/global_loss', scalar_value=(critic_train_loss/(len(dataset_train.dataset))),
+        critic_writer_train.add_scalar(tag=f'{critic_net.name}/global_loss', scalar_value=(critic_train_loss/train_samples),
                                       global_step=(epoch_idx+1))
         actor_test_loss = .0
         critic_test_loss = .0
@@ -173,26 +259,38 @@ def main(args):
 
                 critic_test_loss += critic_loss
                 actor_test_loss += actor_loss
+        critic_test_loss, actor_test_loss = all_reduce_sum(critic_test_loss), all_reduce_sum(actor_test_loss)
 
-        if critic_test_loss / len(dataset_test.dataset) < critic_best_test_loss:
-            critic_best_test_loss = (critic_test_loss / len(dataset_test.dataset))
-        if actor_test_loss / len(dataset_test.dataset) < actor_best_test_loss:
-            actor_best_test_loss = (actor_test_loss / len(dataset_test.dataset))
+        if critic_test_loss / test_samples < critic_best_test_loss:
+            critic_best_test_loss = (critic_test_loss / test_samples)
+        if actor_test_loss / test_samples < actor_best_test_loss:
+            actor_best_test_loss = (actor_test_loss / test_samples)
 
-        torch.save(critic_net.state_dict(), f'{critic_net_path}/test/test_{epoch_idx+1}.pt')
-        torch.save(actor_net.state_dict(), f'{actor_net_path}/test/test_{epoch_idx+1}.pt')
+        checkpoints.save_weights(critic_net.state_dict(), f'{critic_net_path}/test/test_{epoch_idx+1}.pt')
+        checkpoints.save_weights(actor_net.state_dict(), f'{actor_net_path}/test/test_{epoch_idx+1}.pt')
 
-        print(f'{critic_net.name} test loss {(critic_test_loss/len(dataset_test.dataset)):.3f}')
-        print(f'{actor_net.name} test loss {(actor_test_loss/len(dataset_test.dataset)):.3f}')
+        print(f'{critic_net.name} test loss {(critic_test_loss/test_samples):.3f}')
+        print(f'{actor_net.name} test loss {(actor_test_loss/test_samples):.3f}')
         print(f'{critic_net.name} best test loss {critic_best_test_loss:.3f}')
         print(f'{actor_net.name} best test loss {actor_best_test_loss:.3f}')
 
-        critic_writer_test.add_scalar(tag=f'{critic_net.name}/global_loss', scalar_value=(critic_test_loss/(len(dataset_test.dataset))),
+        critic_writer_test.add_scalar(tag=f'{critic_net.name}/global_loss', scalar_value=(critic_test_loss/test_samples),
                                      global_step=(epoch_idx + 1))
-        actor_writer_test.add_scalar(tag=f'{actor_net.name}/global_loss', scalar_value=(actor_test_loss/(len(dataset_test.dataset))),
+        actor_writer_test.add_scalar(tag=f'{actor_net.name}/global_loss', scalar_value=(actor_test_loss/test_samples),
                                      global_step=(epoch_idx + 1))
         torch.cuda.empty_cache()
         gc.collect()
+        checkpoints.save(training_state(
+            args, epoch=epoch_idx + 1, batch=0, rng=rng_state(),
+            metrics={'best': [actor_best_train_loss, critic_best_train_loss, actor_best_test_loss, critic_best_test_loss],
+                     'epoch': [.0, .0, .0, .0]},
+            actor_net=actor_net, critic_net=critic_net, actor_optimizer=actor_optimizer,
+            critic_optimizer=critic_optimizer, actor_scheduler=actor_scheduler, critic_scheduler=critic_scheduler))
+
+    checkpoints.close()
+    cleanup()
+    if not is_main:
+        return None
 
     torch.save(actor_optimizer.state_dict(), f=f'{actor_net_path}/{actor_optimizer.__class__.__name__}.pt')
     torch.save(critic_optimizer.state_dict(), f=f'{critic_net_path}/{critic_optimizer.__class__.__name__}.pt')
@@ -229,7 +327,8 @@ def main(args):
 
 
 def train_rl(batch, actor_net:nn.Module, critic_net:nn.Module, actor_optimizer:torch.optim.Optimizer,
-          critic_optimizer:torch.optim.Optimizer, loss_fn:torch.nn.MSELoss):
+          critic_optimizer:torch.optim.Optimizer, loss_fn:torch.nn.MSELoss, shared_encoder:bool=False, bf16:bool=False,
+             actor_grad_stats:GradientStats=None, critic_grad_stats:GradientStats=None):
     '''
 
     :param batch:
@@ -238,26 +337,40 @@ def train_rl(batch, actor_net:nn.Module, critic_net:nn.Module, actor_optimizer:t
     :param actor_optimizer:
     :param critic_optimizer:
     :param loss_fn:
-    :return:
+    :param shared_encoder: bool, actor shares critic encoder, image features are computed once
+    :param bf16: bool, forward passes in bfloat16 autocast, losses in float32
+    :param actor_grad_stats: GradientStats, updated with gradients of the actor before clipping
+    :param critic_grad_stats: GradientStats, updated with gradients of the critic before clipping
+    :return: (torch.Tensor, torch.Tensor), detached actor and critic loss
     '''
     critic_optimizer.zero_grad()
-    q_pred = critic_net(**batch).view(-1)
-    critic_loss = loss_fn(q_pred, batch['q'].view(-1))
+    with autocast(bf16, device=batch['img'].device):
+        features = critic_net.encode(batch['img'])
+        q_pred = critic_net.head(action=batch['action'], x_numeric=batch['x_numeric'], features=features).view(-1)
+    critic_loss = loss_fn(q_pred.float(), batch['q'].view(-1))
     critic_loss.backward()
+    all_reduce_gradients(critic_net.parameters())
+    if critic_grad_stats is not None:
+        critic_grad_stats.update()
     nn.utils.clip_grad_value_(critic_net.parameters(), 1.5)
-    critic_grad = [p.detach().cpu().abs() for p in critic_net.parameters()]
     critic_optimizer.step()
 
     actor_optimizer.zero_grad()
-    action = actor_net(**batch)
-    actor_loss = loss_fn(action, batch['action'])
+    with autocast(bf16, device=batch['img'].device):
+        if shared_encoder:
+            action = actor_net.head(x_numeric=batch['x_numeric'], features=features.detach())
+        else:
+            action = actor_net(**batch)
+    actor_loss = loss_fn(action.float(), batch['action'])
     actor_loss = actor_loss.sum()
     actor_loss.backward()
-    nn.utils.clip_grad_value_(actor_net.parameters(), 1.5)
-    actor_grad = [p.detach().cpu().abs() for p in actor_net.parameters()]
+    all_reduce_gradients(actor_net.trained_parameters())
+    if actor_grad_stats is not None:
+        actor_grad_stats.update()
+    nn.utils.clip_grad_value_(actor_net.trained_parameters(), 1.5)
     actor_optimizer.step()
 
-    return actor_loss.abs().sum(), critic_loss.abs().sum(), actor_grad, critic_grad
+    return actor_loss.detach().abs().sum(), critic_loss.detach().abs().sum()
 
 
 def parse_args():
@@ -308,6 +421,63 @@ def parse_args():
         default=None,
         dest='tag',
         help='Filter for dataset')
+    argparser.add_argument(
+        '--shared_encoder',
+        action='store_true',
+        dest='shared_encoder',
+        help='Actor uses critic image encoder, features are computed once per batch')
+    argparser.add_argument(
+        '--resume',
+        default=None,
+        type=str,
+        dest='resume',
+        help='Run directory to resume from its latest checkpoint, e.g. ../data/models/offline/20200601_1200')
+    argparser.add_argument(
+        '--checkpoint_every',
+        default=500,
+        type=int,
+        dest='checkpoint_every',
+        help='Checkpoint every n-th batch, checkpoints are also written after every epoch, 0 only after epochs')
+    argparser.add_argument(
+        '--keep_checkpoints',
+        default=3,
+        type=int,
+        dest='keep_checkpoints',
+        help='Number of kept checkpoints, 0 keeps all')
+    argparser.add_argument(
+        '--grad_log_every',
+        default=10,
+        type=int,
+        dest='grad_log_every',
+        help='Log gradient norms, max and mean every n-th batch, 0 disables gradient stats')
+    argparser.add_argument(
+        '--bf16',
+        action='store_true',
+        dest='bf16',
+        help='bfloat16 autocast of forward and backward passes, weights stay in float32, requires torch >= 1.10 '
+             '(environment.yml pins torch 1.5)')
+    argparser.add_argument(
+        '--shards',
+        default=None,
+        dest='shards',
+        help='Directory with shards built by build_shards.py, replaces --tag')
+    argparser.add_argument(
+        '--stream',
+        action='store_true',
+        dest='stream',
+        help='Stream whole episodes sequentially instead of random access to steps')
+    argparser.add_argument(
+        '--shuffle_buffer_mb',
+        default=128,
+        type=int,
+        dest='shuffle_buffer_mb',
+        help='Memory limit of shuffle buffers of all workers in MB, buffers keep uint8 frames, used with --stream')
+    argparser.add_argument(
+        '--cache_mb',
+        default=FRAME_CACHE_MB,
+        type=int,
+        dest='cache_mb',
+        help='Size of shared cache of decoded frames in MB, 0 disables it')
     args = argparser.parse_known_args()
     if len(args) > 1:
         args = args[0]
@@ -0,0 +1,143 @@
+#Script for packing legacy png frames of the experiments tree into per-sensor frame containers
+import argparse
+import os
+import zlib
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from config import EXPERIMENTS_PATH
+from episode_log import list_episodes
+from frame_store import FrameWriter, FrameReader, has_frames
+
+
+def legacy_frames(path:str) -> dict:
+    '''
+    Lists legacy {sensor}_{idx}.png files of the episode
+    :param path: str, path to experiment folder
+    :return: dict, sensor -> {idx: file}
+    '''
+    frames = {}
+    if not os.path.isdir(f'{path}/sensors'):
+        return frames
+    for file in os.listdir(f'{path}/sensors'):
+        if not file.endswith('.png'):
+            continue
+        sensor, idx = file[:-len('.png')].rsplit('_', 1)
+        if idx.isdigit():
+            frames.setdefault(sensor, {})[int(idx)] = f'{path}/sensors/{file}'
+    return frames
+
+
+def pack_sensor(path:str, sensor:str, files:dict, verify:bool=True) -> None:
+    '''
+    Copies png files of the sensor into 'png' container as they are, without decoding and encoding them again
+    :param path: str, path to experiment folder
+    :param sensor: str, sensor name
+    :param files: dict, idx -> png file
+    :param verify: bool, compare crc32 of every packed frame with the source file
+    :return: None
+    '''
+    shape = np.array(Image.open(files[min(files)])).shape
+    writer = FrameWriter(path, sensor, codec='png', capacity=max(files) + 1)
+    checksums = {}
+    for idx in sorted(files):
+        with open(files[idx], 'rb') as file:
+            data = file.read()
+        checksums[idx] = zlib.crc32(data)
+        writer.write_encoded(idx, data, shape=shape)
+    writer.close()
+
+    if verify:
+        reader = FrameReader(path, sensor)
+        corrupted = [idx for idx, checksum in checksums.items() if zlib.crc32(reader.encoded(idx)) != checksum]
+        if corrupted or reader[min(files)].shape != reader.shape:
+            os.remove(f'{writer.file}.json')
+            raise ValueError(f'{sensor} container doesn\'t match png files, frames {corrupted[:10]}')
+
+
+def pack_episode(path:str, verify:bool=True, remove:bool=False) -> (str, str):
+    '''
+    Packs all legacy sensors of the episode, already packed sensors are skipped
+    :param path: str, path to experiment folder
+    :param verify: bool, verify containers against png files
+    :param remove: bool, remove png files of verified containers
+    :return: (str, str), path and status
+    '''
+    try:
+        frames = legacy_frames(path)
+        if not frames:
+            return path, 'skipped, no png frames'
+        packed = []
+        for sensor, files in frames.items():
+            if has_frames(path, sensor):
+                continue
+            pack_sensor(path, sensor, files, verify=verify)
+            packed.append(sensor)
+        if remove and verify:
+            for sensor in packed:
+                for file in frames[sensor].values():
+                    os.remove(file)
+        return path, f'ok, {",".join(packed) or "nothing"} packed'
+    except Exception as e:
+        return path, f'failed, {e}'
+
+
+def main(args):
+    paths = list_episodes(args.path)
+    if args.tag:
+        paths = [path for path in paths if args.tag in path]
+    print(f'Packing {len(paths)} episodes')
+
+    fn = partial(pack_episode, verify=not args.no_verify, remove=args.remove)
+    failed = 0
+    with Pool(processes=args.workers) as pool:
+        for path, status in pool.imap_unordered(fn, paths, chunksize=4):
+            if status.startswith('failed'):
+                failed += 1
+            print(f'{path}: {status}')
+    print(f'Done, {len(paths) - failed}/{len(paths)} episodes packed')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--path',
+        default=EXPERIMENTS_PATH,
+        dest='path',
+        help='Root of experiments tree')
+    argparser.add_argument(
+        '--tag',
+        default=None,
+        dest='tag',
+        help='Filter for episodes')
+    argparser.add_argument(
+        '--no_verify',
+        action='store_true',
+        dest='no_verify',
+        help='Skip verification of packed frames')
+    argparser.add_argument(
+        '--remove',
+        action='store_true',
+        dest='remove',
+        help='Remove png files after the container was verified')
+    argparser.add_argument(
+        '--workers',
+        default=8,
+        type=int,
+        dest='workers',
+        help='Number of processes')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
@@ -0,0 +1,106 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+class BatchPrefetcher:
+    def __init__(self, buffer, depth:int=4, batch_size:int=None, min_size:int=0, pin_memory:bool=True):
+        '''
+        Samples batches from the replay buffer in a background thread, so the simulation loop only consumes
+        ready batches. Batches are collated tensors, pinned if CUDA is available.
+        Priorities of PrioritizedReplayBuffer are updated with slots of already queued batches,
+        so at most depth batches use slightly stale priorities.
+        :param buffer: ReplayBuffer
+        :param depth: int, max number of ready batches in the queue
+        :param batch_size: int, by default batch size of the buffer
+        :param min_size: int, sampling starts when buffer has more transitions
+        :param pin_memory: bool, pin batches for asynchronous host to device copy
+        '''
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.min_size = min_size
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.errors = []
+        self.reset_stats()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _pin(self, batch):
+        if isinstance(batch, dict):
+            return {key: self._pin(value) for key, value in batch.items()}
+        if isinstance(batch, torch.Tensor):
+            return batch.pin_memory()
+        return batch
+
+    def _work(self) -> None:
+        while not self.stopped.is_set():
+            if len(self.buffer) <= self.min_size:
+                time.sleep(0.01)
+                continue
+            try:
+                start = time.perf_counter()
+                batch = self.buffer.sample(self.batch_size)
+                if self.pin_memory:
+                    batch = self._pin(batch)
+                self.sample_time += time.perf_counter() - start
+            except Exception as e:
+                self.errors.append(e)
+                time.sleep(0.1)
+                continue
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self) -> dict:
+        '''
+        Returns next ready batch, waits if the queue is empty (starvation). Errors of the sampling thread are
+        re-raised, also when they occur while waiting.
+        :return: dict, batch of the buffer
+        '''
+        start = time.perf_counter()
+        if self.queue.empty():
+            self.starved += 1
+        while True:
+            if self.errors:
+                errors, self.errors = self.errors, []
+                raise errors[0]
+            if self.stopped.is_set() and self.queue.empty():
+                raise RuntimeError('BatchPrefetcher is stopped')
+            try:
+                batch = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        wait = time.perf_counter() - start
+        self.waits.append(wait)
+        return batch
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def stats(self) -> dict:
+        '''
+        :return: dict, number of consumed batches, how many of them had to be waited for,
+        mean and p99 wait in ms, time spent on sampling in s and current queue depth
+        '''
+        waits = np.array(self.waits) * 1000 if self.waits else np.zeros(1)
+        return {'batches': len(self.waits),
+                'starved': self.starved,
+                'wait_mean_ms': float(waits.mean()),
+                'wait_p99_ms': float(np.percentile(waits, 99)),
+                'sample_s': self.sample_time,
+                'queue_depth': self.queue.qsize()}
+
+    def reset_stats(self) -> None:
+        self.waits = []
+        self.starved = 0
+        self.sample_time = .0
@@ -0,0 +1,103 @@
+#Script for relabeling rewards, dones and q values of the whole experiments tree
+import argparse
+from functools import partial
+from multiprocessing import Pool
+
+from config import EXPERIMENTS_PATH, GAMMA
+from episode_log import read_episode, write_labels, list_episodes
+from rewards import SCHEMES, relabel, punishment_scheme
+
+
+def relabel_episode(path:str, version:str, scheme:str=None, gamma:float=GAMMA, punishment:float=None) -> (str, str):
+    '''
+    Relabels single episode and saves new columns as version
+    :param path: str, path to experiment folder
+    :param version: str, name of the labels version
+    :param scheme: str, reward scheme, None for recomputing only q and done
+    :param gamma: float, discount factor
+    :param punishment: float, constant step punishment, taken from punishment_scheme by default
+    :return: (str, str), path and status
+    '''
+    try:
+        df = read_episode(path, columns=['step', 'distance_2finish', 'velocity', 'collisions', 'reward'])
+        if len(df) < 2:
+            return path, 'skipped, episode too short'
+        punishment = punishment if punishment is not None else punishment_scheme(path)
+        labels = relabel(df, scheme=scheme, gamma=gamma, punishment=punishment)
+        write_labels(path, labels=labels, version=version)
+        return path, 'ok'
+    except Exception as e:
+        return path, f'failed, {e}'
+
+
+def main(args):
+    paths = list_episodes(args.path)
+    if args.tag:
+        paths = [path for path in paths if args.tag in path]
+    print(f'Relabeling {len(paths)} episodes as version {args.version}')
+
+    fn = partial(relabel_episode, version=args.version, scheme=args.scheme, gamma=args.gamma,
+                 punishment=args.punishment)
+    failed = 0
+    with Pool(processes=args.workers) as pool:
+        for path, status in pool.imap_unordered(fn, paths, chunksize=8):
+            if status != 'ok':
+                failed += 1
+                print(f'{path}: {status}')
+    print(f'Done, {len(paths) - failed}/{len(paths)} episodes relabeled. '
+          f'Set LABELS_VERSION = \'{args.version}\' in config.py to train on them.')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '--path',
+        default=EXPERIMENTS_PATH,
+        dest='path',
+        help='Root of experiments tree')
+    argparser.add_argument(
+        '--version',
+        required=True,
+        dest='version',
+        help='Name of the new labels version')
+    argparser.add_argument(
+        '--scheme',
+        default=None,
+        choices=list(SCHEMES.keys()),
+        dest='scheme',
+        help='Reward scheme, if not set saved rewards are kept and only q and done are recomputed')
+    argparser.add_argument(
+        '--gamma',
+        default=GAMMA,
+        type=float,
+        dest='gamma',
+        help='Discount factor of the reward scheme')
+    argparser.add_argument(
+        '--punishment',
+        default=None,
+        type=float,
+        dest='punishment',
+        help='Constant punishment for every step, default depends on the map')
+    argparser.add_argument(
+        '--tag',
+        default=None,
+        dest='tag',
+        help='Filter for episodes')
+    argparser.add_argument(
+        '--workers',
+        default=8,
+        type=int,
+        dest='workers',
+        help='Number of processes')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from config import EXTRA_REWARD, GAMMA, SLOW_FRAMES
+
+
+def discounted_returns(rewards:np.array, gamma:float=1., dones:np.array=None) -> np.array:
+    '''
+    Returns q_i = r_i + gamma * r_(i+1) + ... computed with reverse cumulative sums in O(n).
+    Rewards saved by the runners are already discounted with gamma**step, so default gamma is 1.
+    :param rewards: np.array, rewards of consecutive steps
+    :param gamma: float, discount factor
+    :param dones: np.array, optional terminal flags, return is not propagated over steps with done != 0
+    :return: np.array
+    '''
+    rewards = np.asarray(rewards, dtype=np.float64)
+    if dones is None:
+        ends = [len(rewards)]
+    else:
+        ends = list(np.flatnonzero(np.asarray(dones) != 0) + 1)
+        if not ends or ends[-1] != len(rewards):
+            ends.append(len(rewards))
+
+    returns = np.empty_like(rewards)
+    start = 0
+    for end in ends:
+        segment = rewards[start:end][::-1]
+        if gamma == 1.:
+            returns[start:end] = np.cumsum(segment)[::-1]
+        else:
+            returns[start:end] = lfilter([1.], [1., -gamma], segment)[::-1]
+        start = end
+    return returns
+
+
+def progress(distance:np.array) -> np.array:
+    '''
+    :param distance: np.array, distance to finish of consecutive steps
+    :return: np.array, 1 if agent got closer to finish in the next step, 0 if distance didn't change, -1 otherwise
+    '''
+    return np.sign(distance[:-1] - distance[1:])
+
+
+def failed(df:pd.DataFrame, max_step:int=3499, slow_frames:int=SLOW_FRAMES) -> (bool, bool):
+    '''
+    :param df: pd.DataFrame, episode info
+    :return: (bool, bool), episode ended with timeout or collision, agent got stuck
+    '''
+    crashed = (df['step'].max() > max_step) or (df['collisions'].max() > 0)
+    stuck = int((df['velocity'] < 10).sum()) > slow_frames
+    return crashed, stuck
+
+
+def distance_reward(df:pd.DataFrame, gamma:float=GAMMA, punishment:float=0.01) -> np.array:
+    '''
+    Reward +1/0/-1 for getting closer to/staying/getting further from the finish, discounted with gamma**i
+    :param df: pd.DataFrame, episode info
+    :param gamma: float, discount factor
+    :param punishment: float, constant punishment for every step
+    :return: np.array
+    '''
+    discount = gamma ** np.arange(len(df) - 1)
+    rewards = np.append(progress(df['distance_2finish'].values) * discount - punishment, 0.)
+    crashed, stuck = failed(df)
+    if crashed or stuck:
+        rewards[-2] = - (punishment + EXTRA_REWARD * gamma ** (df['step'].max() - 1))
+    return rewards
+
+
+def velocity_reward(df:pd.DataFrame, gamma:float=GAMMA, punishment:float=0.01) -> np.array:
+    '''
+    Reward proportional to the velocity ratio of consecutive steps, signed with progress towards the finish
+    :param df: pd.DataFrame, episode info
+    :param gamma: float, discount factor
+    :param punishment: float, constant punishment for every step
+    :return: np.array
+    '''
+    velocity = df['velocity'].values
+    discount = gamma ** np.arange(len(df) - 1)
+    ratio = velocity[1:] / (velocity[:-1] + 0.2)
+    rewards = np.append(progress(df['distance_2finish'].values) * ratio * discount - punishment, 0.)
+    crashed, stuck = failed(df)
+    if crashed:
+        rewards[-2] = - (punishment + EXTRA_REWARD * gamma ** (df['step'].max() - 1))
+    elif stuck:
+        rewards[-2] = - (punishment + EXTRA_REWARD * gamma ** (df['step'].max() - (1 + 0.8 * SLOW_FRAMES)))
+    return rewards
+
+
+SCHEMES = {
+    'distance': distance_reward,
+    'velocity': velocity_reward,
+}
+
+
+def relabel(df:pd.DataFrame, scheme:str=None, gamma:float=GAMMA, punishment:float=0.01) -> pd.DataFrame:
+    '''
+    Recomputes reward (if scheme is given), done and q columns of the episode
+    :param df: pd.DataFrame, episode info
+    :param scheme: str, key of SCHEMES or None to keep saved rewards
+    :param gamma: float, discount factor of the reward scheme
+    :param punishment: float, constant punishment for every step
+    :return: pd.DataFrame with reward, done and q columns
+    '''
+    labels = pd.DataFrame(index=df.index)
+    labels['reward'] = SCHEMES[scheme](df, gamma=gamma, punishment=punishment) if scheme else df['reward'].values
+    dones = np.zeros(len(df), dtype=np.int64)
+    dones[-1] = 1
+    labels['done'] = dones
+    labels['q'] = discounted_returns(labels['reward'].values, dones=dones)
+    return labels
+
+
+def punishment_scheme(path:str, extra_reward:int=EXTRA_REWARD):
+    if 'RaceTrack2' in path:
+        return extra_reward/2897
+    elif 'circut_spa' in path:
+        return extra_reward/1313
+    else:
+        return extra_reward/3097
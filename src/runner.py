@@ -21,6 +21,10 @@ from config import DATA_PATH, FRAMERATE, GAMMA, SENSORS, VEHICLES, \
     CARLA_IP, MAP, NO_AGENTS, EXTRA_REWARD, DATA_POINTS, NUMERIC_FEATURES, FEATURES_FOR_BATCH, BATCH_SIZE
 
 from utils import save_info, update_Qvals, arg_bool, save_terminal_state
+from episode_log import close_writer, read_episode, write_episode
+from async_writer import get_async_writer
+from rewards import discounted_returns
+from manifest import EpisodeManifest
 
 
 def main():
@@ -228,10 +232,10 @@ def run_episode(client:carla.Client, controller:Controller, args) -> (dict, dict
         for idx, (state, action, reward, agent) in enumerate(zip(states, actions, rewards, environment.agents)):
             if agent.distance_2finish < 50:
                 print(f'agent {str(agent)} finished the race in {step} steps car {args.vehicle}')
-                step_info = save_info(path=agent.save_path, state=state, action=action, reward=EXTRA_REWARD*GAMMA**step)
+                step_info = save_info(path=agent.save_path, state=state, action=action, reward=EXTRA_REWARD*GAMMA**step, io=agent.io)
                 status[str(agent)] = 'Finished'
                 terminal_state = agent.get_state(step=step+1, retrieve_data=False)
-                save_terminal_state(path=agent.save_path, state=terminal_state, action=action)
+                save_terminal_state(path=agent.save_path, state=terminal_state, action=action, io=agent.io)
                 agent.destroy(data=True, step=step)
                 environment.agents.pop(idx)
                 continue
@@ -239,10 +243,10 @@ def run_episode(client:carla.Client, controller:Controller, args) -> (dict, dict
             elif agent.collision > 0:
                 print(f'failed, collision {str(agent)} at step {step}, car {args.vehicle}')
                 step_info = save_info(path=agent.save_path, state=state, action=action,
-                                      reward=reward - EXTRA_REWARD * (GAMMA ** step))
+                                      reward=reward - EXTRA_REWARD * (GAMMA ** step), io=agent.io)
                 status[str(agent)] = 'Collision'
                 terminal_state = agent.get_state(step=step+1, retrieve_data=False)
-                save_terminal_state(path=agent.save_path, state=terminal_state, action=action)
+                save_terminal_state(path=agent.save_path, state=terminal_state, action=action, io=agent.io)
                 agent.destroy(data=True, step=step)
                 environment.agents.pop(idx)
                 continue
@@ -251,28 +255,31 @@ def run_episode(client:carla.Client, controller:Controller, args) -> (dict, dict
                 if slow_frames[idx] > 100:
                     print(f'agent {str(agent)} stuck, finish on step {step}, car {args.vehicle}')
                     step_info = save_info(path=agent.save_path, state=state, action=action,
-                                          reward=reward - EXTRA_REWARD * (GAMMA ** step))
+                                          reward=reward - EXTRA_REWARD * (GAMMA ** step), io=agent.io)
                     status[str(agent)] = 'Stuck'
                     terminal_state = agent.get_state(step=step+1, retrieve_data=False)
                     terminal_state['collisions'] = 2500
-                    save_terminal_state(path=agent.save_path, state=terminal_state, action=action)
+                    save_terminal_state(path=agent.save_path, state=terminal_state, action=action, io=agent.io)
                     agent.destroy(data=True, step=step)
                     environment.agents.pop(idx)
                     continue
                 slow_frames[idx] += 1
 
-            step_info = save_info(path=agent.save_path, state=state, action=action, reward=reward)
+            step_info = save_info(path=agent.save_path, state=state, action=action, reward=reward, io=agent.io)
 
         if len(environment.agents) < 1:
             print('fini')
             break
 
-    if len(environment.agents) > 1:
+    if len(environment.agents) > 0:
         for agent in environment.agents:
             agent.destroy(data=True, step=NUM_STEPS)
 
+    manifest = EpisodeManifest()
     for (agent, info), path in zip(status.items(), save_paths):
-        df = pd.read_csv(f'{path}/episode_info.csv')
+        #Episode is written once, as a whole, by write_episode below
+        df = read_episode(path)
+        close_writer(path, save=False)
         if args.controller == 'MPC':
             idx = 26
             df.loc[:idx, 'steer'] = 0.
@@ -284,8 +291,13 @@ def run_episode(client:carla.Client, controller:Controller, args) -> (dict, dict
             df.loc[idx,'reward'] = 0.
             df.loc[idx,'done'] = 1.
         #Update qvalues
-        df['q'] = [sum(df['reward'][i:]) for i in range(df.shape[0])]
-        df.to_csv(f'{path}/episode_info.csv', index=False)
+        df['q'] = discounted_returns(df['reward'].values)
+        write_episode(path, df)
+        manifest.update(path, status=info)
+    manifest.close()
+
+    print(f'IO stats: {get_async_writer().stats()}')
+    get_async_writer().reset_stats()
 
     world.tick()
     world.tick()
@@ -15,7 +15,7 @@ from torchvision.transforms import transforms
 from control.nn_control import NNController
 from environment import Environment
 from net.ddpg_net import DDPGActor, DDPGCritic
-from net.utils import ReplayBuffer, get_paths, DepthPreprocess, DepthSegmentationPreprocess, ToReinforcement
+from net.utils import ReplayBuffer, PrioritizedReplayBuffer, get_paths, DepthPreprocess, DepthSegmentationPreprocess, ToReinforcement
 from spawn import df_to_spawn_points, numpy_to_transform, configure_simulation
 from control.mpc_control import MPCController
 from control.abstract_control import Controller
@@ -24,9 +24,14 @@ from control.abstract_control import Controller
 #Configs
 from config import DATA_PATH, FRAMERATE, GAMMA, SENSORS, VEHICLES, \
     CARLA_IP, MAP, NO_AGENTS, EXTRA_REWARD, DATA_POINTS, NUMERIC_FEATURES, FEATURES_FOR_BATCH, BATCH_SIZE, DATE_TIME, \
-    SLOW_FRAMES
+    SLOW_FRAMES, DEVICE
 
 from utils import save_info, update_Qvals, arg_bool, save_terminal_state
+from episode_log import close_writer, read_episode, write_episode
+from async_writer import get_async_writer
+from rewards import discounted_returns
+from manifest import EpisodeManifest
+from prefetch import BatchPrefetcher
 
 
 def parse_args():
@@ -97,7 +102,14 @@ def parse_args():
         metavar='C',
         default='MPC',
         type=str,
-        help='Avialable controllers: "MPC", "NN", Default: "MPC"')
+        help='Avialable controllers: "MPC", "NN", "policy" (evaluation of exported policy), Default: "MPC"')
+
+    argparser.add_argument(
+        '--policy',
+        default=None,
+        type=str,
+        dest='policy',
+        help='Policy exported with export_policy.py, used with "policy" controller')
 
     argparser.add_argument(
         '--speed',
@@ -161,6 +173,67 @@ def parse_args():
         type=str,
         help='Decides of putting MPC data to replay buffer, use only with Neural network, default: true')
 
+    argparser.add_argument(
+        '--capacity',
+        default=100_000,
+        type=int,
+        dest='capacity',
+        help='Replay buffer capacity, frames of the transitions are kept in memory (about 1.5 GiB per 100k)')
+
+    argparser.add_argument(
+        '--prefetch',
+        default=4,
+        type=int,
+        dest='prefetch',
+        help='Number of batches sampled ahead in background thread, 0 samples on the main thread')
+
+    argparser.add_argument(
+        '--shared_encoder',
+        default='False',
+        type=str,
+        help='Actor uses critic image encoder during training, features are computed once per batch, default: false')
+
+    argparser.add_argument(
+        '--hard_sync_every',
+        default=0,
+        type=int,
+        dest='hard_sync_every',
+        help='Copy weights to target nets every n updates instead of soft updates, 0 disables')
+
+    argparser.add_argument(
+        '--cpu_inference',
+        default='False',
+        type=str,
+        help='Choose actions with CPU inference copy of the actor (channels last), training stays on the controller '
+             'device and weights are copied to the copy after every update tick, default: false')
+
+    argparser.add_argument(
+        '--rebuild_every',
+        default=1,
+        type=int,
+        dest='rebuild_every',
+        help='Rebuild quantized CPU inference copy every n-th update tick, see --quantize')
+
+    argparser.add_argument(
+        '--threads',
+        default=None,
+        type=int,
+        dest='threads',
+        help='Number of intra-op threads of CPU inference, torch default if not set')
+
+    argparser.add_argument(
+        '--quantize',
+        default='False',
+        type=str,
+        help='Dynamic int8 quantization of linear layers of CPU inference copy, exported policies are quantized by '
+             'export_policy.py, default: false')
+
+    argparser.add_argument(
+        '--prioritized',
+        default='False',
+        type=str,
+        help='Use prioritized experience replay, use only with Neural network, default: false')
+
     # Logging configs
     argparser.add_argument(
         '--tensorboard',
@@ -180,6 +253,10 @@ def run_client(args):
     args.port = 2000
     args.invert = arg_bool(args.invert)
     args.random_init = arg_bool(args.random_init)
+    args.prioritized = arg_bool(args.prioritized)
+    args.shared_encoder = arg_bool(args.shared_encoder)
+    args.cpu_inference = arg_bool(args.cpu_inference)
+    args.quantize = arg_bool(args.quantize)
 
     print(vars(args))
 
@@ -196,14 +273,20 @@ def run_client(args):
         actor_path = '../data/models/rl/20200620_1237/NNController_dpoints4/DDPGActor.pt'
         critic_path = '../data/models/rl/20200620_1237/NNController_dpoints4/DDPGCritic.pt'
         actor_net = DDPGActor(img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)],
-                              output_shape=[2], linear_hidden=args.linear, conv_filters=args.conv, cuda=True)
-        actor_net.load_state_dict(torch.load(actor_path))
+                              output_shape=[2], linear_hidden=args.linear, conv_filters=args.conv,
+                              cuda=DEVICE.type == 'cuda')
+        actor_net.load_state_dict(torch.load(actor_path, map_location=DEVICE))
         critic_net = DDPGCritic(actor_out_shape=[2, ], img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)],
-                                linear_hidden=args.linear, conv_filters=args.conv, cuda=True)
-        critic_net.load_state_dict(torch.load(critic_path))
+                                linear_hidden=args.linear, conv_filters=args.conv, cuda=DEVICE.type == 'cuda')
+        critic_net.load_state_dict(torch.load(critic_path, map_location=DEVICE))
 
         controller = NNController(actor_net=actor_net, critic_net=critic_net, no_data_points=args.no_data,
-                                  features=NUMERIC_FEATURES, train=True, optimizer='adam', device='cuda:0')
+                                  features=NUMERIC_FEATURES, train=True, optimizer='adam', device=DEVICE,
+                                  shared_encoder=args.shared_encoder, hard_sync_every=args.hard_sync_every)
+        if args.cpu_inference:
+            #Weights change every tick, tracing a frozen graph after every update costs more than it saves
+            controller.cpu_inference(threads=args.threads, quantize=args.quantize, freeze=False,
+                                     rebuild_every=args.rebuild_every)
 
         controller_path = f'../data/models/rl/{DATE_TIME}/{controller}'
         os.makedirs(controller_path, exist_ok=True)
@@ -215,28 +298,38 @@ def run_client(args):
         torch.save(actor_net.state_dict(), f=f'{controller_path}/{actor_net.__class__.__name__}_initial.pt')
         torch.save(critic_net.state_dict(), f=f'{controller_path}/{critic_net.__class__.__name__}_initial.pt')
 
+    elif args.controller == 'policy':
+        #Inference only, neither critic nor optimizers are created
+        controller = NNController.from_policy(args.policy, device='cpu', epsilon=args.epsilon, threads=args.threads)
+        args.no_data = controller.no_data_points
+
+        controller_path = f'../data/models/rl/{DATE_TIME}/{controller}'
+        os.makedirs(controller_path, exist_ok=True)
+        json.dump(controller.dict(), fp=open(f'{controller_path}/controller.json', 'w'), sort_keys=True, indent=4)
+        writer = SummaryWriter(f'{controller_path}/writer', max_queue=30, flush_secs=5)
+
     else:
         print(args.controller)
         controller = None
         print('Unsuccesfull choice of controller, aborting')
         exit(1)
 
-    #TODO
-    # Initialize replay buffer
-    # Remember currently loaded dfs
-    transform = transforms.Compose([DepthSegmentationPreprocess(no_data_points=args.no_data), ToReinforcement()]) #TODO define
-    buffer = ReplayBuffer(capacity=100_000, features=FEATURES_FOR_BATCH, transform=transform,
-                          batch_size=BATCH_SIZE, **SENSORS)
-
-    if args.random_init:
-        samples = get_paths(as_tuples=True, shuffle=True, sensors=SENSORS, tag='MPC')
-        buffer._add_bulk(samples=samples)
-    prievous = []
+    # Initialize replay buffer, only NN controller trains from it
+    buffer = None
+    if args.controller == 'NN':
+        buffer_params = {'capacity': args.capacity, 'features': NUMERIC_FEATURES, 'no_data_points': args.no_data,
+                         'batch_size': BATCH_SIZE}
+        buffer = PrioritizedReplayBuffer(**buffer_params) if args.prioritized else ReplayBuffer(**buffer_params)
+
+    if args.random_init and args.controller == 'NN':
+        for path in np.random.permutation(sorted(get_paths(sensors=SENSORS, tag='MPC').keys())):
+            buffer.add_episode(path=str(path))
+    #Batches are sampled in background thread once the buffer is large enough for training
+    prefetcher = BatchPrefetcher(buffer, depth=args.prefetch, min_size=int(1e4)) \
+        if args.controller == 'NN' and args.prefetch > 0 else None
     max_avg_q = -1e10
     global_step = 0
     for i in range(args.episodes):
-        buffer._load_dfs(prievous=prievous)
-        prievous = buffer.df_paths
         print(args.generate)
         if args.generate > 0:
             args.invert = random.choice([True, False])
@@ -247,16 +340,25 @@ def run_client(args):
             episode_info, buffer, status, save_paths, global_step, ep_length = run_episode(client=client,
                                             controller=controller,
                                             buffer=buffer,
+                                            prefetcher=prefetcher,
                                             writer=writer,
                                             global_step=global_step,
                                             args=args)
-            if args.controller == 'NN':
+            if args.controller in ('NN', 'policy'):
                 print(f'Episode {i + 1} avg Q {episode_info["episode_q"]}')
                 writer.add_scalar(f'global/episode_q', scalar_value=episode_info['episode_q'], global_step=i)
                 writer.add_scalar(f'global/episode_length', scalar_value=ep_length, global_step=i)
-
-                writer.add_scalar(f'global/episode_actor_loss_v', scalar_value=episode_info['episode_actor_loss_v'], global_step=i)
-                writer.add_scalar(f'global/episode_critic_loss_v', scalar_value=episode_info['episode_critic_loss_v'], global_step=i)
+                finished = sum(actor_status == 'Finished' for actor_status in status.values()) / max(len(status), 1)
+                writer.add_scalar(f'global/finished', scalar_value=finished, global_step=i)
+                if args.controller == 'NN':
+                    writer.add_scalar(f'global/episode_actor_loss_v', scalar_value=episode_info['episode_actor_loss_v'], global_step=i)
+                    writer.add_scalar(f'global/episode_critic_loss_v', scalar_value=episode_info['episode_critic_loss_v'], global_step=i)
+                for key, value in episode_info['io'].items():
+                    writer.add_scalar(f'io/{key}', scalar_value=value, global_step=i)
+                for key, value in episode_info['prefetch'].items():
+                    writer.add_scalar(f'prefetch/{key}', scalar_value=value, global_step=i)
+                for key, value in episode_info['inference'].items():
+                    writer.add_scalar(f'inference/{key}', scalar_value=value, global_step=i)
 
             for (actor, status), path in zip(status.items(), save_paths):
                 print(f'Episode {i + 1} actor {actor} ended with status: {status}')
@@ -268,10 +370,13 @@ def run_client(args):
                 torch.save(controller.critic_net.state_dict(), f=f'{controller_path}/{controller.critic_net.__class__.__name__}.pt')
         except:
             print(f'Unsuccesfull episode {i}')
+    if prefetcher is not None:
+        prefetcher.stop()
 
 
 def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
-                writer:SummaryWriter, global_step:int, args) -> (ReplayBuffer, dict, dict):
+                writer:SummaryWriter, global_step:int, args, prefetcher:BatchPrefetcher=None,
+                weights=None) -> (ReplayBuffer, dict, dict):
     '''
     Runs single episode. Configures world and agent, spawns it on map and controlls it from start point to termination
     state.
@@ -283,6 +388,9 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
     :param writer: SummaryWriter, logger for tensorboard
     :param viz: visdom.Vis, other logger #refactor to one dictionary
     :param args: argparse.args, config #refactor to dict
+    :param buffer: ReplayBuffer, None if the controller doesn't train
+    :param prefetcher: BatchPrefetcher, source of training batches, buffer is sampled directly if None
+    :param weights: actor_learner.SharedWeights, actor weights published by the learner are pulled before every step
     :return: status:str, succes
              actor_dict -> speed, wheels turn, throttle, reward -> can be taken from actor?
              env_dict -> consecutive locations of actor, distances to closest spawn point, starting spawn point
@@ -331,8 +439,9 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
     agents_2pop = []
     for step in range(NUM_STEPS):
         local_step = step
-        states = [agent.get_state(step, retrieve_data=True) for agent in environment.agents]
-        actions = [agent.play_step(state) for agent, state in zip(environment.agents, states)]
+        if weights is not None and weights.pull(controller.actor_net) > 0:
+            controller.refresh_inference()
+        states, actions = environment.get_agents_states_actions(step, retrieve_data=True)
 
         world.tick()
         for agent in environment.agents:
@@ -349,11 +458,12 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
             if agent.distance_2finish < 50:
                 print(f'agent {str(agent)} finished the race in {step} steps car {args.vehicle}')
 
-                step_info = save_info(path=agent.save_path, state=state, action=action, reward=reward)
-                buffer.add_step(path=agent.save_path, step=step_info)
+                step_info = save_info(path=agent.save_path, state=state, action=action, reward=reward, io=agent.io)
+                if buffer is not None:
+                    buffer.add_step(path=agent.save_path, state=state, action=action, reward=step_info['reward'], done=1)
                 status[str(agent)] = 'Finished'
                 terminal_state = agent.get_state(step=step+1, retrieve_data=False)
-                save_terminal_state(path=agent.save_path, state=terminal_state, action=action)
+                save_terminal_state(path=agent.save_path, state=terminal_state, action=action, io=agent.io)
 
                 agent.destroy(data=True, step=step)
                 agents_2pop.append(idx)
@@ -362,11 +472,12 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
             elif agent.collision > 0:
                 print(f'failed, collision {str(agent)} at step {step}, car {args.vehicle}')
                 step_info = save_info(path=agent.save_path, state=state, action=action,
-                                      reward=reward - EXTRA_REWARD * (GAMMA ** step))
-                buffer.add_step(path=agent.save_path, step=step_info)
+                                      reward=reward - EXTRA_REWARD * (GAMMA ** step), io=agent.io)
+                if buffer is not None:
+                    buffer.add_step(path=agent.save_path, state=state, action=action, reward=step_info['reward'], done=1)
                 status[str(agent)] = 'Collision'
                 terminal_state = agent.get_state(step=step+1, retrieve_data=False)
-                save_terminal_state(path=agent.save_path, state=terminal_state, action=action)
+                save_terminal_state(path=agent.save_path, state=terminal_state, action=action, io=agent.io)
 
                 agent.destroy(data=True, step=step)
                 agents_2pop.append(idx)
@@ -376,32 +487,39 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
                 if slow_frames[idx] > SLOW_FRAMES:
                     print(f'agent {str(agent)} stuck, finish on step {step}, car {args.vehicle}')
                     step_info = save_info(path=agent.save_path, state=state, action=action,
-                                          reward=reward - EXTRA_REWARD * (GAMMA ** (step-0.8*SLOW_FRAMES)))
-                    buffer.add_step(path=agent.save_path, step=step_info)
+                                          reward=reward - EXTRA_REWARD * (GAMMA ** (step-0.8*SLOW_FRAMES)), io=agent.io)
+                    if buffer is not None:
+                        buffer.add_step(path=agent.save_path, state=state, action=action, reward=step_info['reward'],
+                                        done=1)
                     status[str(agent)] = 'Stuck'
                     terminal_state = agent.get_state(step=step+1, retrieve_data=False)
                     terminal_state['collisions'] = 2500
-                    save_terminal_state(path=agent.save_path, state=terminal_state, action=action)
+                    save_terminal_state(path=agent.save_path, state=terminal_state, action=action, io=agent.io)
                     agent.destroy(data=True, step=step)
                     agents_2pop.append(idx)
                     continue
                 slow_frames[idx] += 1
 
-            step_info = save_info(path=agent.save_path, state=state, action=action, reward=reward)
-            buffer.add_step(path=agent.save_path, step=step_info)
+            step_info = save_info(path=agent.save_path, state=state, action=action, reward=reward, io=agent.io)
+            if buffer is not None:
+                buffer.add_step(path=agent.save_path, state=state, action=action, reward=step_info['reward'])
 
         if args.controller == 'NN' and len(environment.agents) > 0 and len(buffer) > 1e4:
             actor_loss_avg = 0
             critic_loss_avg = 0
             for i in range(len(environment.agents)):
-                batch = buffer.sample()
-                actor_loss_v, critic_loss_v, q_ref_v = controller.train_on_batch(batch=batch, gamma=GAMMA)
+                batch = prefetcher.get() if prefetcher is not None else buffer.sample()
+                actor_loss_v, critic_loss_v, q_ref_v, td_errors = controller.train_on_batch(batch=batch, gamma=GAMMA)
+                if args.prioritized:
+                    buffer.update_priorities(batch['idx'], td_errors.cpu().numpy())
                 actor_loss_avg += actor_loss_v
                 critic_loss_avg += critic_loss_v
             episode_actor_loss_v += actor_loss_avg / (buffer.batch_size * len(environment.agents))
             episode_critic_loss_v += critic_loss_avg / (buffer.batch_size * len(environment.agents))
-            writer.add_scalar('local/actor_loss_v', scalar_value=actor_loss_avg/(buffer.batch_size * len(environment.agents)), global_step=global_step+local_step)
-            writer.add_scalar('local/critic_loss_v', scalar_value=critic_loss_avg/(buffer.batch_size * len(environment.agents)), global_step=global_step+local_step)
+            controller.refresh_inference()
+            #Losses stay on the device during updates and are read back once per tick for logging
+            writer.add_scalar('local/actor_loss_v', scalar_value=float(actor_loss_avg)/(buffer.batch_size * len(environment.agents)), global_step=global_step+local_step)
+            writer.add_scalar('local/critic_loss_v', scalar_value=float(critic_loss_avg)/(buffer.batch_size * len(environment.agents)), global_step=global_step+local_step)
 
         for idx in sorted(agents_2pop, reverse=True):
             environment.agents.pop(idx)
@@ -411,14 +529,17 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
             print('fini')
             break
 
-    if len(environment.agents) > 1:
+    if len(environment.agents) > 0:
         for agent in environment.agents:
             agent.destroy(data=True, step=NUM_STEPS)
     
     episode_q = 0
     
+    manifest = EpisodeManifest()
     for (agent, info), path in zip(status.items(), save_paths):
-        df = pd.read_csv(f'{path}/episode_info.csv')
+        #Episode is written once, as a whole, by write_episode below
+        df = read_episode(path)
+        close_writer(path, save=False)
         if args.controller == 'MPC':
             idx = 13
             df.loc[:idx, 'steer'] = 0.
@@ -431,16 +552,25 @@ def run_episode(client:carla.Client, controller:Controller, buffer:ReplayBuffer,
             df.loc[idx,'reward'] = 0. #TODO -> discuss if necessary
             df.loc[idx,'done'] = 1.
         #Update qvalues
-        df['q'] = [sum(df['reward'][i:]) for i in range(df.shape[0])]
+        df['q'] = discounted_returns(df['reward'].values)
         episode_q += sum(df['reward'])
-        df.to_csv(f'{path}/episode_info.csv', index=False)
+        write_episode(path, df)
+        manifest.update(path, status=info)
+    manifest.close()
 
     episode_q /= len(save_paths)
+    io_stats = get_async_writer().stats()
+    get_async_writer().reset_stats()
     episode_info = {
         'episode_q':episode_q,
-        'episode_actor_loss_v': episode_actor_loss_v / local_step,
-        'episode_critic_loss_v': episode_critic_loss_v / local_step
+        'episode_actor_loss_v': float(episode_actor_loss_v) / local_step,
+        'episode_critic_loss_v': float(episode_critic_loss_v) / local_step,
+        'io': io_stats,
+        'prefetch': prefetcher.stats() if prefetcher is not None else {},
+        'inference': environment.inference_stats()
     }
+    if prefetcher is not None:
+        prefetcher.reset_stats()
 
     world.tick()
     world.tick()
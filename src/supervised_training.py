@@ -2,13 +2,15 @@
 import argparse
 import json
 import os
+import time
+from itertools import islice
 from subprocess import check_call
 
 import numpy as np
 from torch.optim.lr_scheduler import CosineAnnealingLR, OneCycleLR, CosineAnnealingWarmRestarts
 from torch.utils.data import DataLoader
 
-from config import NUMERIC_FEATURES, DEVICE, DATE_TIME, SENSORS
+from config import NUMERIC_FEATURES, DEVICE, DATE_TIME, SENSORS, FRAME_CACHE_MB
 from net.ddpg_net import DDPGActor, DDPGCritic
 
 np.random.seed(48)
@@ -20,14 +22,27 @@ from torchvision import transforms
 from torch import multiprocessing as mp, nn
 from tensorboardX import SummaryWriter
 
+from checkpoint import CheckpointManager, training_state, restore, rng_state, set_rng_state
+from distributed import init_distributed, cleanup, rank_dataset, EpisodeSampler, rank_samples, min_batches, \
+    all_reduce_gradients, broadcast_state, all_reduce_sum, NullWriter
+from frame_cache import make_frame_cache
 from net.utils import get_paths, DepthPreprocess, ToSupervised, SimpleDataset, unpack_batch, get_n_params, \
-    DepthSegmentationPreprocess
+    DepthSegmentationPreprocess, ShardDataset, StreamingDataset, get_shards, autocast, \
+    GradientStats
 
 def main(args):
 
     args = parse_args()
+    state = None
+    if args.resume:
+        #Run continues with arguments, weights, optimizer and data order of the latest checkpoint
+        state = CheckpointManager.load_latest(f'{args.resume}/checkpoints')
+        args = argparse.Namespace(**{**state['args'], 'resume': args.resume})
     tag = args.tag
-    device = torch.device('cuda:0')
+    #Data parallel ranks started by launch_ddp.py train on CPU, every rank reads its own episodes
+    rank, world_size = init_distributed()
+    device = DEVICE if world_size == 1 else torch.device('cpu')
+    is_main = rank == 0
 
     no_epochs = args.epochs
     batch_size = args.batch
@@ -35,26 +50,57 @@ def main(args):
     linear_hidden = args.linear
     conv_hidden = args.conv
 
-    #Get train test paths -> later on implement cross val
-    steps = get_paths(as_tuples=True, shuffle=True, tag=tag)
-    steps_train, steps_test = steps[:int(len(steps)*.8)], steps[int(len(steps)*.2):]
-
-    transform = transforms.Compose([DepthSegmentationPreprocess(no_data_points=1), ToSupervised()])
-
-    dataset_train = SimpleDataset(ids=steps_train, batch_size=batch_size, transform=transform, **SENSORS)
-    dataset_test = SimpleDataset(ids=steps_test, batch_size=batch_size, transform=transform, **SENSORS)
-
-    dataloader_params = {'batch_size': batch_size, 'shuffle': True, 'num_workers': 8} #we've already shuffled paths
-
-    dataset_train = DataLoader(dataset_train, **dataloader_params)
-    dataset_test = DataLoader(dataset_test, **dataloader_params)
-
-    batch = next(iter(dataset_test))
+    cache = None
+    if args.shards:
+        #Shards are split by episodes, see build_shards.py
+        shards = get_shards(args.shards)
+        dataset_train = rank_dataset(ShardDataset(shards=shards[:int(len(shards)*.8)], shuffle=True), rank, world_size)
+        dataset_test = rank_dataset(ShardDataset(shards=shards[int(len(shards)*.8):], shuffle=False), rank, world_size)
+        steps = range(len(dataset_train) + len(dataset_test))
+        dataloader_params = {'batch_size': batch_size, 'num_workers': max(8 // world_size, 1)}
+        dataset_train = DataLoader(dataset_train, **dataloader_params)
+        dataset_test = DataLoader(dataset_test, **dataloader_params)
+    elif args.stream:
+        #Train test split by episodes, samples of one episode are streamed by one worker
+        episodes = get_paths(tag=tag)
+        paths = [str(path) for path in np.random.permutation(sorted(episodes.keys()))]
+        paths_train, paths_test = paths[:int(len(paths)*.8)], paths[int(len(paths)*.8):]
+        dataset_train = StreamingDataset({path: episodes[path] for path in paths_train}, no_data_points=1,
+                                         shuffle=True, shuffle_buffer_mb=args.shuffle_buffer_mb)
+        dataset_test = StreamingDataset({path: episodes[path] for path in paths_test}, no_data_points=1,
+                                        shuffle=False)
+        dataset_train = rank_dataset(dataset_train, rank, world_size)
+        dataset_test = rank_dataset(dataset_test, rank, world_size)
+        steps = range(len(dataset_train) + len(dataset_test))
+        dataloader_params = {'batch_size': batch_size, 'num_workers': max(8 // world_size, 1)}
+        dataset_train = DataLoader(dataset_train, **dataloader_params)
+        dataset_test = DataLoader(dataset_test, **dataloader_params)
+    else:
+        #Get train test paths -> later on implement cross val
+        steps = get_paths(as_tuples=True, shuffle=True, tag=tag)
+        steps_train, steps_test = steps[:int(len(steps)*.8)], steps[int(len(steps)*.2):]
+
+        cache = make_frame_cache(max_mb=args.cache_mb)
+        transform = transforms.Compose([DepthSegmentationPreprocess(no_data_points=1, cache=cache), ToSupervised()])
+
+        dataset_train = SimpleDataset(ids=steps_train, batch_size=batch_size, transform=transform, **SENSORS)
+        dataset_test = SimpleDataset(ids=steps_test, batch_size=batch_size, transform=transform, **SENSORS)
+
+        #EpisodeSampler shuffles by epoch, so resumed epochs start at the first untrained batch
+        dataloader_params = {'batch_size': batch_size, 'num_workers': max(8 // world_size, 1)}
+        dataset_train = DataLoader(dataset_train, **dataloader_params,
+                                   sampler=EpisodeSampler(dataset_train.ids, rank=rank, world_size=world_size))
+        dataset_test = DataLoader(dataset_test, **dataloader_params,
+                                  sampler=EpisodeSampler(dataset_test.ids, rank=rank, world_size=world_size,
+                                                         shuffle=False))
+
+    #Every rank has train samples, see rank_dataset
+    batch = next(iter(dataset_train))
     action_shape = batch['action'][0].shape
     img_shape = batch['img'][0].shape
     #Nets
     net = DDPGActor(img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)], output_shape=[2],
-                    linear_hidden=linear_hidden, conv_filters=conv_hidden)
+                    linear_hidden=linear_hidden, conv_filters=conv_hidden, cuda=device.type == 'cuda')
     # net = DDPGCritic(actor_out_shape=action_shape, img_shape=img_shape, numeric_shape=[len(NUMERIC_FEATURES)],
     #                         linear_hidden=linear_hidden, conv_filters=conv_filters)
 
@@ -62,16 +108,28 @@ def main(args):
     print(net)
     print(get_n_params(net))
     # save path
-    net_path = f'../data/models/imitation/{DATE_TIME}/{net.name}'
-    os.makedirs(net_path, exist_ok=True)
+    run_path = args.resume or f'../data/models/imitation/{DATE_TIME}'
+    net_path = f'{run_path}/{net.name}'
+    checkpoints = CheckpointManager(f'{run_path}/checkpoints', keep=args.keep_checkpoints, enabled=is_main)
     optim_steps = args.optim_steps
-    logging_idx = int(len(dataset_train.dataset) / (batch_size * optim_steps))
-
-    writer_train = SummaryWriter(f'{net_path}/train', max_queue=30, flush_secs=5)
-    writer_test = SummaryWriter(f'{net_path}/test', max_queue=1, flush_secs=5)
+    #All ranks run the same number of updates per epoch, limited by the rank with the fewest samples
+    train_batches = min_batches(rank_samples(dataset_train), batch_size) if world_size > 1 else None
+    train_samples = train_batches * batch_size if world_size > 1 else len(dataset_train.dataset)
+    test_samples = int(all_reduce_sum(rank_samples(dataset_test)))
+    test_batches = int(all_reduce_sum(len(dataset_test)))
+    logging_idx = int(train_samples / (batch_size * optim_steps))
+
+    if is_main:
+        os.makedirs(net_path, exist_ok=True)
+        writer_train = SummaryWriter(f'{net_path}/train', max_queue=30, flush_secs=5)
+        writer_test = SummaryWriter(f'{net_path}/test', max_queue=1, flush_secs=5)
+    else:
+        writer_train, writer_test = NullWriter(), NullWriter()
+    broadcast_state(net)
 
     #Optimizers
     optimizer = torch.optim.Adam(net.parameters(), lr=0.001, weight_decay=0.0005)
+    grad_stats = GradientStats(net, every=args.grad_log_every if is_main else 0)
 
     if args.scheduler == 'cos':
         scheduler = CosineAnnealingWarmRestarts(optimizer, T_0=optim_steps, T_mult=2)
@@ -86,47 +144,72 @@ def main(args):
     best_train_loss = 1e10
     best_test_loss = 1e10
 
-    for epoch_idx in range(no_epochs):
+    start_epoch, start_batch = 0, 0
+    if state is not None:
+        restore(state, net=net, optimizer=optimizer, scheduler=scheduler)
+        best_train_loss, best_test_loss = state['metrics']['best']
+        start_epoch, start_batch = state['position']['epoch'], state['position']['batch']
+
+    for epoch_idx in range(start_epoch, no_epochs):
         train_loss = .0
         running_loss = .0
         # critic_running_loss = .0
-        avg_max_grad = 0.
-        avg_avg_grad = 0.
-        for idx, batch in enumerate(iter(dataset_train)):
-            global_step = int((len(dataset_train.dataset) / batch_size * epoch_idx) + idx)
+        skip = 0
+        if state is not None and epoch_idx == start_epoch:
+            #Same shuffling as the interrupted epoch, already trained batches are skipped
+            set_rng_state(state['rng'])
+            train_loss, running_loss = state['metrics']['epoch']
+            skip = start_batch
+        #Skipped at the source, already trained batches are never loaded
+        if isinstance(dataset_train.dataset, (ShardDataset, StreamingDataset)):
+            dataset_train.dataset.set_epoch(epoch_idx, skip=skip, batch_size=batch_size)
+        if isinstance(dataset_train.sampler, EpisodeSampler):
+            dataset_train.sampler.set_epoch(epoch_idx, skip=skip, batch_size=batch_size)
+        epoch_rng = rng_state()
+        epoch_start = time.perf_counter()
+        for idx, batch in enumerate(islice(dataset_train, train_batches - skip if train_batches is not None else None),
+                                    start=skip):
+            global_step = int((train_samples / batch_size * epoch_idx) + idx)
             batch = unpack_batch(batch=batch, device=device)
-            loss, grad = train(input=batch, label=batch['action'], net=net, optimizer=optimizer, loss_fn=loss_function)
+            loss = train(input=batch, label=batch['action'], net=net, optimizer=optimizer, loss_fn=loss_function,
+                         bf16=args.bf16, grad_stats=grad_stats)
             # loss, grad = train(input=batch, label=batch['q'], net=net, optimizer=optimizer, loss_fn=loss_function)
 
-            avg_max_grad += max([element.max() for element in grad])
-            avg_avg_grad += sum([element.mean() for element in grad]) / len(grad)
-
             running_loss += loss
             train_loss += loss
 
             writer_train.add_scalar(tag=f'{net.name}/running_loss',
                                           scalar_value=loss/batch_size,
                                           global_step=global_step)
-            writer_train.add_scalar(tag=f'{net.name}/max_grad', scalar_value=avg_max_grad,
-                                          global_step=global_step)
-            writer_train.add_scalar(tag=f'{net.name}/mean_grad', scalar_value=avg_avg_grad,
-                                          global_step=global_step)
+            grad_stats.write(writer_train, global_step=global_step)
 
             if idx % logging_idx == logging_idx-1:
                 print(f'Actor Epoch: {epoch_idx + 1}, Batch: {idx+1}, Loss: {running_loss/logging_idx}, Lr: {scheduler.get_last_lr()[0]}')
                 if (running_loss/logging_idx) < best_train_loss:
                     best_train_loss = running_loss/logging_idx
-                    torch.save(net.state_dict(), f'{net_path}/train/train.pt')
+                    checkpoints.save_weights(net.state_dict(), f'{net_path}/train/train.pt')
 
                 writer_train.add_scalar(tag=f'{net.name}/lr', scalar_value=scheduler.get_last_lr()[0],
                                               global_step=global_step)
                 running_loss = 0.0
-                avg_max_grad = 0.
-                avg_avg_grad = 0.
                 scheduler.step()
 
+            if args.checkpoint_every and (idx + 1) % args.checkpoint_every == 0:
+                checkpoints.save(training_state(args, epoch=epoch_idx, batch=idx + 1, rng=epoch_rng,
+                                                metrics={'best': [best_train_loss, best_test_loss],
+                                                         'epoch': [train_loss, running_loss]},
+                                                net=net, optimizer=optimizer, scheduler=scheduler))
+
         print(f'{net.name} best train loss for epoch {epoch_idx+1} - {best_train_loss}')
-        writer_train.add_scalar(tag=f'{net.name}/global_loss', scalar_value=train_loss/len(dataset_train.dataset),
+        #Throughput next to the losses, so bf16 and fp32 runs can be compared
+        samples_per_s = train_samples * world_size / (time.perf_counter() - epoch_start)
+        print(f'Train throughput {samples_per_s:.1f} samples/s, {"bf16" if args.bf16 else "fp32"}')
+        writer_train.add_scalar(tag=f'{net.name}/samples_per_s', scalar_value=samples_per_s, global_step=(epoch_idx+1))
+        if cache is not None:
+            for key, value in cache.stats().items():
+                writer_train.add_scalar(tag=f'cache/{key}', scalar_value=value, global_step=(epoch_idx+1))
+            print(f'Frame cache: {cache.stats()}')
+        writer_train.add_scalar(tag=f'{net.name}/global_loss', scalar_value=train_loss/train_samples,
                                       global_step=(epoch_idx+1))
         test_loss = .0
         with torch.no_grad():
@@ -137,16 +220,25 @@ def main(args):
                 # loss = test_loss_function(pred.view(-1), batch['q'])
 
                 test_loss += loss
+        test_loss = all_reduce_sum(test_loss)
 
-        if (test_loss / len(dataset_test)) < best_test_loss:
-            best_test_loss = (test_loss / len(dataset_test))
+        if (test_loss / test_batches) < best_test_loss:
+            best_test_loss = (test_loss / test_batches)
 
-        torch.save(net.state_dict(), f'{net_path}/test/test_{epoch_idx+1}.pt')
+        checkpoints.save_weights(net.state_dict(), f'{net_path}/test/test_{epoch_idx+1}.pt')
 
-        print(f'{net.name} test loss {(test_loss/len(dataset_test)):.3f}')
+        print(f'{net.name} test loss {(test_loss/test_batches):.3f}')
         print(f'{net.name} best test loss {best_test_loss:.3f}')
-        writer_test.add_scalar(tag=f'{net.name}/global_loss', scalar_value=(test_loss/len(dataset_test.dataset)),
+        writer_test.add_scalar(tag=f'{net.name}/global_loss', scalar_value=(test_loss/test_samples),
                                      global_step=(epoch_idx + 1))
+        checkpoints.save(training_state(args, epoch=epoch_idx + 1, batch=0, rng=rng_state(),
+                                        metrics={'best': [best_train_loss, best_test_loss], 'epoch': [.0, .0]},
+                                        net=net, optimizer=optimizer, scheduler=scheduler))
+
+    checkpoints.close()
+    cleanup()
+    if not is_main:
+        return None
 
     torch.save(optimizer.state_dict(), f=f'{net_path}/{optimizer.__class__.__name__}.pt')
     torch.save(scheduler.state_dict(), f=f'{net_path}/{scheduler.__class__.__name__}.pt')
@@ -166,7 +258,8 @@ def main(args):
 
 
 
-def train(input:dict, label:torch.Tensor, net:nn.Module, optimizer:torch.optim.Optimizer, loss_fn:torch.nn.MSELoss):
+def train(input:dict, label:torch.Tensor, net:nn.Module, optimizer:torch.optim.Optimizer, loss_fn:torch.nn.MSELoss,
+          bf16:bool=False, grad_stats:GradientStats=None):
     '''
 
     :param input:
@@ -174,19 +267,24 @@ def train(input:dict, label:torch.Tensor, net:nn.Module, optimizer:torch.optim.O
     :param net:
     :param optimizer:
     :param device:
+    :param bf16: bool, forward pass in bfloat16 autocast, loss in float32
+    :param grad_stats: GradientStats, updated with gradients before clipping
     :return:
     '''
     optimizer.zero_grad()
-    y_pred = net(**input).view(-1)
-    loss = loss_fn(y_pred, label.view(-1))
+    with autocast(bf16, device=label.device):
+        y_pred = net(**input).view(-1)
+    loss = loss_fn(y_pred.float(), label.view(-1))
     loss.backward()
+    all_reduce_gradients(net.parameters())
     # loss_weighted = (loss * (loss / (loss.sum()/2))).sum().mean()
     # loss_weighted.backward()
+    if grad_stats is not None:
+        grad_stats.update()
     nn.utils.clip_grad_value_(net.parameters(), 1.5)
-    grad = [p.detach().cpu().abs() for p in net.parameters()]
     optimizer.step()
 
-    return loss.detach().cpu(), grad
+    return loss.detach()
 
 
 def parse_args():
@@ -231,6 +329,58 @@ def parse_args():
         default=None,
         dest='tag',
         help='Filter for dataset')
+    argparser.add_argument(
+        '--resume',
+        default=None,
+        type=str,
+        dest='resume',
+        help='Run directory to resume from its latest checkpoint, e.g. ../data/models/imitation/20200601_1200')
+    argparser.add_argument(
+        '--checkpoint_every',
+        default=500,
+        type=int,
+        dest='checkpoint_every',
+        help='Checkpoint every n-th batch, checkpoints are also written after every epoch, 0 only after epochs')
+    argparser.add_argument(
+        '--keep_checkpoints',
+        default=3,
+        type=int,
+        dest='keep_checkpoints',
+        help='Number of kept checkpoints, 0 keeps all')
+    argparser.add_argument(
+        '--grad_log_every',
+        default=10,
+        type=int,
+        dest='grad_log_every',
+        help='Log gradient norms, max and mean every n-th batch, 0 disables gradient stats')
+    argparser.add_argument(
+        '--bf16',
+        action='store_true',
+        dest='bf16',
+        help='bfloat16 autocast of forward and backward passes, weights stay in float32, requires torch >= 1.10 '
+             '(environment.yml pins torch 1.5)')
+    argparser.add_argument(
+        '--shards',
+        default=None,
+        dest='shards',
+        help='Directory with shards built by build_shards.py with --no_data=1, replaces --tag')
+    argparser.add_argument(
+        '--stream',
+        action='store_true',
+        dest='stream',
+        help='Stream whole episodes sequentially instead of random access to steps')
+    argparser.add_argument(
+        '--shuffle_buffer_mb',
+        default=128,
+        type=int,
+        dest='shuffle_buffer_mb',
+        help='Memory limit of shuffle buffers of all workers in MB, buffers keep uint8 frames, used with --stream')
+    argparser.add_argument(
+        '--cache_mb',
+        default=FRAME_CACHE_MB,
+        type=int,
+        dest='cache_mb',
+        help='Size of shared cache of decoded frames in MB, 0 disables it')
     args = argparser.parse_known_args()
     if len(args) > 1:
         args = args[0]
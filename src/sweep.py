@@ -0,0 +1,362 @@
+#Script for hyperparameter sweeps of DDPGActor imitation training. Dataset is decoded once into shared memory,
+#trials train concurrently on partitioned cores and trials falling behind are stopped by successive halving
+import argparse
+import itertools
+import json
+import os
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import multiprocessing as mp
+from torch.optim.lr_scheduler import OneCycleLR, CosineAnnealingWarmRestarts
+
+from config import DATE_TIME, DATA_POINTS
+from net.ddpg_net import DDPGActor
+from net.utils import get_paths, episode_windows, get_n_params, stack_windows
+from supervised_training import train
+
+#Shared dataset of pool workers, set by init_worker
+_dataset = {}
+
+
+def decode_episode(path:str, no_data_points:int=DATA_POINTS) -> dict:
+    '''
+    :param path: str, path to experiment folder
+    :param no_data_points: int, number of stacked frames
+    :return: dict, uint8 (depth + segmentation) 'frames' stored once, 'frame_start' of the window of every step
+    in the episode frames, 'x_numeric' and 'action' of all steps of the episode, see episode_windows
+    '''
+    frames, frame_start, samples = episode_windows(path, no_data_points=no_data_points)
+    return {'frames': frames, 'frame_start': frame_start,
+            **{key: value for key, value in samples.items() if key in ('x_numeric', 'action')}}
+
+
+def load_dataset(tag:str=None, cache:str=None, workers:int=1, no_data_points:int=DATA_POINTS) -> dict:
+    '''
+    Decodes all episodes once (in parallel) or loads them from cache and moves them to shared memory,
+    frames stay uint8 and are stacked and normalized per batch
+    :param tag: str, filter for episode paths
+    :param cache: str, .npz file with decoded dataset, written if it doesn't exist
+    :param workers: int, number of decoding processes
+    :param no_data_points: int, number of stacked frames
+    :return: dict, key -> shared torch.Tensor, 'frame_start' indexes windows in 'frames',
+    'episode' is index of the episode of every sample
+    '''
+    if cache is not None and os.path.exists(cache):
+        data = dict(np.load(cache))
+        assert int(data.pop('no_data_points', -1)) == no_data_points, \
+            f'{cache} was decoded with other --no_data or without frame windows, remove it to decode again'
+    else:
+        paths = sorted(str(path) for path in get_paths(tag=tag))
+        with mp.get_context('spawn').Pool(workers) as pool:
+            episodes = pool.map(partial(decode_episode, no_data_points=no_data_points), paths, chunksize=1)
+        episodes = [episode for episode in episodes if len(episode['frame_start']) > 0]
+        offsets = np.cumsum([0] + [len(episode['frames']) for episode in episodes[:-1]])
+        data = {key: np.concatenate([episode[key] for episode in episodes])
+                for key in ('frames', 'x_numeric', 'action')}
+        data['frame_start'] = np.concatenate([episode['frame_start'] + offset
+                                              for episode, offset in zip(episodes, offsets)])
+        data['episode'] = np.concatenate([np.full(len(episode['action']), idx)
+                                          for idx, episode in enumerate(episodes)])
+        if cache is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+            np.savez(cache, no_data_points=no_data_points, **data)
+    return {key: torch.from_numpy(value).share_memory_() for key, value in data.items()}
+
+
+def split_dataset(episode:torch.Tensor, seed:int=48, train_size:float=.8) -> (np.array, np.array):
+    '''
+    Train test split by episodes, same for all trials
+    :return: (np.array, np.array), train and test sample indexes
+    '''
+    episodes = np.random.RandomState(seed).permutation(int(episode.max()) + 1)
+    train_mask = np.isin(episode.numpy(), episodes[:int(len(episodes) * train_size)])
+    return np.flatnonzero(train_mask), np.flatnonzero(~train_mask)
+
+
+def make_batch(data:dict, idx:torch.Tensor, no_data_points:int) -> dict:
+    '''
+    Stacks frame windows of the samples like ShardDataset
+    :return: dict, batch with min/max normalized float images, same values as normalize of single samples
+    '''
+    windows = data['frames'].numpy()[data['frame_start'][idx].numpy()[:, np.newaxis] + np.arange(no_data_points)]
+    img = torch.from_numpy(stack_windows(windows)).float()
+    flat = img.view(len(idx), -1)
+    flat -= flat.min(dim=1, keepdim=True)[0]
+    flat /= flat.max(dim=1, keepdim=True)[0]
+    return {'img': img, 'x_numeric': data['x_numeric'][idx], 'action': data['action'][idx]}
+
+
+def init_worker(data:dict, threads:int, slots) -> None:
+    '''
+    Pins every pool worker to its own slice of cores
+    :param data: dict, shared dataset
+    :param threads: int, number of cores of the worker
+    :param slots: multiprocessing.Value, counter of started workers
+    '''
+    with slots.get_lock():
+        slot = slots.value
+        slots.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        start = slot * threads % len(cores)
+        os.sched_setaffinity(0, cores[start:start + threads] or cores)
+    torch.set_num_threads(threads)
+    _dataset.update(data)
+
+
+def build_trial(trial:dict, img_shape:list, numeric_shape:list, epochs:int,
+                optim_steps:int) -> (DDPGActor, torch.optim.Optimizer, object):
+    net = DDPGActor(img_shape=img_shape, numeric_shape=numeric_shape, output_shape=[2],
+                    linear_hidden=trial['linear'], conv_filters=trial['conv'], cuda=False)
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.001, weight_decay=0.0005)
+    if trial['scheduler'] == 'cos':
+        scheduler = CosineAnnealingWarmRestarts(optimizer, T_0=optim_steps, T_mult=2)
+    else:
+        scheduler = OneCycleLR(optimizer, max_lr=0.001, epochs=epochs, steps_per_epoch=optim_steps)
+    return net, optimizer, scheduler
+
+
+def evaluate(net:DDPGActor, data:dict, indexes:np.array, batch_size:int, no_data_points:int) -> float:
+    loss_fn = torch.nn.MSELoss(reduction='sum')
+    test_loss = .0
+    net.eval()
+    with torch.no_grad():
+        for idx in torch.from_numpy(indexes).split(batch_size):
+            batch = make_batch(data, idx, no_data_points=no_data_points)
+            test_loss += float(loss_fn(net(**batch), batch['action']))
+    net.train()
+    return test_loss / max(len(indexes), 1)
+
+
+def run_trial(job:tuple) -> dict:
+    '''
+    Trains trial from its checkpoint up to the epoch budget of the rung, runs in pool worker
+    :param job: tuple, (trial, budget, settings) where trial is dict of hyperparameters and epochs trained so far
+    :return: dict, name and history of the trial
+    '''
+    trial, budget, settings = job
+    data = _dataset
+    path = f'{settings["path"]}/{trial["name"]}'
+    os.makedirs(path, exist_ok=True)
+    train_idx, test_idx = split_dataset(data['episode'], seed=settings['seed'])
+    batch_size = trial['batch']
+    batches_per_epoch = len(train_idx) // batch_size
+    logging_idx = max(batches_per_epoch // settings['optim_steps'], 1)
+
+    torch.manual_seed(settings['seed'])
+    #Frames are (H, W, C) and stacked along width, see stack_windows
+    height, width, channels = data['frames'].shape[1:]
+    img_shape = [channels, height, width * settings['no_data']]
+    net, optimizer, scheduler = build_trial(trial, img_shape=img_shape,
+                                            numeric_shape=[data['x_numeric'].shape[1]], epochs=settings['epochs'],
+                                            optim_steps=settings['optim_steps'])
+    history = []
+    if trial['epochs'] > 0:
+        state = torch.load(f'{path}/state.pt')
+        net.load_state_dict(state['net'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        history = state['history']
+
+    loss_fn = torch.nn.MSELoss(reduction='sum')
+    for epoch_idx in range(trial['epochs'], budget):
+        #Full batches only, like SimpleDataset
+        order = np.random.RandomState(settings['seed'] + epoch_idx).permutation(train_idx)
+        order = torch.from_numpy(order[:batches_per_epoch * batch_size])
+        train_loss = .0
+        start = time.perf_counter()
+        for idx, batch_idx in enumerate(order.split(batch_size)):
+            batch = make_batch(data, batch_idx, no_data_points=settings['no_data'])
+            train_loss += train(input=batch, label=batch['action'], net=net, optimizer=optimizer, loss_fn=loss_fn,
+                                bf16=settings['bf16'])
+            if idx % logging_idx == logging_idx-1 and scheduler.last_epoch < scheduler_steps(scheduler, settings):
+                scheduler.step()
+        samples_per_s = len(order) / (time.perf_counter() - start)
+        history.append({'epoch': epoch_idx + 1, 'train_loss': float(train_loss) / max(len(order), 1),
+                        'test_loss': evaluate(net, data, test_idx, batch_size, settings['no_data']),
+                        'samples_per_s': samples_per_s})
+
+    torch.save({'net': net.state_dict(), 'optimizer': optimizer.state_dict(), 'scheduler': scheduler.state_dict(),
+                'history': history}, f'{path}/state.pt')
+    return {'name': trial['name'], 'history': history, 'params': get_n_params(net)}
+
+
+def scheduler_steps(scheduler, settings:dict) -> float:
+    '''
+    :return: float, OneCycleLR can't be stepped more than epochs * steps_per_epoch times
+    '''
+    if isinstance(scheduler, OneCycleLR):
+        return settings['epochs'] * settings['optim_steps']
+    return float('inf')
+
+
+def rung_budgets(min_epochs:int, max_epochs:int, eta:int) -> list:
+    '''
+    :return: list, epochs trained by surviving trials at every rung, e.g. [1, 2, 4, 8]
+    '''
+    budgets = [min_epochs]
+    while budgets[-1] * eta < max_epochs:
+        budgets.append(budgets[-1] * eta)
+    return budgets + [max_epochs] if budgets[-1] < max_epochs else budgets
+
+
+def main(args):
+    sweep_path = f'../data/models/sweeps/{DATE_TIME}'
+    os.makedirs(sweep_path, exist_ok=True)
+    json.dump(vars(args), fp=open(f'{sweep_path}/args.json', 'w'), sort_keys=True, indent=4)
+
+    trials = [{'name': f'trial{idx}_c{conv}_l{linear}_b{batch}_{scheduler}', 'conv': conv, 'linear': linear,
+               'batch': batch, 'scheduler': scheduler, 'epochs': 0, 'status': 'running'}
+              for idx, (conv, linear, batch, scheduler)
+              in enumerate(itertools.product(args.conv, args.linear, args.batch, args.scheduler))]
+    workers = min(args.workers or os.cpu_count(), len(trials))
+    threads = max(os.cpu_count() // workers, 1)
+
+    start = time.perf_counter()
+    data = load_dataset(tag=args.tag, cache=args.data_cache, workers=workers, no_data_points=args.no_data)
+    print(f'Dataset of {len(data["action"])} samples decoded in {time.perf_counter() - start:.1f} s, '
+          f'{data["frames"].numel() / 2**20:.1f} MB of shared frames, {args.no_data} stacked frames per sample')
+
+    settings = {'path': sweep_path, 'seed': args.seed, 'epochs': args.epochs, 'optim_steps': args.optim_steps,
+                'bf16': args.bf16, 'no_data': args.no_data}
+    results = {trial['name']: {} for trial in trials}
+    alive = trials
+    ctx = mp.get_context('spawn')
+    print(f'{len(trials)} trials on {workers} workers with {threads} threads each')
+    with ctx.Pool(workers, initializer=init_worker, initargs=(data, threads, ctx.Value('i', 0))) as pool:
+        for rung, budget in enumerate(rung_budgets(args.min_epochs, args.epochs, args.eta)):
+            for result in pool.imap_unordered(run_trial, [(trial, budget, settings) for trial in alive]):
+                results[result['name']] = result
+            for trial in alive:
+                trial['epochs'] = budget
+            alive = sorted(alive, key=lambda trial: results[trial['name']]['history'][-1]['test_loss'])
+            print(f'Rung {rung}, {budget} epochs: ' + ', '.join(
+                f'{trial["name"]} {results[trial["name"]]["history"][-1]["test_loss"]:.4f}' for trial in alive))
+            if budget == args.epochs:
+                break
+            #Successive halving, only 1/eta of the trials train for the next budget
+            for trial in alive[max(len(alive) // args.eta, 1):]:
+                trial['status'] = f'stopped at rung {rung}'
+            alive = alive[:max(len(alive) // args.eta, 1)]
+    for trial in alive:
+        trial['status'] = 'finished'
+
+    table = []
+    for trial in trials:
+        history = pd.DataFrame(results[trial['name']]['history'])
+        table.append({**{key: trial[key] for key in ('name', 'conv', 'linear', 'batch', 'scheduler', 'epochs', 'status')},
+                      'params': results[trial['name']]['params'],
+                      'test_loss': history['test_loss'].iloc[-1],
+                      'best_test_loss': history['test_loss'].min(),
+                      'train_loss': history['train_loss'].iloc[-1],
+                      'samples_per_s': history['samples_per_s'].mean()})
+    table = pd.DataFrame(table).sort_values(['epochs', 'test_loss'], ascending=[False, True])
+    table.to_csv(f'{sweep_path}/results.csv', index=False)
+    print(table.to_string(index=False))
+    print(f'Sweep finished in {time.perf_counter() - start:.1f} s, results in {sweep_path}/results.csv')
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        '-c', '--conv',
+        default=[64],
+        nargs='+',
+        type=int,
+        dest='conv',
+        help='Conv hidden sizes')
+    argparser.add_argument(
+        '-l', '--linear',
+        default=[128],
+        nargs='+',
+        type=int,
+        dest='linear',
+        help='Linear hidden sizes')
+    argparser.add_argument(
+        '--no_data',
+        default=DATA_POINTS,
+        type=int,
+        dest='no_data',
+        help='Number of stacked frames, same for all trials')
+    argparser.add_argument(
+        '--batch',
+        default=[128],
+        nargs='+',
+        type=int,
+        dest='batch',
+        help='Batch sizes')
+    argparser.add_argument(
+        '--scheduler',
+        default=['cos'],
+        nargs='+',
+        choices=['cos', 'one_cycle'],
+        dest='scheduler',
+        help='Learning rate schedulers')
+    argparser.add_argument(
+        '-e', '--epochs',
+        default=8,
+        type=int,
+        dest='epochs',
+        help='Max number of epochs of a trial')
+    argparser.add_argument(
+        '--min_epochs',
+        default=1,
+        type=int,
+        dest='min_epochs',
+        help='Number of epochs of all trials before the first halving')
+    argparser.add_argument(
+        '--eta',
+        default=2,
+        type=int,
+        dest='eta',
+        help='Halving rate, 1/eta of the trials is kept at every rung')
+    argparser.add_argument(
+        '--optim_steps',
+        default=16,
+        type=int,
+        dest='optim_steps',
+        help='Number of scheduler steps per epoch')
+    argparser.add_argument(
+        '--workers',
+        default=None,
+        type=int,
+        dest='workers',
+        help='Number of concurrent trials, cores are divided between them, by default one per core')
+    argparser.add_argument(
+        '--tag',
+        default=None,
+        dest='tag',
+        help='Filter for dataset')
+    argparser.add_argument(
+        '--data_cache',
+        default=None,
+        dest='data_cache',
+        help='.npz file with decoded dataset, written on first use')
+    argparser.add_argument(
+        '--seed',
+        default=48,
+        type=int,
+        dest='seed',
+        help='Seed of train test split, init and shuffling, same for all trials')
+    argparser.add_argument(
+        '--bf16',
+        action='store_true',
+        dest='bf16',
+        help='bfloat16 autocast of forward and backward passes, weights stay in float32, requires torch >= 1.10 '
+             '(environment.yml pins torch 1.5)')
+    args = argparser.parse_known_args()
+    if len(args) > 1:
+        args = args[0]
+
+    return args
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except KeyboardInterrupt:
+        print('Interrupted by user! Bye.')
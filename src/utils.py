@@ -10,6 +10,9 @@ from tensorboardX import SummaryWriter
 
 from config import IMAGE_DOWNSIZE_FACTOR, DATE_TIME, IMAGE_SIZE, EXTRA_REWARD, GAMMA
 from spawn import location_to_numpy, calc_azimuth
+from episode_log import open_writer, get_writer, read_episode, write_episode
+from async_writer import AsyncWriter
+from rewards import discounted_returns, distance_reward, velocity_reward, punishment_scheme
 
 to_rgb_pil = lambda img: Image.frombuffer(mode='RGBA', size=IMAGE_SIZE, data=img.raw_data.tobytes()).convert('RGB')
 to_array = lambda img: np.asarray(img.raw_data, dtype=np.int8).reshape(img.height, img.width, 4)  # 4 because image is in BRGB format
@@ -149,47 +152,42 @@ def init_reporting(path:str, sensors:dict) -> None:
     :return: None
     '''
 
-    if len(path.split('/')) > 1:
-        os.makedirs(name='/'.join(path.split('/')), exist_ok=True)
-
-    header = 'step'
-    sensors_header = ','.join([f'{k * v}_indexes' for k,v in sensors.items() if k is not 'collisions'])
+    sensors_header = [f'{k}_indexes' for k,v in sensors.items() if v and k != 'collisions']
     if 'collisions' in sensors.keys():
-        sensors_header = f'{sensors_header},collisions'
-    header = f'{header},{sensors_header}'
-    # header = f'{header},velocity,velocity_vec,yaw,location,distance_2finish,steer,gas_brake,reward\n'
-    header = f'{header},state_steer,state_gas_brake,velocity,velocity_vec,yaw,location,distance_2finish,steer,gas_brake,reward\n'
+        sensors_header.append('collisions')
+    header = ['step', *sensors_header, 'state_steer', 'state_gas_brake', 'velocity', 'velocity_vec', 'yaw',
+              'location', 'distance_2finish', 'steer', 'gas_brake', 'reward']
 
-    with open(f'{path}/episode_info.csv', 'w+') as file:
-        file.write(header)
+    open_writer(path=path, columns=header)
     print('Init succesfull')
 
 
-def save_info(path:str, state:dict, action:dict, reward:float, done:int=0) -> pd.DataFrame:
+def save_info(path:str, state:dict, action:dict, reward:float, done:int=0, io:AsyncWriter=None) -> dict:
     '''
-    Appends information after every step about state, actions and received reward
+    Appends information after every step about state, actions and received reward to the episode writer buffer
     :param path: str, path to experiment folder
     :param state: dict, state dictionary
     :param action:dict, action dictionary
     :param reward: float, reward value
-    :return: None
+    :param io: AsyncWriter, if provided row is appended in the background
+    :return: dict, saved row
     '''
     info = {**state, **action, 'reward':reward, 'done':done}
-    # info = {**state, **action, 'reward':reward}
-    info = pd.DataFrame().from_dict({k:[v] for k,v in info.items() if 'data' not in k})
-    info_csv = info.to_csv(index=False, header=False)
-    with open(f'{path}/episode_info.csv', 'a') as file:
-        file.write(info_csv)
+    info = {k:v for k,v in info.items() if 'data' not in k}
+    if io is not None:
+        io.submit(path, get_writer(path).append, info)
+    else:
+        get_writer(path).append(info)
 
     return info
 
 
-def save_terminal_state(path:str, state:dict, action:dict):
+def save_terminal_state(path:str, state:dict, action:dict, io:AsyncWriter=None):
     action['steer'] = 0.
     action['gas_brake'] = 0.
     if 'q_pred' in list(action.keys()):
         action['q_pred'] = 0.
-    save_info(path=path, state=state, action=action, reward=0, done=1)
+    save_info(path=path, state=state, action=action, reward=0, done=1, io=io)
 
 
 def update_Qvals(path:str) -> None:
@@ -198,9 +196,9 @@ def update_Qvals(path:str) -> None:
     :param path:
     :return:
     '''
-    df = pd.read_csv(f'{path}/episode_info.csv')
-    df['q'] = [sum(df['reward'][i:]) for i in range(df.shape[0])]
-    df.to_csv(f'{path}/episode_info.csv', index=False)
+    df = read_episode(path)
+    df['q'] = discounted_returns(df['reward'].values)
+    write_episode(path, df)
 
 
 def plot_gray(img):
@@ -222,10 +220,10 @@ def arg_bool(arg:str):
 
 
 def clean_mpc_bias(path, save:bool=False):
-    df = pd.read_csv(f'{path}/episode_info.csv')
-    df[:24]['steer'] = [0. for i in range(24)]
+    df = read_episode(path)
+    df.loc[:23, 'steer'] = 0.
     if save:
-        df.to_csv(f'{path}/episode_info.csv', index=False)
+        write_episode(path, df)
     else:
         return df
 
@@ -241,59 +239,21 @@ def add_dones_and_terminal_state(df:pd.DataFrame, path:str=None):
     df.loc[len(df) - 1, 'steer'] = .0
     df.loc[len(df) - 1, 'gas_brake'] = .0
     df.loc[len(df) - 1, 'q'] = .0
-    dones = [0 for i in range(len(df)-1)] + [1]
+    dones = np.zeros(len(df), dtype=np.int64)
+    dones[-1] = 1
     df['done'] = dones
-    df['q'] = [sum(df['reward'][i:]) for i in range(df.shape[0])]
+    df['q'] = discounted_returns(df['reward'].values)
     if path:
-        df.to_csv(f'{path}/episode_info.csv', index=False)
+        write_episode(path, df)
     else:
         return df
 
 def change_reward_scheme(df:pd.DataFrame, gamma: float = GAMMA, punishment:float=0.01) -> pd.DataFrame:
-
-    def reward(dist, next_dist):
-        if dist > next_dist:
-            return 1
-        elif dist == next_dist:
-            return 0
-        else:
-            return -1
-    rewards = [reward(df.loc[i, 'distance_2finish'], df.loc[i+1, 'distance_2finish'])*gamma**i - punishment
-               for i in range(len(df)-1)] + [0]
-    if (max(df['step']) > 3499) or max(df['collisions']) > 0 or len(df[df['velocity']<10]) > 100:
-        rewards[-2] = - (punishment + EXTRA_REWARD * gamma**max((df['step'])-1))
-    df['reward'] = rewards
-    qs = [sum(df.loc[i:, 'reward']) for i in range(len(df))]
-    df['q'] = qs
+    df['reward'] = distance_reward(df, gamma=gamma, punishment=punishment)
+    df['q'] = discounted_returns(df['reward'].values)
     return df
 
 def velocity_reward_scheme(df:pd.DataFrame, gamma: float = GAMMA, punishment:float=0.01) -> pd.DataFrame:
-
-    def reward(dist, next_dist, velocity, next_velocity):
-        if dist > next_dist:
-            return next_velocity/(velocity+0.2)
-        elif dist == next_dist:
-            return 0
-        else:
-            return -next_velocity/(velocity+0.2)
-    rewards = [reward(df.loc[i, 'distance_2finish'], df.loc[i+1, 'distance_2finish'],
-                      df.loc[i, 'velocity'], df.loc[i+1, 'velocity'])*gamma**i - punishment
-               for i in range(len(df)-1)] + [0]
-    if (max(df['step']) > 3499) or max(df['collisions']) > 0:
-        rewards[-2] = - (punishment + EXTRA_REWARD * gamma**max((df['step'])-1))
-    elif len(df[df['velocity']<10]) > 100:
-        rewards[-2] = - (punishment + EXTRA_REWARD * gamma ** max((df['step']) - (1+0.8*SLOW_FRAMES)))
-    df['reward'] = rewards
-    qs = [sum(df.loc[i:, 'reward']) for i in range(len(df))]
-    df['q'] = qs
+    df['reward'] = velocity_reward(df, gamma=gamma, punishment=punishment)
+    df['q'] = discounted_returns(df['reward'].values)
     return df
-
-
-def punishment_scheme(path:str, extra_reward:int=EXTRA_REWARD):
-    if 'RaceTrack2' in path:
-        return extra_reward/2897
-    elif 'circut_spa' in path:
-        return extra_reward/1313
-    else:
-        return extra_reward/3097
-
@@ -6,9 +6,10 @@ import numpy as np
 import pandas as pd
 import visdom as vis
 from PIL import Image
-from ast import literal_eval
 
 from config import DATE_TIME, SENSORS, EXPERIMENTS_PATH, MAP, INVERT
+from episode_log import read_episode
+from frame_store import has_frames, open_frames
 
 """
 The idea of the visdom usage for ongoing models is calling vis_initialize_windows() and saving the windows,
@@ -57,12 +58,12 @@ def vis_log_data(visdom:vis.Visdom, windows:dict, data_path:str, data:dict) -> i
     '''
     #Dont load whole file only last row, and append last row
     if data_path:
-        data = pd.read_csv(f'{data_path}/episode_info.csv')
-        data['location'] = [literal_eval(item) for item in data['location']]
-        data['velocity_vec'] = [literal_eval(item) for item in data['velocity_vec']]
-
-    location_x = [x[0] for x in data['location']]
-    location_y = [x[1] for x in data['location']]
+        data = read_episode(data_path)
+        location_x = list(data['location_0'])
+        location_y = list(data['location_1'])
+    else:
+        location_x = [x[0] for x in data['location']]
+        location_y = [x[1] for x in data['location']]
 
     visdom.line(X=location_x, Y=location_y, win=windows['trace'], update='replace',
                 opts={'ytickmin': min(location_y)-0.1*mean(location_y),
@@ -99,9 +100,13 @@ def vis_log_photos(visdom:vis, windows:dict, data_path:str, sensors:dict, data:d
     :return:
     '''
     if data_path:
-        idx = max([int(x.split('_')[-1][:-4]) for x in os.listdir(f'{data_path}/sensors')])
+        pngs = [x for x in os.listdir(f'{data_path}/sensors') if x.endswith('.png')]
+        idx = max([int(x.split('_')[-1][:-4]) for x in pngs]) if pngs else None
     for sensor in [sensor for sensor, value in sensors.items() if value & (sensor is not 'collisions')]:
-        if data_path:
+        if data_path and has_frames(data_path, sensor):
+            frames = open_frames(data_path, sensor)
+            img = np.array(frames[len(frames)-1])
+        elif data_path:
             img = np.array(Image.open(f'{data_path}/sensors/{sensor}_{idx}.png')).astype(np.uint8)
         else:
             #data[sensor] needs to be uint8 numpy array like above